@@ -0,0 +1,235 @@
+"""
+Admission control in front of the chat endpoints.
+
+- Token buckets per session and per client IP cap how fast any one client
+  can start turns (each turn costs one or two upstream model calls).
+- A global limit on turns in progress, with a bounded FIFO wait queue and a
+  maximum queueing time, applies backpressure before upstream quota runs out
+  instead of letting every request fail at once.
+
+Requests that can't be admitted fail fast with Rejected, which the app maps
+to 429 Too Many Requests with a Retry-After header.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+
+from metrics import Counter, Histogram
+
+QUEUE_WAIT = Histogram(
+    "counselor_admission_wait_seconds", "Time chat turns waited in the admission queue"
+)
+REJECTIONS = Counter(
+    "counselor_admission_rejections_total", "Chat requests rejected with 429", ("reason",)
+)
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"request rejected ({reason}), retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token; return 0 on success or the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token bucket per key, keeping at most `max_keys` buckets (least recently used dropped)."""
+
+    def __init__(self, per_minute, burst, max_keys=100000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def check(self, key):
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take()
+
+    def refund(self, key):
+        """Give back the token check() took, for a request that was turned away elsewhere."""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionQueue:
+    """At most `max_active` turns at once; up to `max_queue` more wait, each for at most `max_wait` seconds."""
+
+    def __init__(self, max_active, max_queue, max_wait):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters = OrderedDict()  # future -> None, in arrival order
+        # Moving average of how long a turn holds its slot, for Retry-After
+        self.average_hold = 1.0
+
+    @property
+    def depth(self):
+        return len(self._waiters)
+
+    def estimated_wait(self, position):
+        return self.average_hold * (position + 1) / self.max_active
+
+    async def acquire(self):
+        """Wait for a slot; returns the time waited or raises Rejected."""
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+            return 0.0
+        if len(self._waiters) >= self.max_queue:
+            raise Rejected("queue_full", self.estimated_wait(len(self._waiters)))
+
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[waiter] = None
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self._waiters.pop(waiter, None)
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot was handed over just as we gave up
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise Rejected("queue_timeout", self.estimated_wait(len(self._waiters))) from None
+        return time.monotonic() - started
+
+    def release(self, held=None):
+        if held is not None:
+            self.average_hold += 0.1 * (held - self.average_hold)
+        # Hand the slot straight to the oldest waiter, if any
+        while self._waiters:
+            waiter, _ = self._waiters.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+def client_address(request, trusted_hops=0):
+    """
+    The client IP of a Starlette request. Behind `trusted_hops` reverse
+    proxies (e.g. 1 on Heroku or Render), the address those proxies appended
+    to X-Forwarded-For is used; entries further left are client-supplied and
+    can't be trusted.
+    """
+    if trusted_hops > 0:
+        forwarded = [a.strip() for a in request.headers.get("x-forwarded-for", "").split(",") if a.strip()]
+        if len(forwarded) >= trusted_hops:
+            return forwarded[-trusted_hops]
+    return request.client.host if request.client else "unknown"
+
+
+class Admission:
+    def __init__(self, session_per_minute=12, session_burst=6, ip_per_minute=120,
+                 ip_burst=60, max_active=32, max_queue=100, max_wait=15.0):
+        self.sessions = RateLimiter(session_per_minute, session_burst)
+        self.ips = RateLimiter(ip_per_minute, ip_burst)
+        self.queue = AdmissionQueue(max_active, max_queue, max_wait)
+        self.counters = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_session": 0,
+            "rejected_ip": 0,
+            "rejected_queue_full": 0,
+            "rejected_queue_timeout": 0,
+        }
+        self.wait_seconds_total = 0.0
+
+    @classmethod
+    def from_env(cls, max_active):
+        return cls(
+            session_per_minute=float(os.environ.get("RATE_LIMIT_SESSION_PER_MINUTE", "12")),
+            session_burst=float(os.environ.get("RATE_LIMIT_SESSION_BURST", "6")),
+            ip_per_minute=float(os.environ.get("RATE_LIMIT_IP_PER_MINUTE", "120")),
+            ip_burst=float(os.environ.get("RATE_LIMIT_IP_BURST", "60")),
+            max_active=int(os.environ.get("ADMISSION_MAX_ACTIVE", str(max_active))),
+            max_queue=int(os.environ.get("ADMISSION_QUEUE_SIZE", "100")),
+            max_wait=float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "15")),
+        )
+
+    def reject(self, reason, retry_after):
+        self.counters[f"rejected_{reason}"] += 1
+        REJECTIONS.inc(reason=reason)
+        raise Rejected(reason, retry_after)
+
+    async def admit(self, session_id, client_ip):
+        """
+        Charge the session's and the IP's buckets, then wait for a turn slot.
+        Returns the slot's release function; raises Rejected.
+        """
+        retry_after = self.sessions.check(session_id)
+        if retry_after:
+            self.reject("session", retry_after)
+        retry_after = self.ips.check(client_ip)
+        if retry_after:
+            # The turn doesn't run, so it mustn't use up the session's quota
+            self.sessions.refund(session_id)
+            self.reject("ip", retry_after)
+
+        if self.queue.depth or self.queue.active >= self.queue.max_active:
+            self.counters["queued"] += 1
+        try:
+            waited = await self.queue.acquire()
+        except Rejected as e:
+            self.reject(e.reason, e.retry_after)
+        QUEUE_WAIT.observe(waited)
+        self.wait_seconds_total += waited
+        self.counters["admitted"] += 1
+
+        acquired_at = time.monotonic()
+        released = False
+
+        def release(*_):
+            nonlocal released
+            if not released:
+                released = True
+                self.queue.release(time.monotonic() - acquired_at)
+
+        return release
+
+    def stats(self):
+        admitted = self.counters["admitted"]
+        return {
+            "active": self.queue.active,
+            "max_active": self.queue.max_active,
+            "queue_depth": self.queue.depth,
+            "max_queue": self.queue.max_queue,
+            "avg_wait_seconds": self.wait_seconds_total / admitted if admitted else 0.0,
+            "tracked_sessions": len(self.sessions),
+            "tracked_ips": len(self.ips),
+            **self.counters,
+        }
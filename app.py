@@ -1,17 +1,52 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from google import genai
+from typing import Optional
+import asyncio
+import json
 import os
-import traceback
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+from admission import Admission, Rejected, client_address
+from budgets import TRUNCATIONS, WASTED_TOKENS, OutputBudget, finish_reason, is_truncated, wasted_tokens
+from crisis import CRISIS_FAST_PATH, SAFETY_RESPONSE, match_crisis
+from few_shot import EXAMPLES, FEW_SHOT_EXAMPLES, FEW_SHOT_K, FewShotIndex, render_examples
+from model_client import create_client
+from history import ConversationHistory, build_summary_prompt, estimate_tokens
+from metrics import (
+    CANCELLED_TURNS, HISTORY_CHARS, SAFETY_RESPONSES, SAVED_TOKENS, RequestTrace, current_trace,
+    get_logger, log_event, register_collector, render_metrics,
+)
+from resilience import Deadline, DeadlineExceeded, ResilientCaller, UpstreamUnavailable
+from session_store import create_session_store
+from static_assets import StaticAssets
+from turns import SessionLocks, TurnCancelled, TurnRegistry
 
 # Load environment variables from .env file (for local development)
 load_dotenv()
 
-app = FastAPI(title="AI Counselor API", version="1.0.0")
+# Structured JSON logs on stderr (level from LOG_LEVEL), see metrics.py
+logger = get_logger("counselor")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Start serving right away; the client, few-shot index, upstream
+    # connection and prompt cache are prepared in the background and
+    # /readyz reports when that is done.
+    global startup_task
+    startup_task = asyncio.create_task(warm_up())
+    yield
+    startup_task.cancel()
+    await prompt_cache.stop()
+
+app = FastAPI(title="AI Counselor API", version="1.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -22,16 +57,45 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Get API key from environment variable
-api_key = os.environ.get("GOOGLE_API_KEY")
-if not api_key:
-    raise ValueError(
-        "GOOGLE_API_KEY environment variable is not set. "
-        "Please set it in your .env file or environment variables."
-    )
-client = genai.Client(api_key=api_key)
+# Model client (real Gemini API, or the offline fake with GEMINI_BACKEND=fake).
+# Built on first use rather than at import: constructing it imports
+# google-genai (~0.6s), and a missing API key should fail /readyz instead of
+# the whole process.
+client = None
+client_lock = threading.Lock()
+
+def set_client(new_client):
+    """Swap the model client, e.g. for a FakeGeminiClient in tests and benchmarks."""
+    global client
+    client = new_client
+
+def get_client():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = create_client()
+    return client
 
-# System prompt and few-shot examples
+async def model_client():
+    """The model client, built in a worker thread on first use so the event loop isn't blocked."""
+    if client is not None:
+        return client
+    return await asyncio.to_thread(get_client)
+
+MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+
+# Per-request deadline, retries with backoff, optional hedging, circuit
+# breaking and the fallback model chain for every upstream call (see
+# resilience.py). A hedged duplicate shares its call's upstream slot.
+upstream = ResilientCaller.from_env(MODEL_NAME)
+
+# Cap on in-flight upstream Gemini calls per worker process. Calls beyond the
+# cap wait on the semaphore instead of piling more load on the upstream API.
+MAX_CONCURRENT_UPSTREAM = int(os.environ.get("MAX_CONCURRENT_UPSTREAM", "16"))
+upstream_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPSTREAM)
+
+# System prompt
 SYSTEM_PROMPT = """You are a compassionate AI counselor specializing in mental health support for depression and anxiety. 
 
 Your approach:
@@ -52,149 +116,431 @@ IMPORTANT: Always think through your response step-by-step before answering:
 IMPORTANT: Keep your response under 300 words. Be concise while maintaining warmth and empathy.
 """
 
-FEW_SHOT_EXAMPLES = """
-Example 1:
-User: "I feel like I'm drowning in work and I can't keep up. Everyone else seems fine but I'm falling apart."
-
-Counselor's thought process:
-- Feeling: Overwhelmed, inadequate, isolated
-- Underlying issue: Possible burnout, comparison with others, lack of support
-- Need: Validation that their feelings are real and normal
-- Response approach: Normalize their experience, validate feelings, offer perspective
+# Few-shot examples live in few_shot.py as a structured corpus. With
+# FEW_SHOT_K > 0 only the most relevant examples are sent each turn. The
+# index (and numpy) is loaded by the startup warm-up or the first turn.
+few_shot_index = None
 
-Counselor: "What you're experiencing sounds incredibly overwhelming, and I want you to know that your feelings are completely valid. It's important to remember that what you see of others is often just the surface - many people struggle privately. Feeling like you're 'falling apart' is actually your mind and body telling you that you need support and rest. This isn't a weakness; it's a sign that you're human and that you've been carrying too much. Can you tell me more about what's been weighing on you most?"
+def get_few_shot_index():
+    global few_shot_index
+    if few_shot_index is None:
+        few_shot_index = FewShotIndex(EXAMPLES)
+    return few_shot_index
 
-Example 2:
-User: "I don't see the point anymore. Nothing makes me happy."
 
-Counselor's thought process:
-- Feeling: Hopelessness, anhedonia (loss of pleasure), possible depression
-- Underlying issue: This could indicate clinical depression - serious concern
-- Need: Immediate validation, gentle exploration, professional help recommendation
-- Response approach: Take seriously, show care, assess safety, encourage professional support
+# Prompt-prefix caching. SYSTEM_PROMPT (plus FEW_SHOT_EXAMPLES when every
+# example is sent, FEW_SHOT_K=0) is identical on every PLAN and ANSWER call, so
+# it is uploaded once as a Gemini cached content and referenced by name
+# instead of being re-sent each time.
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE", "1") != "0"
+# Gemini rejects cached contents below a minimum size; don't try below this
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_TTL_SECONDS = int(os.environ.get("PROMPT_CACHE_TTL_SECONDS", "3600"))
+# How long to wait before trying again after the cache could not be created
+PROMPT_CACHE_RETRY_SECONDS = int(os.environ.get("PROMPT_CACHE_RETRY_SECONDS", "300"))
 
-Counselor: "Thank you for sharing something so difficult with me. What you're describing - this feeling of emptiness and loss of joy - is a real symptom that many people with depression experience, and it's not your fault. These feelings can feel permanent, but they're not. I'm concerned about you and I want to help. First, I need to ask: are you having thoughts of hurting yourself? Also, have you been able to talk to a mental health professional? You deserve support from someone who can work with you regularly. In the meantime, I'm here to listen."
+class PromptCache:
+    """
+    Owns the cached-content handle for the static prompt prefix.
 
-Example 3:
-User: "I had a panic attack today and I'm scared it will happen again."
+    The handle is created at startup and its TTL is extended by a background
+    task shortly before it expires. If the upstream cache disappears anyway
+    (evicted, deleted, expired while the refresher was stalled) the failing
+    request is replayed with the inline prefix and the handle is recreated in
+    the background. When caching is disabled or unavailable every request
+    simply carries the prefix inline.
+    """
 
-Counselor's thought process:
-- Feeling: Fear, anxiety about anxiety, loss of control
-- Underlying issue: Panic disorder symptoms, fear of recurrence
-- Need: Reassurance, education about panic attacks, coping tools
-- Response approach: Normalize the experience, provide psychoeducation, teach grounding
+    # Refresh this many seconds before the TTL runs out
+    REFRESH_MARGIN = 120
 
-Counselor: "I'm sorry you went through that - panic attacks can be terrifying, especially when they're unexpected. First, I want you to know that you're safe now, and what you experienced, while frightening, wasn't dangerous. The fear of having another panic attack is very common and actually has a name: 'anticipatory anxiety.' Here's something that might help: panic attacks always pass, usually within 10-20 minutes. When you feel one coming, try the 5-4-3-2-1 grounding technique: name 5 things you see, 4 you can touch, 3 you hear, 2 you smell, and 1 you taste. This helps bring you back to the present moment. Would you like to talk about what was happening before the panic attack occurred?"
-
-Example 4:
-User: "I avoid social situations because I'm terrified people will judge me. I canceled plans again today and now I feel like a failure."
+    def __init__(self, model, system_instruction, prefix, ttl_seconds, enabled=True):
+        self.model = model
+        self.system_instruction = system_instruction
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled and (
+            estimate_tokens(system_instruction + prefix) >= PROMPT_CACHE_MIN_TOKENS
+        )
+        self.name = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.prefix_tokens = 0
+        self._lock = asyncio.Lock()
+        self._creating = None
+        self._refresher = None
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "creates": 0,
+            "refreshes": 0,
+            "evictions": 0,
+            "errors": 0,
+            "cached_tokens": 0,
+        }
 
-Counselor's thought process:
-- Feeling: Social anxiety, shame, self-criticism, isolation
-- Underlying issue: Fear of negative evaluation, avoidance cycle reinforcing anxiety
-- Need: Validation without enabling avoidance, gentle challenge to negative self-talk
-- Response approach: Normalize the fear, address self-criticism, explore small steps forward
+    def inline(self, suffix):
+        """The full prompt used when no cache handle is available."""
+        if not self.prefix:
+            return f"{self.system_instruction}\n\n{suffix}"
+        return f"{self.system_instruction}\n\n{self.prefix}\n\n{suffix}"
 
-Counselor: "First, I want to acknowledge how brave it is that you're sharing this with me. Social anxiety is incredibly common, and the fear of judgment can feel paralyzing. But I want to gently challenge the idea that you're a 'failure' - you're someone dealing with anxiety, and that's not a character flaw. The tricky thing about avoidance is that while it brings short-term relief, it can actually strengthen the anxiety over time. Your brain learns that social situations are dangerous, even though they're not. What if we thought about this differently? Instead of 'I'm a failure for canceling,' what if it's 'I'm struggling with anxiety, and I'm working on it.' Can you tell me what specifically worries you most about these social situations?"
+    async def start(self):
+        if not self.enabled:
+            return
+        await self.ensure()
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_loop())
 
-Example 5:
-User: "My partner and I keep fighting about the same things. I don't think they understand how I feel."
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
 
-Counselor's thought process:
-- Feeling: Frustration, feeling unheard, relationship distress
-- Underlying issue: Communication breakdown, possible unmet needs
-- Need: Help identifying patterns, communication tools, validation of both perspectives
-- Response approach: Explore the pattern, teach communication skills, avoid taking sides
+    def handle(self):
+        """
+        Return the current cache name, or None if requests must go inline.
+        Never blocks the request path: a missing handle is recreated in the
+        background.
+        """
+        if self.name is not None and time.monotonic() < self.expires_at:
+            self.counters["hits"] += 1
+            return self.name
+        self.counters["misses"] += 1
+        self._schedule_create()
+        return None
 
-Counselor: "Relationship conflicts, especially recurring ones, can be really exhausting and lonely. It sounds like you're feeling unheard, which is painful. I'm curious - when you say they don't understand how you feel, have you been able to express your feelings using 'I' statements? For example, instead of 'You always...' trying 'I feel... when... because...' This can help your partner hear your feelings without becoming defensive. Also, it might help to ask yourself: what need of mine isn't being met? Is it connection, respect, support, or something else? Understanding this can help you communicate more clearly. Would you be willing to tell me about one of these recurring conflicts so we can explore it together?"
+    def _schedule_create(self):
+        if self.enabled and self._creating is None and time.monotonic() >= self.retry_at:
+            self._creating = asyncio.create_task(self.ensure())
 
-Example 6:
-User: "It's been six months since my mom passed away and I still cry every day. People say I should be moving on by now."
+    async def ensure(self):
+        async with self._lock:
+            try:
+                if self.name is None or time.monotonic() >= self.expires_at:
+                    await self._create()
+            finally:
+                self._creating = None
 
-Counselor's thought process:
-- Feeling: Grief, sadness, pressure from others, possibly guilt
-- Underlying issue: Normal grief process being invalidated by others
-- Need: Permission to grieve, normalization of timeline, validation
-- Response approach: Strongly validate grief, educate about grief process, challenge "should"
+    async def _create(self):
+        try:
+            active = await model_client()
+            cached = await active.aio.caches.create(
+                model=self.model,
+                config={
+                    "system_instruction": self.system_instruction,
+                    "contents": [self.prefix],
+                    "ttl": f"{self.ttl_seconds}s",
+                    "display_name": "ai-counselor-prompt-prefix",
+                },
+            )
+        except Exception as e:
+            self.counters["errors"] += 1
+            self.name = None
+            self.retry_at = time.monotonic() + PROMPT_CACHE_RETRY_SECONDS
+            log_event(logger, "prompt_cache_unavailable", logging.WARNING,
+                      error_class=type(e).__name__, error=str(e))
+            return
+        self.name = cached.name
+        self.expires_at = time.monotonic() + self.ttl_seconds
+        usage = getattr(cached, "usage_metadata", None)
+        self.prefix_tokens = getattr(usage, "total_token_count", None) or 0
+        self.counters["creates"] += 1
+        log_event(logger, "prompt_cache_created", name=self.name, prefix_tokens=self.prefix_tokens)
 
-Counselor: "I'm so sorry for the loss of your mom. What you're experiencing is completely normal and valid. There's no timeline for grief, and anyone who suggests you 'should' be over it by six months doesn't understand how grief works. Grief isn't linear - it comes in waves, and six months is still very recent. Crying every day is your heart processing an enormous loss. Some people grieve intensely for years, and that's okay. What matters is that you're allowing yourself to feel. Grief is love with nowhere to go, and the depth of your pain reflects the depth of your love for your mom. How are you taking care of yourself during this time? And do you have people in your life who allow you to grieve without judgment?"
+    async def _refresh_loop(self):
+        while True:
+            delay = self.expires_at - time.monotonic() - self.REFRESH_MARGIN
+            await asyncio.sleep(max(delay, self.REFRESH_MARGIN))
+            async with self._lock:
+                if self.name is None:
+                    await self._create()
+                    continue
+                try:
+                    active = await model_client()
+                    await active.aio.caches.update(
+                        name=self.name, config={"ttl": f"{self.ttl_seconds}s"}
+                    )
+                    self.expires_at = time.monotonic() + self.ttl_seconds
+                    self.counters["refreshes"] += 1
+                except Exception as e:
+                    log_event(logger, "prompt_cache_refresh_failed", logging.WARNING,
+                              error_class=type(e).__name__, error=str(e))
+                    self.counters["evictions"] += 1
+                    await self._create()
 
-Example 7:
-User: "I look in the mirror and hate what I see. I feel ugly and worthless compared to everyone else."
+    def invalidate(self, name):
+        """Forget a handle the upstream rejected; it is recreated on next use."""
+        if self.name == name:
+            self.name = None
+            self.counters["evictions"] += 1
+            self._schedule_create()
 
-Counselor's thought process:
-- Feeling: Low self-esteem, self-hatred, comparison, body image issues
-- Underlying issue: Negative self-perception, possibly influenced by social media/society
-- Need: Compassionate challenge to distorted thinking, self-worth beyond appearance
-- Response approach: Validate pain, challenge comparison, explore self-worth sources
+    @staticmethod
+    def is_cache_error(error):
+        """True when a request failed because its cached content is gone."""
+        code = getattr(error, "code", None)
+        message = str(error).lower()
+        return code in (403, 404) or "cached content" in message or "cachedcontent" in message
 
-Counselor: "Thank you for trusting me with something so painful. The relationship we have with ourselves can be the hardest one, and I hear how much you're struggling right now. I want to ask you something: if a friend came to you and said they felt ugly and worthless, what would you say to them? Often we're much kinder to others than to ourselves. Comparison is a trap - we compare our behind-the-scenes to everyone else's highlight reel, especially on social media. But here's the truth: your worth has nothing to do with how you look. Your worth is inherent - it exists because you exist. What are some things about yourself that have nothing to do with appearance? What do you value in others - is it really just how they look, or is it their kindness, humor, intelligence, creativity?"
+    def record_usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        cached_tokens = getattr(usage, "cached_content_token_count", None)
+        if cached_tokens:
+            self.counters["cached_tokens"] += cached_tokens
 
-Example 8:
-User: "I have so much to do and I can't focus on anything. My mind keeps racing and I'm getting nothing done."
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "enabled": self.enabled,
+            "active": self.name is not None,
+            "prefix_tokens": self.prefix_tokens,
+            "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+            **self.counters,
+        }
 
-Counselor's thought process:
-- Feeling: Overwhelmed, scattered, anxious, possibly paralyzed by stress
-- Underlying issue: Cognitive overload, possible anxiety, lack of prioritization
-- Need: Grounding, practical strategies, validation of difficulty
-- Response approach: Validate, provide concrete stress management tools, break down tasks
+prompt_cache = PromptCache(
+    model=MODEL_NAME,
+    system_instruction=SYSTEM_PROMPT,
+    prefix=FEW_SHOT_EXAMPLES if FEW_SHOT_K <= 0 else "",
+    ttl_seconds=PROMPT_CACHE_TTL_SECONDS,
+    enabled=PROMPT_CACHE_ENABLED,
+)
 
-Counselor: "What you're describing is a really common response to stress and overwhelm - when we have too much to do, our brain can go into overdrive and actually make it harder to do anything. It's like having too many browser tabs open. First, take a breath with me. Let's try to calm your nervous system. Can you name three things you can see right now? Good. Now, let's make this manageable. Instead of looking at everything at once, can you identify just ONE thing that absolutely must get done today? Just one. We're going to ignore everything else for now. Once you have that one thing, break it into the smallest possible first step - something you can do in 5 minutes. Sometimes we just need to build momentum. Also, your racing mind might benefit from a 'brain dump' - write down everything you're worried about, just to get it out of your head. Does this feel doable?"
-"""
+# Store conversation history per session (see session_store.py)
+sessions = create_session_store()
 
-# Store conversation history per session
-conversations = {}
+async def session_call(method, *args):
+    """Call a `sessions` method, in a thread if the store blocks on I/O (SQLite)."""
+    if sessions.blocking:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
 
 # Request/Response models
 class ChatRequest(BaseModel):
     message: str
     session_id: str = "default"
+    pipeline: Optional[str] = None  # "two_stage", "fused" or "thinking"
+    request_id: Optional[str] = None  # idempotency key for retries / double submits
 
 class ChatResponse(BaseModel):
-    task: str  # "PLAN" or "ANSWER"
+    task: str  # "ANSWER", or "SAFETY" from the crisis fast path
     prompt: str
     session_id: str
 
 class ResetRequest(BaseModel):
     session_id: str = "default"
 
+class FollowUpRequest(BaseModel):
+    session_id: str = "default"
+    request_id: str
+
+class CancelRequest(BaseModel):
+    session_id: str = "default"
+    request_id: Optional[str] = None  # None cancels every turn of the session
+
 from pathlib import Path
 
 # Get the directory where this script is located
 BASE_DIR = Path(__file__).resolve().parent
 
+# Frontend assets, fingerprinted and precompressed once at startup (see
+# static_assets.py). Restart the server to pick up edits to these files.
+static_assets = StaticAssets(BASE_DIR, page="index.html", files=("styles.css", "script.js"))
+
 @app.get("/")
-async def read_root():
-    return FileResponse(BASE_DIR / "index.html")
+async def read_root(request: Request):
+    return static_assets.serve("index.html", request)
+
+@app.get("/assets/{name}")
+async def get_asset(name: str, request: Request):
+    return static_assets.serve_hashed(name, request)
 
+# Unhashed URLs, for pages cached before assets were fingerprinted
 @app.get("/styles.css")
-async def get_styles():
-    return FileResponse(BASE_DIR / "styles.css")
+async def get_styles(request: Request):
+    return static_assets.serve("styles.css", request)
 
 @app.get("/script.js")
-async def get_script():
-    return FileResponse(BASE_DIR / "script.js")
+async def get_script(request: Request):
+    return static_assets.serve("script.js", request)
 
-@app.post("/chat")
-async def chat(request: ChatRequest):
+def request_args(prompt, cache_name):
+    """Contents and config for one call, referencing the cached prefix if we have one."""
+    config = {
+        "temperature": 0.7,
+    }
+    if cache_name is None:
+        return prompt_cache.inline(prompt), config
+    config["cached_content"] = cache_name
+    return prompt, config
+
+def new_usage():
+    """Per-request token accounting, filled in by generate()/generate_stream()."""
+    return {
+        "upstream_calls": 0,
+        "prompt_tokens": 0,
+        "output_tokens": 0,
+        "thinking_tokens": 0,
+        "cached_tokens": 0,
+        "wasted_tokens": 0,
+    }
+
+def add_usage(usage, response):
+    if usage is None:
+        return
+    usage["upstream_calls"] += 1
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return
+    usage["prompt_tokens"] += getattr(metadata, "prompt_token_count", None) or 0
+    usage["output_tokens"] += getattr(metadata, "candidates_token_count", None) or 0
+    usage["thinking_tokens"] += getattr(metadata, "thoughts_token_count", None) or 0
+    usage["cached_tokens"] += getattr(metadata, "cached_content_token_count", None) or 0
+
+# Moving average of the tokens one call of each stage costs, for estimating
+# what cancelling a turn before (or during) a stage saved
+stage_costs = {}  # stage -> {"input": tokens, "output": thinking + output tokens}
+
+def record_stage_cost(stage, response):
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return
+    sample = {
+        "input": getattr(metadata, "prompt_token_count", None) or 0,
+        "output": (getattr(metadata, "thoughts_token_count", None) or 0)
+        + (getattr(metadata, "candidates_token_count", None) or 0),
+    }
+    cost = stage_costs.setdefault(stage, dict(sample))
+    for kind, count in sample.items():
+        cost[kind] += 0.1 * (count - cost[kind])
+
+def record_call(stage, prompt, response, started):
+    """Attribute one model call's latency, prompt size and tokens to the current request."""
+    prompt_cache.record_usage(response)
+    record_stage_cost(stage, response)
+    trace = current_trace()
+    if trace is not None:
+        trace.add_stage(stage, time.perf_counter() - started)
+        trace.record_prompt(stage, prompt)
+        trace.record_usage(stage, response)
+
+def record_queue_wait(queued):
+    """Record the wait for an upstream slot as the "upstream_queue" stage."""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_stage("upstream_queue", time.perf_counter() - queued)
+
+async def model_request(model, prompt, max_output_tokens, extra_config, stage, stream=False):
+    """
+    One upstream attempt against `model`. The cached prefix belongs to the
+    primary model, so fallback models get the prefix inline.
+    """
+    models = (await model_client()).aio.models
+    method = models.generate_content_stream if stream else models.generate_content
+    cache_name = prompt_cache.handle() if model == prompt_cache.model else None
+    contents, config = request_args(prompt, cache_name)
+    config.update(extra_config or {}, max_output_tokens=max_output_tokens)
     try:
-        if not request.message:
-            raise HTTPException(status_code=400, detail="No message provided")
-        
-        # Get or create conversation history
-        if request.session_id not in conversations:
-            conversations[request.session_id] = []
-        
-        conversation_history = "\n".join(conversations[request.session_id])
-        
-        # Step 1: Generate PLAN (thinking process)
-        plan_prompt = f"""{SYSTEM_PROMPT}
+        result = await method(model=model, contents=contents, config=config)
+    except Exception as e:
+        if cache_name is None or not prompt_cache.is_cache_error(e):
+            raise
+        # Cache was evicted upstream: replay inline and let it be recreated
+        prompt_cache.invalidate(cache_name)
+        contents, config = request_args(prompt, None)
+        config.update(extra_config or {}, max_output_tokens=max_output_tokens)
+        result = await method(model=model, contents=contents, config=config)
+    if model != upstream.primary:
+        trace = current_trace()
+        if trace is not None:
+            trace.set(**{f"{stage}_model": model})
+    return result
+
+async def open_stream(model, prompt, max_output_tokens, extra_config, stage):
+    """Start a stream and wait for its first chunk, so retries and hedging cover time to first token."""
+    stream = await model_request(model, prompt, max_output_tokens, extra_config, stage, stream=True)
+    try:
+        first = await anext(stream)
+    except StopAsyncIteration:
+        first = None
+    return first, stream
+
+def close_stream(opened):
+    """Close the stream of a losing hedged attempt."""
+    _, stream = opened
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        asyncio.ensure_future(aclose())
 
-{FEW_SHOT_EXAMPLES}
+async def generate(prompt, max_output_tokens, usage=None, extra_config=None, stage="model"):
+    """
+    Run a single Gemini call on the async client so the event loop stays free
+    for other sessions and static routes while we wait on the upstream API.
+    `prompt` is the per-turn part; the static prefix comes from prompt_cache.
+    `stage` names the call in metrics and logs (plan, answer, fused, ...).
+    Retries, hedging, model fallback and the request deadline come from
+    `upstream` (see resilience.py).
+    """
+    queued = time.perf_counter()
+    async with upstream_semaphore:
+        record_queue_wait(queued)
+        started = time.perf_counter()
+        response = await upstream.call(
+            lambda model: model_request(model, prompt, max_output_tokens, extra_config, stage)
+        )
+        record_call(stage, prompt, response, started)
+        add_usage(usage, response)
+        return response
+
+async def generate_stream(prompt, max_output_tokens, usage=None, extra_config=None, stage="model"):
+    """
+    Streaming variant of generate(): yields response chunks as the model
+    produces them. The upstream slot is held until the stream is exhausted.
+    Failures before the first chunk are retried like generate(); once text
+    has been sent to the client the stream is not restarted. The rest of the
+    stream is bounded by the request deadline too, so a stream that stalls
+    raises DeadlineExceeded instead of holding its slots. Closing the
+    generator early (the turn was cancelled) closes the upstream stream.
+    """
+    queued = time.perf_counter()
+    async with upstream_semaphore:
+        record_queue_wait(queued)
+        started = time.perf_counter()
+        first, stream = await upstream.call(
+            lambda model: open_stream(model, prompt, max_output_tokens, extra_config, stage),
+            discard=close_stream,
+        )
+        trace = current_trace()
+        if trace is not None:
+            trace.add_stage(f"{stage}_first_token", time.perf_counter() - started)
+        deadline = Deadline.current()
+        # An empty stream (no first chunk) is still a call: closed and recorded
+        last_chunk = first
+        try:
+            while last_chunk is not None:
+                yield last_chunk
+                try:
+                    async with asyncio.timeout(deadline.remaining() if deadline else None):
+                        last_chunk = await anext(stream)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    raise DeadlineExceeded(f"{stage} stream stalled past the request deadline") from None
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        # Usage metadata on the final chunk covers the whole stream
+        record_call(stage, prompt, last_chunk, started)
+        add_usage(usage, last_chunk)
 
-{conversation_history}
+# The prompt builders return only the per-turn part of the prompt. The static
+# prefix from prompt_cache is attached by generate().
+def build_plan_prompt(conversation_history, message):
+    return f"""{conversation_history}
 
-User: "{request.message}"
+User: "{message}"
 
 Think through the following step-by-step and write out your thought process:
 1. What are they feeling?
@@ -203,99 +549,846 @@ Think through the following step-by-step and write out your thought process:
 4. How should I respond?
 
 Provide your internal thought process in a clear, structured way:"""
-        
-        # Get thinking process from Gemini
-        plan_response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=plan_prompt,
-            config={
-                "temperature": 0.7,
-                "max_output_tokens": 512,
-            }
-        )
-        
-        # Validate response
-        if plan_response is None or not hasattr(plan_response, 'text') or plan_response.text is None:
-            print("Warning: PLAN response is None or invalid")
-            print(f"plan_response type: {type(plan_response)}")
-            print(f"plan_response value: {plan_response}")
-            if plan_response is not None:
-                print(f"plan_response attributes: {dir(plan_response)}")
-            thinking_process = "Unable to generate thinking process."
-        else:
-            thinking_process = plan_response.text.strip()
-            print(f"✓ PLAN generated successfully ({len(thinking_process)} chars)")
-        
-        # Step 2: Generate ANSWER (final response)
-        answer_prompt = f"""{SYSTEM_PROMPT}
-
-{FEW_SHOT_EXAMPLES}
-
-{conversation_history}
-
-User: "{request.message}"
+
+def build_answer_prompt(conversation_history, message, thinking_process):
+    return f"""{conversation_history}
+
+User: "{message}"
 
 Your thought process:
 {thinking_process}
 
 Based on your analysis above, provide ONLY your compassionate counselor response directly to the user, without showing your thought process or any labels:"""
-        
-        # Get final response from Gemini
-        answer_response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=answer_prompt,
-            config={
-                "temperature": 0.7,
-                "max_output_tokens": 1024,
-            }
+
+def build_fused_prompt(conversation_history, message):
+    return f"""{conversation_history}
+
+User: "{message}"
+
+First think through the following step-by-step and write it in the "plan" field:
+1. What are they feeling?
+2. What might be the underlying cause?
+3. What do they need right now?
+4. How should I respond?
+
+Then, based on that plan, write your compassionate counselor response directly to the user in the "answer" field, without showing your thought process or any labels."""
+
+def build_direct_prompt(conversation_history, message):
+    return f"""{conversation_history}
+
+User: "{message}"
+
+Before answering, think through what they are feeling, what might be the underlying cause, what they need right now and how you should respond.
+
+Then provide ONLY your compassionate counselor response directly to the user, without showing your thought process or any labels:"""
+
+def response_text(response, stage):
+    """Return the stripped text of a Gemini response, or None if it is missing."""
+    if response is None or not hasattr(response, 'text') or response.text is None:
+        log_event(
+            logger, "empty_response", logging.WARNING,
+            stage=stage,
+            response_type=type(response).__name__,
+            finish_reason=finish_reason(response),
+        )
+        return None
+    return response.text.strip()
+
+# Output budgets per stage (see budgets.py). PLAN reasons explicitly, so
+# model thinking is off there and for the ANSWER that follows the plan; it
+# would otherwise eat into max_output_tokens and leave the text empty.
+PLAN_BUDGET = OutputBudget.from_env("plan", 512, thinking_budget=0, on_truncation="accept")
+ANSWER_BUDGET = OutputBudget.from_env("answer", 1024, thinking_budget=0, on_truncation="continue")
+FUSED_BUDGET = OutputBudget.from_env("fused", 1536, thinking_budget=0, on_truncation="retry")
+SUMMARY_BUDGET = OutputBudget.from_env("summary", 512, thinking_budget=0, on_truncation="retry")
+
+def note_truncation(stage, action):
+    TRUNCATIONS.inc(stage=stage, action=action)
+    trace = current_trace()
+    if trace is not None:
+        trace.set(**{f"{stage}_truncated": action})
+
+def discard_output(usage, stage, response):
+    """Count a paid-for response that is being thrown away as wasted tokens."""
+    counts = wasted_tokens(response)
+    for kind, count in counts.items():
+        if count:
+            WASTED_TOKENS.inc(count, stage=stage, kind=kind)
+    if usage is not None:
+        usage["wasted_tokens"] += sum(counts.values())
+    trace = current_trace()
+    if trace is not None:
+        trace.tokens[f"{stage}_wasted"] += sum(counts.values())
+
+def build_continuation_prompt(prompt, partial):
+    return f"""{prompt}
+
+{partial}
+
+(Your response above was cut off. Continue it exactly where it stopped, without repeating anything and without any introduction:)"""
+
+def join_continuation(text, more):
+    """Append a continuation, with a space unless it resumes mid-punctuation."""
+    if not more or text.endswith((" ", "\n")) or more[0] in " \n.,;:!?)'\"":
+        return text + more
+    return f"{text} {more}"
+
+async def generate_text(prompt, budget, usage=None, extra_config=None):
+    """
+    generate() for one stage under its OutputBudget, returning the response
+    text (or None). Output cut off at max_output_tokens is handled as
+    budget.on_truncation says instead of being dropped.
+    """
+    max_output_tokens = budget.max_output_tokens
+    while True:
+        config = {**budget.config(max_output_tokens), **(extra_config or {})}
+        response = await generate(prompt, config.pop("max_output_tokens"), usage, config, budget.stage)
+        text = response_text(response, budget.stage.upper())
+        if not is_truncated(response):
+            return text
+        if text and budget.on_truncation == "accept":
+            note_truncation(budget.stage, "accepted")
+            return text
+        if text and budget.on_truncation == "continue":
+            return await continue_text(prompt, text, budget, usage, extra_config)
+        # Nothing usable (typically thinking used up the budget): retry bigger
+        discard_output(usage, budget.stage, response)
+        max_output_tokens = budget.grow(max_output_tokens)
+        if max_output_tokens is None:
+            note_truncation(budget.stage, "gave_up")
+            return None
+        note_truncation(budget.stage, "retried")
+
+async def continue_text(prompt, text, budget, usage=None, extra_config=None):
+    """Ask for the rest of a truncated `text`, up to budget.max_continuations times."""
+    for _ in range(budget.max_continuations):
+        config = {**budget.config(), **(extra_config or {})}
+        response = await generate(build_continuation_prompt(prompt, text),
+                                  config.pop("max_output_tokens"), usage, config, budget.stage)
+        text = join_continuation(text, response_text(response, budget.stage.upper()) or "")
+        if not is_truncated(response):
+            note_truncation(budget.stage, "continued")
+            return text
+    note_truncation(budget.stage, "continued_partial")
+    return text
+
+async def generate_plan(conversation_history, message, usage=None):
+    """Step 1: Generate PLAN (internal thinking process)."""
+    thinking_process = await generate_text(
+        build_plan_prompt(conversation_history, message), PLAN_BUDGET, usage
+    )
+    if thinking_process is None:
+        return "Unable to generate thinking process."
+    log_event(logger, "plan_generated", level=logging.DEBUG, chars=len(thinking_process))
+    return thinking_process
+
+# Pipeline modes:
+#   two_stage - separate PLAN and ANSWER calls (the original chain-of-thought)
+#   fused     - one structured-output call returning {"plan", "answer"}
+#   thinking  - one call where the model's native thinking replaces PLAN
+PIPELINE_MODES = ("two_stage", "fused", "thinking")
+DEFAULT_PIPELINE = os.environ.get("PIPELINE_MODE", "two_stage")
+PIPELINE_THINKING_BUDGET = int(os.environ.get("PIPELINE_THINKING_BUDGET", "1024"))
+
+FUSED_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "plan": {"type": "STRING"},
+        "answer": {"type": "STRING"},
+    },
+    "required": ["plan", "answer"],
+    "property_ordering": ["plan", "answer"],
+}
+
+def resolve_pipeline(requested):
+    mode = requested or DEFAULT_PIPELINE
+    if mode not in PIPELINE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown pipeline '{mode}'. Choose one of: {', '.join(PIPELINE_MODES)}",
+        )
+    return mode
+
+async def run_fused(conversation_history, message, usage):
+    raw = await generate_text(
+        build_fused_prompt(conversation_history, message),
+        FUSED_BUDGET,
+        usage,
+        extra_config={
+            "response_mime_type": "application/json",
+            "response_schema": FUSED_SCHEMA,
+        },
+    )
+    if raw is None:
+        return None
+    try:
+        answer = json.loads(raw).get("answer")
+    except (ValueError, AttributeError):
+        log_event(logger, "invalid_fused_json", logging.WARNING, chars=len(raw))
+        return None
+    return answer.strip() if isinstance(answer, str) and answer.strip() else None
+
+# The thinking pipeline's single call: ANSWER's budget plus model thinking
+THINKING_ANSWER_BUDGET = ANSWER_BUDGET.with_thinking(PIPELINE_THINKING_BUDGET)
+
+async def run_pipeline(mode, conversation_history, message, usage):
+    """Run one turn through the selected pipeline and return the answer text (or None)."""
+    if mode == "fused":
+        return await run_fused(conversation_history, message, usage)
+
+    if mode == "thinking":
+        return await generate_text(
+            build_direct_prompt(conversation_history, message), THINKING_ANSWER_BUDGET, usage
+        )
+
+    thinking_process = await generate_plan(conversation_history, message, usage)
+
+    # Step 2: Generate ANSWER (final response)
+    return await generate_text(
+        build_answer_prompt(conversation_history, message, thinking_process), ANSWER_BUDGET, usage
+    )
+
+async def stream_pipeline(mode, conversation_history, message, usage):
+    """Streaming counterpart of run_pipeline(): yields answer text as it is produced."""
+    if mode == "fused":
+        # Structured JSON output can't be shown token by token; send it whole.
+        answer = await run_fused(conversation_history, message, usage)
+        if answer:
+            yield answer
+        return
+
+    if mode == "thinking":
+        prompt = build_direct_prompt(conversation_history, message)
+        budget = THINKING_ANSWER_BUDGET
+    else:
+        thinking_process = await generate_plan(conversation_history, message, usage)
+        prompt = build_answer_prompt(conversation_history, message, thinking_process)
+        budget = ANSWER_BUDGET
+
+    # Same truncation handling as generate_text(), except that text already
+    # sent can't be taken back: only an empty stream is retried bigger.
+    streamed = ""
+    request_prompt = prompt
+    max_output_tokens = budget.max_output_tokens
+    continuations = 0
+    resumed = False  # the next text continues a cut-off answer
+    while True:
+        config = budget.config(max_output_tokens)
+        last = None
+        async for chunk in generate_stream(request_prompt, config.pop("max_output_tokens"),
+                                           usage, config, budget.stage):
+            last = chunk
+            text = getattr(chunk, "text", None)
+            if text:
+                if resumed:
+                    text = join_continuation(streamed, text)[len(streamed):]
+                    resumed = False
+                streamed += text
+                yield text
+        if not is_truncated(last):
+            if continuations:
+                note_truncation(budget.stage, "continued")
+            return
+        if not streamed.strip():
+            discard_output(usage, budget.stage, last)
+            max_output_tokens = budget.grow(max_output_tokens)
+            if max_output_tokens is None:
+                note_truncation(budget.stage, "gave_up")
+                return
+            note_truncation(budget.stage, "retried")
+            continue
+        if budget.on_truncation != "continue" or continuations >= budget.max_continuations:
+            note_truncation(budget.stage, "continued_partial" if continuations else "accepted")
+            return
+        continuations += 1
+        request_prompt = build_continuation_prompt(prompt, streamed)
+        max_output_tokens = budget.max_output_tokens
+        resumed = True
+
+class PipelineMetrics:
+    """Per-mode latency and token counters, so pipeline modes can be A/B compared."""
+
+    # Latency samples kept per mode for percentiles
+    WINDOW = 1000
+
+    def __init__(self, modes):
+        self.modes = {mode: self._empty() for mode in modes}
+
+    @staticmethod
+    def _empty():
+        return {
+            "requests": 0,
+            "errors": 0,
+            "latency_seconds_total": 0.0,
+            "latencies": deque(maxlen=PipelineMetrics.WINDOW),
+            **new_usage(),
+        }
+
+    def record(self, mode, elapsed, usage, error=False):
+        entry = self.modes[mode]
+        entry["requests"] += 1
+        entry["errors"] += int(error)
+        entry["latency_seconds_total"] += elapsed
+        entry["latencies"].append(elapsed)
+        for key, value in usage.items():
+            entry[key] += value
+
+    def stats(self):
+        result = {}
+        for mode, entry in self.modes.items():
+            latencies = sorted(entry["latencies"])
+            requests = entry["requests"]
+            summary = {k: v for k, v in entry.items() if k != "latencies"}
+            summary["latency_p50"] = latencies[len(latencies) // 2] if latencies else None
+            summary["latency_p95"] = latencies[int(len(latencies) * 0.95)] if latencies else None
+            for key in ("prompt_tokens", "output_tokens", "thinking_tokens"):
+                summary[f"avg_{key}"] = entry[key] / requests if requests else 0.0
+            result[mode] = summary
+        return result
+
+pipeline_metrics = PipelineMetrics(PIPELINE_MODES)
+
+def prompt_context(conversation_history, message):
+    """
+    Per-turn context for the prompt builders: the few-shot examples most
+    relevant to this message (unless all of them are in the static prefix),
+    followed by the conversation history.
+    """
+    if FEW_SHOT_K <= 0:
+        return conversation_history
+    examples = render_examples(get_few_shot_index().select(message, FEW_SHOT_K))
+    return f"{examples}\n\n{conversation_history}"
+
+async def get_history(session_id):
+    """Get the conversation history for a session (empty for a new session)."""
+    return ConversationHistory.from_dict(await session_call(sessions.get, session_id))
+
+async def commit_exchange(session_id, message, counselor_response):
+    """Update conversation history (only with the final answer, not the thinking)."""
+    def add_exchange(state):
+        nonlocal history
+        history = ConversationHistory.from_dict(state)
+        history.add_exchange(message, counselor_response)
+        return history.to_dict()
+
+    history = None
+    await session_call(sessions.update, session_id, add_exchange)
+
+    # Turns that left the token budget are folded into the summary off the
+    # request path
+    if history.pending and session_id not in summarizing:
+        summarizing.add(session_id)
+        task = asyncio.create_task(summarize_session(session_id, list(history.pending)))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+# Sessions with a summary in progress, and references that keep background
+# tasks alive until they finish
+summarizing = set()
+background_tasks = set()
+
+async def generate_summary(prompt):
+    """
+    One summary call, without the counselor prompt prefix. A cut-off summary
+    would lose the folded turns for good, so it is retried with a larger
+    budget instead of being applied.
+    """
+    models = (await model_client()).aio.models
+    max_output_tokens = SUMMARY_BUDGET.max_output_tokens
+    while True:
+        config = {"temperature": 0.3, **SUMMARY_BUDGET.config(max_output_tokens)}
+        queued = time.perf_counter()
+        async with upstream_semaphore:
+            record_queue_wait(queued)
+            started = time.perf_counter()
+            response = await upstream.call(
+                lambda model: models.generate_content(model=model, contents=prompt, config=config)
+            )
+            record_call("summary", prompt, response, started)
+        if not is_truncated(response):
+            return response_text(response, "SUMMARY")
+        discard_output(None, "summary", response)
+        max_output_tokens = SUMMARY_BUDGET.grow(max_output_tokens)
+        if max_output_tokens is None:
+            note_truncation("summary", "gave_up")
+            return None
+        note_truncation("summary", "retried")
+
+async def summarize_session(session_id, lines):
+    # Background work gets its own trace so its calls aren't attributed to
+    # the request that scheduled it
+    trace = RequestTrace("summary", logger, session_id=session_id)
+    status, error = "ok", None
+    try:
+        while lines:
+            Deadline.start(upstream.default_deadline)
+            history = await get_history(session_id)
+            summary = await generate_summary(build_summary_prompt(history.summary, lines))
+            if summary is None:
+                return
+
+            # Re-read: the session may have moved on (or been reset) meanwhile
+            def apply_summary(state):
+                nonlocal history
+                if state is None:
+                    return None
+                history = ConversationHistory.from_dict(state)
+                return history.to_dict() if history.apply_summary(summary, lines) else None
+
+            if await session_call(sessions.update, session_id, apply_summary) is None:
+                return
+            trace.set(folded_lines=trace.fields.get("folded_lines", 0) + len(lines),
+                      summary_chars=len(summary))
+            # More turns may have left the window while we were summarizing
+            lines = list(history.pending)
+    except Exception as e:
+        status, error = "error", e
+    finally:
+        trace.finish(status, error)
+        summarizing.discard(session_id)
+
+FALLBACK_RESPONSE = "I apologize, but I'm having trouble generating a response right now. Please try again in a moment."
+
+# Turns of one session run one at a time, and duplicate submissions of the
+# same request (same session_id + request_id) share a single turn.
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "1024"))
+session_locks = SessionLocks()
+turns = TurnRegistry(max_completed=IDEMPOTENCY_CACHE_SIZE)
+
+async def assemble_context(trace, request):
+    """Render the session history and few-shot context, recorded as the "prompt" stage."""
+    with trace.stage("prompt"):
+        history_text = (await get_history(request.session_id)).render()
+        HISTORY_CHARS.observe(len(history_text))
+        trace.set(history_chars=len(history_text))
+        return prompt_context(history_text, request.message)
+
+def upstream_http_error(error):
+    """
+    The HTTP error for a failed turn: 504 when the request deadline ran out,
+    503 (with Retry-After) when every model is unavailable, 409 when the
+    turn was cancelled (reset or superseded), 500 otherwise.
+    Upstream error messages are logged, not returned to the browser.
+    """
+    if isinstance(error, TurnCancelled):
+        return HTTPException(status_code=409, detail=f"Request cancelled ({error.reason})")
+    if isinstance(error, DeadlineExceeded):
+        return HTTPException(
+            status_code=504,
+            detail="The counselor is taking too long to respond. Please try again.",
+        )
+    if isinstance(error, UpstreamUnavailable):
+        return HTTPException(
+            status_code=503,
+            detail="The counselor is temporarily unavailable. Please try again in a moment.",
+            headers={"Retry-After": str(math.ceil(error.retry_after or 5))},
+        )
+    return HTTPException(status_code=500, detail=FALLBACK_RESPONSE)
+
+# Model call stages of each pipeline mode, in order (truncation retries and
+# continuations aside)
+PIPELINE_STAGES = {
+    "two_stage": ("plan", "answer"),
+    "fused": ("fused",),
+    "thinking": ("answer",),
+}
+
+def record_cancellation(trace, mode, usage, reason, streamed=""):
+    """
+    Count a cancelled turn and estimate the upstream tokens the cancellation
+    saved: the average cost of each stage that never started, plus the rest
+    of an answer stream that was cut off. A call that was in flight without
+    streaming is assumed to be billed in full.
+    """
+    stages = PIPELINE_STAGES[mode]
+    if "upstream_queue" not in trace.stages:
+        remaining, in_flight = stages, None  # stopped before its first model call
+    else:
+        done = usage["upstream_calls"]
+        remaining = stages[done + 1:]
+        in_flight = stages[done] if done < len(stages) else None
+    saved = sum(cost["input"] + cost["output"]
+                for cost in (stage_costs.get(stage) for stage in remaining) if cost)
+    if streamed and in_flight in stage_costs:
+        saved += max(stage_costs[in_flight]["output"] - estimate_tokens(streamed), 0)
+    endpoint = trace.fields["endpoint"]
+    CANCELLED_TURNS.inc(endpoint=endpoint, reason=reason)
+    SAVED_TOKENS.inc(round(saved), endpoint=endpoint)
+    trace.set(cancel_reason=reason, saved_tokens=round(saved))
+    trace.finish("cancelled")
+
+async def answer_turn(request, mode, turn):
+    """Run one /chat turn under the session lock and return the response body."""
+    Deadline.start(upstream.default_deadline)
+    trace = RequestTrace("/chat", logger, pipeline=mode, session_id=request.session_id)
+    usage = new_usage()
+    queued = time.perf_counter()
+    try:
+        async with session_locks.hold(request.session_id):
+            trace.add_stage("session_queue", time.perf_counter() - queued)
+            start = time.perf_counter()
+            try:
+                conversation_history = await assemble_context(trace, request)
+                
+                counselor_response = await run_pipeline(
+                    mode, conversation_history, request.message, usage
+                )
+                status = "ok"
+                if counselor_response is None:
+                    counselor_response = FALLBACK_RESPONSE
+                    status = "fallback"
+                
+                await commit_exchange(request.session_id, request.message, counselor_response)
+                pipeline_metrics.record(mode, time.perf_counter() - start, usage)
+                trace.set(answer_chars=len(counselor_response))
+                trace.finish(status)
+                
+                # Return only the ANSWER (PLAN was used internally to generate better response)
+                return {
+                    "task": "ANSWER",
+                    "prompt": counselor_response,
+                    "session_id": request.session_id,
+                    "pipeline": mode,
+                }
+                
+            except Exception as e:
+                pipeline_metrics.record(mode, time.perf_counter() - start, usage, error=True)
+                trace.finish("error", e)
+                raise
+    except asyncio.CancelledError:
+        # Reset, cancelled or abandoned: nothing is committed to the session
+        record_cancellation(trace, mode, usage, turn.cancel_reason or "shutdown")
+        raise
+
+# Per-session and per-IP rate limits plus a bounded queue for turns in
+# progress (see admission.py). Behind a reverse proxy set FORWARDED_HOPS so
+# clients are told apart by X-Forwarded-For instead of the proxy's address.
+FORWARDED_HOPS = int(os.environ.get("FORWARDED_HOPS", "0"))
+admission = Admission.from_env(max_active=2 * MAX_CONCURRENT_UPSTREAM)
+
+async def admit(request, http_request):
+    """Wait for an admission slot and return its release function; 429 if there is none."""
+    try:
+        return await admission.admit(
+            request.session_id, client_address(http_request, FORWARDED_HOPS)
+        )
+    except Rejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many messages at once. Please wait a moment and try again.",
+            headers={"Retry-After": e.retry_after_header},
+        )
+
+async def start_turn(key, request, http_request, produce):
+    """
+    Join the turn for `key` if a duplicate is already running or done;
+    otherwise admit the request (429 if it can't be) and start a new turn
+    that holds an admission slot until it finishes.
+    """
+    release = None
+    existing = turns.find(key)
+    if existing is None or (existing.done and not existing.succeeded):  # not shared: a new turn
+        release = await admit(request, http_request)
+    turn = turns.start(key, produce)
+    if release is not None:
+        turn.task.add_done_callback(release)
+    return turn
+
+def safety_reply(endpoint, request):
+    """
+    Record a message caught by the crisis fast path (crisis.py). Its safety
+    response goes out before, and regardless of, admission and the model.
+    """
+    SAFETY_RESPONSES.inc(endpoint=endpoint)
+    log_event(logger, "safety_response", endpoint=endpoint, session_id=request.session_id)
+    return SAFETY_RESPONSE
+
+async def follow_up_turn(request, http_request, mode, turn):
+    """The model turn behind a safety response; waits for admission inside the turn."""
+    release = await admit(request, http_request)
+    try:
+        return await answer_turn(request, mode, turn)
+    finally:
+        release()
+
+async def until_disconnected(http_request):
+    """Return once the client has gone away (never, for a request without a connection)."""
+    try:
+        while (await http_request.receive())["type"] != "http.disconnect":
+            pass
+    except RuntimeError:  # no receive channel, e.g. a handler called directly
+        await asyncio.get_running_loop().create_future()
+
+async def wait_for_turn(turn, http_request):
+    """
+    turn.wait(), unless the client disconnects first. Then the request stops
+    following the turn, which cancels it if no other request follows it, and
+    a 499 (client closed request) is logged; the client is gone anyway.
+    """
+    waiter = asyncio.ensure_future(turn.wait())
+    watcher = asyncio.ensure_future(until_disconnected(http_request))
+    try:
+        await asyncio.wait((waiter, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        waiter.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if waiter.done():
+        return waiter.result()
+    waiter.cancel()
+    return Response(status_code=499)
+
+@app.post("/chat")
+async def chat(request: ChatRequest, http_request: Request):
+    if not request.message:
+        raise HTTPException(status_code=400, detail="No message provided")
+    mode = resolve_pipeline(request.pipeline)
+    if CRISIS_FAST_PATH and match_crisis(request.message):
+        # Answer now; the model's reply is fetched from /chat/follow_up
+        request.request_id = request.request_id or uuid.uuid4().hex
+        # Kept even if it fails, so /chat/follow_up can report why
+        turns.start(
+            ("chat", request.session_id, request.request_id),
+            lambda turn: follow_up_turn(request, http_request, mode, turn),
+            keep_failed=True,
         )
-        
-        # Validate response
-        if answer_response is None or not hasattr(answer_response, 'text') or answer_response.text is None:
-            print("Error: ANSWER response is None or invalid")
-            print(f"answer_response type: {type(answer_response)}")
-            print(f"answer_response value: {answer_response}")
-            if answer_response is not None:
-                print(f"answer_response attributes: {dir(answer_response)}")
-            counselor_response = "I apologize, but I'm having trouble generating a response right now. Please try again in a moment."
-        else:
-            counselor_response = answer_response.text.strip()
-            print(f"✓ ANSWER generated successfully ({len(counselor_response)} chars)")
-        
-        # Update conversation history (only with the final answer, not the thinking)
-        conversations[request.session_id].append(f"User: {request.message}")
-        conversations[request.session_id].append(f"Counselor: {counselor_response}")
-        
-        # Keep only last 10 exchanges to avoid token limits
-        if len(conversations[request.session_id]) > 20:
-            conversations[request.session_id] = conversations[request.session_id][-20:]
-        
-        # Return only the ANSWER (PLAN was used internally to generate better response)
         return {
-            "task": "ANSWER",
-            "prompt": counselor_response,
-            "session_id": request.session_id
+            "task": "SAFETY",
+            "prompt": safety_reply("/chat", request),
+            "session_id": request.session_id,
+            "pipeline": mode,
+            "follow_up": request.request_id,
         }
-        
+    turn = await start_turn(
+        ("chat", request.session_id, request.request_id), request, http_request,
+        lambda turn: answer_turn(request, mode, turn),
+    )
+    try:
+        return await wait_for_turn(turn, http_request)
+    except Exception as e:
+        raise upstream_http_error(e)
+
+@app.post("/chat/follow_up")
+async def chat_follow_up(request: FollowUpRequest, http_request: Request):
+    """
+    The counselor's reply to a message that /chat answered with a safety
+    response ("task": "SAFETY"), by the "follow_up" id it returned. Waits
+    for the reply if it is still being generated. If generating it failed,
+    the error /chat would have returned (429, 503, 504, ...) is returned.
+    """
+    turn = turns.find(("chat", request.session_id, request.request_id))
+    if turn is None:
+        raise HTTPException(status_code=404, detail="No reply pending for this request")
+    try:
+        return await wait_for_turn(turn, http_request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise upstream_http_error(e)
+
+def sse_event(payload):
+    """Format a payload as a single Server-Sent Events message."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+async def stream_turn(request, mode, turn):
+    """Run one /chat/stream turn under the session lock, publishing SSE events."""
+    Deadline.start(upstream.default_deadline)
+    trace = RequestTrace("/chat/stream", logger, pipeline=mode, session_id=request.session_id)
+    usage = new_usage()
+    chunks = []
+    queued = time.perf_counter()
+    try:
+        async with session_locks.hold(request.session_id):
+            trace.add_stage("session_queue", time.perf_counter() - queued)
+            start = time.perf_counter()
+            try:
+                conversation_history = await assemble_context(trace, request)
+
+                async for text in stream_pipeline(mode, conversation_history, request.message, usage):
+                    # Drop leading whitespace so the bubble doesn't start blank
+                    if not chunks:
+                        text = text.lstrip()
+                        if not text:
+                            continue
+                    chunks.append(text)
+                    turn.publish(sse_event({"type": "token", "text": text}))
+
+                counselor_response = "".join(chunks).strip()
+                status = "ok"
+                if not counselor_response:
+                    counselor_response = FALLBACK_RESPONSE
+                    status = "fallback"
+                    turn.publish(sse_event({"type": "token", "text": counselor_response}))
+
+                await commit_exchange(request.session_id, request.message, counselor_response)
+                pipeline_metrics.record(mode, time.perf_counter() - start, usage)
+                trace.set(answer_chars=len(counselor_response))
+                trace.finish(status)
+                turn.publish(sse_event({"type": "done", "session_id": request.session_id, "pipeline": mode}))
+                return counselor_response
+
+            except Exception as e:
+                pipeline_metrics.record(mode, time.perf_counter() - start, usage, error=True)
+                trace.finish("error", e)
+                error = upstream_http_error(e)
+                turn.publish(sse_event({"type": "error", "status": error.status_code, "detail": error.detail}))
+                raise
+    except asyncio.CancelledError:
+        reason = turn.cancel_reason or "shutdown"
+        record_cancellation(trace, mode, usage, reason, streamed="".join(chunks))
+        turn.publish(sse_event({"type": "cancelled", "reason": reason}))
+        raise
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """
+    Same pipeline as /chat, but the answer is streamed to the browser as
+    Server-Sent Events. Each event is a JSON object with a "type" of "token",
+    "done", "error" or "cancelled". A message caught by the crisis fast path
+    gets a "safety" event with the helpline response first, before admission
+    and the model. History is only committed once the stream has completed.
+    A duplicate submission of the same request_id replays the same stream.
+    When the browser disconnects, StreamingResponse stops iterating the
+    events, and a turn no other request follows is cancelled mid-stream.
+    """
+    if not request.message:
+        raise HTTPException(status_code=400, detail="No message provided")
+    mode = resolve_pipeline(request.pipeline)
+    def start():
+        return start_turn(
+            ("stream", request.session_id, request.request_id), request, http_request,
+            lambda turn: stream_turn(request, mode, turn),
+        )
+
+    if CRISIS_FAST_PATH and match_crisis(request.message):
+        events = safety_stream(request, start)
+    else:
+        events = (await start()).follow()
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def safety_stream(request, start):
+    """A "safety" event first, then the turn's own events once it is admitted."""
+    yield sse_event({"type": "safety", "text": safety_reply("/chat/stream", request)})
+    try:
+        turn = await start()
+    except HTTPException as e:
+        yield sse_event({"type": "error", "status": e.status_code, "detail": e.detail})
+        return
+    async for event in turn.follow():
+        yield event
+
+# Startup warm-up, run in the background by lifespan() so the port opens
+# immediately. With WARMUP=1 (default) a models.get call also opens the
+# upstream connection (TLS handshake included) before the first user's turn.
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") != "0"
+startup_task = None
+warmup_state = {"seconds": None, "upstream": None, "error": None}
+
+async def warm_up():
+    started = time.perf_counter()
+    try:
+        active = await model_client()
+        if FEW_SHOT_K > 0:
+            await asyncio.to_thread(get_few_shot_index)
+        if WARMUP_ENABLED:
+            try:
+                await asyncio.wait_for(active.aio.models.get(model=MODEL_NAME),
+                                       upstream.attempt_timeout)
+                warmup_state["upstream"] = "ok"
+            except Exception as e:
+                # Not fatal: turns still retry and fall back as usual
+                warmup_state["upstream"] = f"{type(e).__name__}: {e}"
+                log_event(logger, "warmup_upstream_failed", logging.WARNING,
+                          error_class=type(e).__name__, error=str(e))
+        await prompt_cache.start()
+    except Exception as e:
+        warmup_state["error"] = f"{type(e).__name__}: {e}"
+        log_event(logger, "warmup_failed", logging.ERROR,
+                  error_class=type(e).__name__, error=str(e))
+    warmup_state["seconds"] = round(time.perf_counter() - started, 3)
+    log_event(logger, "warmup_done", **warmup_state)
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the model client exists and the startup warm-up has finished."""
+    if startup_task is not None and not startup_task.done():
+        return JSONResponse({"status": "starting"}, status_code=503)
+    try:
+        await model_client()
     except Exception as e:
-        # Print full traceback for debugging
-        print("\n" + "="*60)
-        print("ERROR in /chat endpoint:")
-        print("="*60)
-        traceback.print_exc()
-        print("="*60 + "\n")
-        raise HTTPException(status_code=500, detail=str(e))
+        # e.g. GOOGLE_API_KEY missing; retried on every probe
+        body = {"status": "unavailable", "error": f"{type(e).__name__}: {e}"}
+        return JSONResponse(body, status_code=503)
+    return {"status": "ready", "warmup": warmup_state}
+
+@app.get("/stats")
+async def stats():
+    """Runtime counters for verifying cost and latency optimizations."""
+    return {
+        "prompt_cache": prompt_cache.stats(),
+        "pipelines": pipeline_metrics.stats(),
+        "sessions": sessions.stats(),
+        "turns": {**turns.stats(), "locked_sessions": len(session_locks)},
+        "cancellation_saved_tokens": {
+            endpoint: SAVED_TOKENS.value(endpoint=endpoint) for endpoint in ("/chat", "/chat/stream")
+        },
+        "static_assets": static_assets.stats(),
+        "upstream": upstream.stats(),
+        "admission": admission.stats(),
+        "output_budgets": {
+            "plan": PLAN_BUDGET.stats(),
+            "answer": ANSWER_BUDGET.stats(),
+            "fused": FUSED_BUDGET.stats(),
+            "thinking": THINKING_ANSWER_BUDGET.stats(),
+            "summary": SUMMARY_BUDGET.stats(),
+        },
+    }
+
+register_collector("counselor_prompt_cache", "Prompt cache counter", prompt_cache.stats)
+register_collector("counselor_admission", "Admission control", admission.stats)
+register_collector("counselor_upstream", "Upstream resilience counter", upstream.stats)
+register_collector("counselor_session_store", "Session store counter", sessions.stats)
+register_collector(
+    "counselor_turns", "Turn coordination counter",
+    lambda: {**turns.stats(), "locked_sessions": len(session_locks)},
+)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: request and stage latencies, token usage, errors and /stats counters."""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/cancel")
+async def cancel(request: CancelRequest):
+    """
+    Stop the session's turn for `request_id` (every turn of the session
+    without one) and its upstream calls, e.g. when the browser supersedes or
+    aborts a request. Requests following the turn get 409 or a "cancelled" event.
+    """
+    cancelled = turns.cancel(request.session_id, request.request_id, reason="cancelled")
+    return {"cancelled": cancelled}
 
 @app.post("/reset")
 async def reset(request: ResetRequest):
-    if request.session_id in conversations:
-        del conversations[request.session_id]
+    # Turns in flight would otherwise append to the history deleted here
+    turns.cancel(request.session_id, reason="reset")
+    await session_call(sessions.delete, request.session_id)
     return {"message": "Conversation reset"}
 
 if __name__ == "__main__":
+    # A single development server; use serve.py for several workers
     import uvicorn
-   # port = int(os.environ.get("PORT", 8000))
-    port=8000
+    port = int(os.environ.get("PORT", 8000))
     print("\n" + "="*60)
     print("AI Counselor Web Server Starting...")
     print("="*60)
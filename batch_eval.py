@@ -0,0 +1,181 @@
+"""
+Batch evaluation of counselor scenarios from a JSONL file.
+
+Each input line is one scenario, either a single message or a multi-turn
+conversation:
+
+    {"id": "anxiety-1", "message": "I can't sleep before exams"}
+    {"id": "grief-2", "turns": ["My dog died", "I keep expecting him at the door"],
+     "pipeline": "fused"}
+
+Scenarios run concurrently through the same pipeline as app.py (history,
+few-shot retrieval, PLAN/ANSWER or the selected pipeline mode, retries and
+fallbacks). One JSON line per finished scenario is appended to the output
+file as soon as it completes, with the answers, per-turn latency and token
+usage. Re-running with the same output file skips scenarios already
+recorded with status "ok", so an interrupted run resumes where it stopped;
+failed scenarios are run again and the last line for an id wins.
+
+Usage:
+    python batch_eval.py eval_scenarios.jsonl -o results.jsonl --concurrency 8
+    python batch_eval.py eval_scenarios.jsonl -o results.jsonl --fake
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from resilience import Deadline
+
+
+def read_scenarios(path):
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            scenario = json.loads(line)
+            scenario.setdefault("id", f"line-{number}")
+            if "turns" not in scenario:
+                if "message" not in scenario:
+                    raise ValueError(f"{path}:{number}: scenario needs 'message' or 'turns'")
+                scenario["turns"] = [scenario["message"]]
+            yield scenario
+
+
+def completed_ids(path):
+    """Ids recorded with status "ok" in an existing output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # line cut short by an interrupted run
+            if record.get("status") == "ok":
+                done.add(record["id"])
+            else:
+                done.discard(record.get("id"))
+    return done
+
+
+def open_output(path):
+    """Open for appending, first terminating a line cut short by an interrupted run."""
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            partial = f.read(1) != b"\n"
+        if partial:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("\n")
+    return open(path, "a", encoding="utf-8")
+
+
+async def run_scenario(app, scenario, default_pipeline):
+    """Run every turn of a scenario in its own session and return the result record."""
+    mode = scenario.get("pipeline") or default_pipeline
+    session_id = f"batch:{scenario['id']}"
+    await app.session_call(app.sessions.delete, session_id)  # leftovers from an interrupted run
+    record = {"id": scenario["id"], "pipeline": mode, "status": "ok", "turns": []}
+    started = time.perf_counter()
+    totals = app.new_usage()
+    try:
+        if mode not in app.PIPELINE_MODES:
+            raise ValueError(f"unknown pipeline '{mode}'")
+        for message in scenario["turns"]:
+            Deadline.start(app.upstream.default_deadline)
+            usage = app.new_usage()
+            turn_started = time.perf_counter()
+            context = app.prompt_context((await app.get_history(session_id)).render(), message)
+            answer = await app.run_pipeline(mode, context, message, usage)
+            fallback = answer is None
+            if fallback:
+                answer = app.FALLBACK_RESPONSE
+            await app.commit_exchange(session_id, message, answer)
+            record["turns"].append({
+                "user": message,
+                "answer": answer,
+                "fallback": fallback,
+                "latency_seconds": round(time.perf_counter() - turn_started, 3),
+                "usage": usage,
+            })
+            for key, value in usage.items():
+                totals[key] += value
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        await app.session_call(app.sessions.delete, session_id)
+    record["latency_seconds"] = round(time.perf_counter() - started, 3)
+    record["usage"] = totals
+    return record
+
+
+async def run(args):
+    import app
+
+    done = completed_ids(args.output)
+    pending = (s for s in read_scenarios(args.scenarios) if s["id"] not in done)
+    results = {"ok": 0, "error": 0}
+    turn_latencies = []
+    tokens = app.new_usage()
+
+    await app.prompt_cache.start()
+    started = time.perf_counter()
+    with open_output(args.output) as output:
+        async def worker():
+            # Workers pull scenarios lazily, so huge files aren't loaded at once
+            for scenario in pending:
+                record = await run_scenario(app, scenario, args.pipeline)
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                results[record["status"]] += 1
+                turn_latencies.extend(t["latency_seconds"] for t in record["turns"])
+                for key, value in record["usage"].items():
+                    tokens[key] += value
+                if record["status"] == "error":
+                    print(f"{record['id']}: {record['error']}", file=sys.stderr)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        await asyncio.gather(*app.background_tasks)
+    await app.prompt_cache.stop()
+    elapsed = time.perf_counter() - started
+
+    print(f"scenarios: {results['ok']} ok, {results['error']} failed, "
+          f"{len(done)} skipped (already completed) in {elapsed:.1f}s")
+    if turn_latencies:
+        ordered = sorted(turn_latencies)
+        print(f"turn latency p50/p95: {ordered[len(ordered) // 2]:.2f}s / "
+              f"{ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]:.2f}s "
+              f"over {len(ordered)} turns")
+    print(f"tokens: {tokens['prompt_tokens']} prompt ({tokens['cached_tokens']} cached), "
+          f"{tokens['output_tokens']} output, {tokens['thinking_tokens']} thinking, "
+          f"{tokens['upstream_calls']} upstream calls")
+    print(f"results: {args.output}")
+    return 1 if results["error"] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", help="input JSONL file")
+    parser.add_argument("-o", "--output", default="eval_results.jsonl",
+                        help="output JSONL file, appended to and used to resume")
+    parser.add_argument("--concurrency", type=int, default=8, help="scenarios in flight at once")
+    parser.add_argument("--pipeline", default=None,
+                        help="pipeline for scenarios that don't name one (default: PIPELINE_MODE)")
+    parser.add_argument("--fake", action="store_true",
+                        help="use the offline fake Gemini backend (FAKE_* variables apply)")
+    args = parser.parse_args()
+    if args.fake:
+        os.environ["GEMINI_BACKEND"] = "fake"
+    if args.pipeline is None:
+        args.pipeline = os.environ.get("PIPELINE_MODE", "two_stage")
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark and phrase check for the local crisis matcher (crisis.py).
+
+First checks the matcher against labelled messages: every message in
+SHOULD_MATCH must be recognised and none in SHOULD_NOT_MATCH. Then measures
+throughput over a large synthetic message volume, comparing the single
+precompiled alternation in crisis.py with trying each phrase as its own
+compiled regex. Runs fully offline.
+
+Usage:
+    python bench_crisis.py [messages]
+"""
+import random
+import re
+import sys
+import time
+
+from crisis import CRISIS_PATTERN, CRISIS_PHRASES, _compile, match_crisis
+from few_shot import EXAMPLES
+
+SHOULD_MATCH = [
+    "I don't see the point anymore. Nothing makes me happy.",
+    "i dont see the point anymore",
+    "I want to kill myself",
+    "Sometimes I think about ending it all",
+    "I've been having suicidal thoughts again",
+    "I keep thinking everyone would be better off without me",
+    "I don't want to wake up tomorrow",
+    "I can’t go on like this",
+    "I cannot go on",
+    "I've been cutting myself again",
+    "I took an overdose last year and I'm scared I'll do it again",
+    "honestly I just want to die",
+    "I wish I was never born",
+    "my life isn't worth living",
+    "there's no reason to live anymore",
+    "I'm thinking of taking my own life",
+    "I started self-harming in college",
+]
+
+SHOULD_NOT_MATCH = [
+    "I've been feeling really anxious lately and can't sleep well",
+    "I don't see the point of this meeting",
+    "My boss keeps piling on work and I'm burned out",
+    "I had a panic attack on the train yesterday",
+    "I'm dying to see my friends again",
+    "That movie killed me, I laughed so hard",
+    "I want to end my relationship but I'm scared",
+    "I can't go out tonight",
+    "My grandma died last month and I can't stop crying",
+    "I'm going to try to get more sleep",
+]
+
+
+def check_phrases():
+    missed = [m for m in SHOULD_MATCH if match_crisis(m) is None]
+    flagged = [(m, match_crisis(m)) for m in SHOULD_NOT_MATCH if match_crisis(m) is not None]
+    assert not missed, f"not recognised: {missed}"
+    assert not flagged, f"false positives: {flagged}"
+    print(f"phrase check: {len(SHOULD_MATCH)} crisis and {len(SHOULD_NOT_MATCH)} "
+          f"other messages classified correctly")
+
+
+def messages(count, crisis_share=0.01):
+    """A mix of everyday messages with a small share of crisis messages."""
+    rng = random.Random(0)
+    ordinary = SHOULD_NOT_MATCH + [e["user"] for e in EXAMPLES if match_crisis(e["user"]) is None]
+    # Longer messages as well: several sentences run together
+    ordinary += [" ".join(rng.sample(ordinary, 4)) for _ in range(50)]
+    return [rng.choice(SHOULD_MATCH) if rng.random() < crisis_share else rng.choice(ordinary)
+            for _ in range(count)]
+
+
+def throughput(name, matcher, batch):
+    start = time.perf_counter()
+    hits = sum(1 for message in batch if matcher(message))
+    elapsed = time.perf_counter() - start
+    megabytes = sum(len(m) for m in batch) / 1e6
+    print(f"{name:<22} {len(batch) / elapsed:>12,.0f} messages/s  {megabytes / elapsed:7.1f} MB/s  "
+          f"{elapsed / len(batch) * 1e6:6.2f} us/message  ({hits} matches)")
+    return hits
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    check_phrases()
+
+    re.purge()  # time a real compile, not a hit in re's pattern cache
+    start = time.perf_counter()
+    _compile(CRISIS_PHRASES)
+    print(f"compile: {(time.perf_counter() - start) * 1000:.2f} ms for {len(CRISIS_PHRASES)} phrases "
+          f"({len(CRISIS_PATTERN.pattern)} chars of regex)")
+
+    batch = messages(count)
+    separate = [_compile([phrase]) for phrase in CRISIS_PHRASES]
+    combined = throughput("single alternation", match_crisis, batch)
+    one_by_one = throughput("phrase by phrase",
+                            lambda m: any(p.search(m.lower()) for p in separate), batch)
+    assert combined == one_by_one, (combined, one_by_one)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark for retrieval-based few-shot selection.
+
+Compares the input size of PLAN/ANSWER prompts when all few-shot examples are
+sent against sending only the top-k retrieved ones, and measures the local
+cost of building the index and selecting examples. Runs fully offline.
+
+With FEW_SHOT_K=0 the system prompt and all examples form the cached prompt
+prefix, billed at CACHED_TOKEN_PRICE of the normal input price. Retrieval
+leaves too small a static part to cache, so the top-k prompt is billed in
+full; the last lines compare the two in billed input tokens per call.
+
+Token counts use the same ~4 chars/token estimate as history.py; the
+upstream side of the latency change (less prefill per call) shows up in the
+per-pipeline latencies on GET /stats when running against the real API.
+
+Usage:
+    python bench_few_shot.py [k] [cached_token_price]
+"""
+import sys
+import time
+
+from app import SYSTEM_PROMPT
+from few_shot import EXAMPLES, FEW_SHOT_EXAMPLES, FewShotIndex, render_examples
+from history import estimate_tokens
+
+# Price of a cached input token relative to an uncached one (Gemini 2.5)
+CACHED_TOKEN_PRICE = 0.25
+
+MESSAGES = [
+    "I've been feeling really anxious lately and can't sleep well",
+    "I feel like nobody understands what I'm going through",
+    "I'm having trouble getting out of bed in the morning",
+    "I had a panic attack on the train and now I'm scared to ride it",
+    "My boyfriend and I argue every night about money",
+    "My grandma died last month and I can't stop crying",
+    "I hate how I look in photos",
+    "I can't concentrate on studying for my exams",
+    "My boss keeps piling on work and I'm burned out",
+    "I canceled on my friends again because I was scared they'd judge me",
+]
+
+
+def main():
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    cached_price = float(sys.argv[2]) if len(sys.argv) > 2 else CACHED_TOKEN_PRICE
+
+    start = time.perf_counter()
+    index = FewShotIndex(EXAMPLES)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    all_tokens = estimate_tokens(FEW_SHOT_EXAMPLES)
+    selected_tokens = []
+    print(f"{'message':<70} selected topics")
+    for message in MESSAGES:
+        selected = index.select(message, k)
+        selected_tokens.append(estimate_tokens(render_examples(selected)))
+        print(f"{message[:68]:<70} {', '.join(e['topic'] for e in selected)}")
+
+    rounds = 2000
+    start = time.perf_counter()
+    for i in range(rounds):
+        index.select(MESSAGES[i % len(MESSAGES)], k)
+    select_us = (time.perf_counter() - start) / rounds * 1e6
+
+    average = sum(selected_tokens) / len(selected_tokens)
+    print()
+    print(f"index build:            {build_ms:.2f} ms ({len(EXAMPLES)} examples, "
+          f"{len(index.term_ids)} terms)")
+    print(f"selection latency:      {select_us:.1f} us per message")
+    print(f"{f'examples, all {len(EXAMPLES)}:':<24}~{all_tokens} tokens per call")
+    print(f"{f'examples, top {k}:':<24}~{average:.0f} tokens per call")
+    print(f"input-token reduction:  ~{all_tokens - average:.0f} tokens per call, "
+          f"~{2 * (all_tokens - average):.0f} per two-stage turn "
+          f"({(1 - average / all_tokens) * 100:.0f}%)")
+
+    system_tokens = estimate_tokens(SYSTEM_PROMPT)
+    cached_prefix = system_tokens + all_tokens
+    cached_billed = cached_prefix * cached_price
+    retrieved_billed = system_tokens + average
+    print(f"{'billed, k=0 cached:':<24}~{cached_billed:.0f} tokens per call "
+          f"({cached_prefix} cached at {cached_price:g}x)")
+    print(f"{f'billed, top {k} uncached:':<24}~{retrieved_billed:.0f} tokens per call "
+          f"({retrieved_billed / cached_billed:.2f}x the cached baseline)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Cold-start benchmark for the FastAPI app against the offline fake Gemini
+backend.
+
+Each run starts a fresh server process (uvicorn on a free local port) and
+measures, from process launch:
+
+- import: time to `import app` in a fresh interpreter
+- live: first 200 from GET /healthz (the port is open and serving)
+- ready: first 200 from GET /readyz (client built, warm-up finished)
+- first chat / second chat: latency of the first two POST /chat requests,
+  sent as soon as the server is live, while /readyz is polled alongside
+
+A gap between the first and second chat latency is cold-start cost paid by
+the first user; with --wait-ready the chats are only sent after /readyz, as
+behind a load balancer that gates traffic on readiness, and it should vanish. The fake upstream defaults to a fixed 200 ms per call with
+instant generation here (FAKE_* variables override that); set WARMUP=0 to
+compare against a start without the upstream warm-up call.
+
+Usage:
+    python bench_startup.py --runs 5
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_env():
+    env = dict(os.environ)
+    env.setdefault("GEMINI_BACKEND", "fake")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env.setdefault("FAKE_LATENCY_MS", "200")
+    env.setdefault("FAKE_LATENCY_DIST", "fixed")
+    env.setdefault("FAKE_TOKENS_PER_SECOND", "0")
+    return env
+
+
+def import_seconds():
+    """`import app` in a fresh interpreter, as the server process pays it."""
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=HERE, env=server_env(),
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def wait_for(http, path, started, timeout):
+    while time.perf_counter() - started < timeout:
+        try:
+            if http.get(path).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"{path} not OK after {timeout}s")
+
+
+def chat_seconds(http, session_id):
+    started = time.perf_counter()
+    response = http.post("/chat", json={"message": "I can't sleep before exams",
+                                        "session_id": session_id})
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+def cold_start(timeout, wait_ready):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=HERE, env=server_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60) as http, \
+                ThreadPoolExecutor(1) as executor:
+            live = wait_for(http, "/healthz", started, timeout)
+            ready = executor.submit(wait_for, http, "/readyz", started, timeout)
+            if wait_ready:
+                ready.result()
+            first = chat_seconds(http, "cold-1")
+            second = chat_seconds(http, "cold-2")
+            ready = ready.result()
+    finally:
+        server.terminate()
+        server.wait()
+    return {"live": live, "ready": ready, "first chat": first, "second chat": second}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="server starts to measure")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a server")
+    parser.add_argument("--wait-ready", action="store_true",
+                        help="send the first chats only once /readyz reports ready")
+    args = parser.parse_args()
+
+    results = {"import": [import_seconds() for _ in range(args.runs)]}
+    for _ in range(args.runs):
+        for name, value in cold_start(args.timeout, args.wait_ready).items():
+            results.setdefault(name, []).append(value)
+
+    print(f"cold start over {args.runs} runs (backend {server_env()['GEMINI_BACKEND']}, "
+          f"WARMUP={os.environ.get('WARMUP', '1')}"
+          f"{', chats after ready' if args.wait_ready else ''}), median / max:")
+    for name, values in results.items():
+        print(f"  {name:<12} {statistics.median(values) * 1000:7.0f} ms / {max(values) * 1000:7.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Throughput benchmark for serve.py: one worker against several, with the
+offline fake Gemini backend.
+
+For each worker count a fresh `python serve.py --workers N` is started on a
+free local port. Once /readyz reports ready, client processes keep
+`--concurrency` /chat requests in flight for `--duration` seconds, each
+client task running a series of short multi-turn sessions. Reported per
+worker count: completed requests per second, latency percentiles, and
+sessions whose requests were answered by more than one worker (which must
+be 0: see the X-Worker header set by serve.py).
+
+The fake upstream answers in a fixed --latency-ms with instant generation,
+so at high concurrency the server's own CPU time is the limit and more
+workers should raise throughput, up to the number of CPUs. With one worker,
+serve.py runs app.py directly; with more, the numbers include the
+dispatcher's forwarding.
+
+Usage:
+    python bench_workers.py --workers 1 4 --duration 20
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+from serve import cpu_count
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Turns per simulated session before a client task starts a new one
+TURNS_PER_SESSION = 4
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_env(latency_ms):
+    env = dict(os.environ)
+    env.setdefault("GEMINI_BACKEND", "fake")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env["FAKE_LATENCY_MS"] = str(latency_ms)
+    env.setdefault("FAKE_LATENCY_DIST", "fixed")
+    env.setdefault("FAKE_TOKENS_PER_SECOND", "0")
+    # Every request comes from one address and few sessions; keep the
+    # per-client limits out of the way
+    env.setdefault("RATE_LIMIT_IP_PER_MINUTE", "0")
+    env.setdefault("RATE_LIMIT_SESSION_PER_MINUTE", "0")
+    env.setdefault("MAX_CONCURRENT_UPSTREAM", "1000")
+    return env
+
+
+def wait_ready(base_url, timeout):
+    started = time.perf_counter()
+    with httpx.Client(base_url=base_url) as http:
+        while time.perf_counter() - started < timeout:
+            try:
+                if http.get("/readyz").status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            time.sleep(0.05)
+    raise TimeoutError(f"server not ready after {timeout}s")
+
+
+async def client_load(base_url, name, concurrency, duration):
+    """Latencies of completed requests, failures, and the workers each session was sent to."""
+    latencies, failures, workers = [], 0, {}
+    deadline = time.perf_counter() + duration
+
+    async def session_loop(http, task):
+        nonlocal failures
+        for number in range(sys.maxsize):
+            session_id = f"{name}-{task}-{number}"
+            for turn in range(TURNS_PER_SESSION):
+                if time.perf_counter() >= deadline:
+                    return
+                started = time.perf_counter()
+                try:
+                    response = await http.post("/chat", json={
+                        "message": f"Turn {turn}: I can't sleep before exams", "session_id": session_id,
+                    }, headers={"X-Session-Id": session_id})
+                except httpx.TransportError:
+                    failures += 1
+                    continue
+                if response.status_code != 200:
+                    failures += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                workers.setdefault(session_id, set()).add(response.headers.get("x-worker", "-"))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as http:
+        await asyncio.gather(*(session_loop(http, task) for task in range(concurrency)))
+    return latencies, failures, workers
+
+
+def run_client(base_url, name, concurrency, duration):
+    return asyncio.run(client_load(base_url, name, concurrency, duration))
+
+
+def measure(workers, args):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+        cwd=HERE, env=server_env(args.latency_ms), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(base_url, args.timeout)
+        per_client = max(args.concurrency // args.clients, 1)
+        with ProcessPoolExecutor(args.clients) as executor:
+            results = list(executor.map(
+                run_client, [base_url] * args.clients, [f"w{workers}c{i}" for i in range(args.clients)],
+                [per_client] * args.clients, [args.duration] * args.clients,
+            ))
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    failures = sum(result[1] for result in results)
+    split = sum(1 for result in results for seen in result[2].values() if len(seen) > 1)
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests/s": len(latencies) / args.duration,
+        "p50 ms": quantiles[49] * 1000,
+        "p99 ms": quantiles[98] * 1000,
+        "failures": failures,
+        "split sessions": split,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, cpu_count()}),
+                        help="worker counts to compare")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight")
+    parser.add_argument("--clients", type=int, default=2, help="load-generating processes")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of load per worker count")
+    parser.add_argument("--latency-ms", type=float, default=20, help="fake upstream round trip")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for readiness")
+    args = parser.parse_args()
+
+    print(f"{cpu_count()} CPUs, {args.concurrency} requests in flight from {args.clients} "
+          f"client processes, fake upstream {args.latency_ms:.0f} ms per call")
+    baseline = None
+    for workers in args.workers:
+        result = measure(workers, args)
+        baseline = baseline or result["requests/s"]
+        print(f"  {workers:>2} worker{'s' if workers > 1 else ' '}  "
+              f"{result['requests/s']:8.1f} requests/s ({result['requests/s'] / baseline:4.2f}x)  "
+              f"p50 {result['p50 ms']:7.1f} ms  p99 {result['p99 ms']:7.1f} ms  "
+              f"failures {result['failures']}  split sessions {result['split sessions']}")
+        assert result["split sessions"] == 0, "a session was served by more than one worker"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Latency/throughput benchmark for the FastAPI app against the offline fake
+Gemini backend.
+
+Drives /chat in-process (httpx ASGI transport, no sockets) with many
+concurrent multi-turn sessions and reports latency percentiles, throughput
+and memory held per session. Upstream behaviour comes from the FAKE_*
+environment variables or the flags below. Runs with no network; use
+--latency-ms 0 to measure the server's own overhead.
+
+Usage:
+    python benchmark.py --sessions 200 --turns 3 --concurrency 50
+"""
+import argparse
+import asyncio
+import gc
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+# All simulated sessions share one client address; keep the per-client rate
+# limits out of the way (the global admission queue still applies)
+os.environ.setdefault("RATE_LIMIT_IP_PER_MINUTE", "0")
+os.environ.setdefault("RATE_LIMIT_SESSION_PER_MINUTE", "0")
+
+import httpx
+
+import app as counselor_app
+from fake_gemini import FakeGeminiClient
+
+MESSAGES = [
+    "I've been feeling really anxious lately and can't sleep well",
+    "I feel like nobody understands what I'm going through",
+    "I'm having trouble getting out of bed in the morning",
+    "My boss keeps piling on work and I'm burned out",
+    "I had a panic attack on the train yesterday",
+]
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(args):
+    fake = FakeGeminiClient(
+        latency_ms=args.latency_ms,
+        latency_dist=args.latency_dist,
+        tokens_per_second=args.tokens_per_second,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    counselor_app.set_client(fake)
+
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=counselor_app.app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 timeout=None) as http:
+        async def session(number):
+            nonlocal errors
+            async with semaphore:
+                for turn in range(args.turns):
+                    start = time.perf_counter()
+                    response = await http.post("/chat", json={
+                        "message": MESSAGES[(number + turn) % len(MESSAGES)],
+                        "session_id": f"bench_{number}",
+                        "pipeline": args.pipeline,
+                    })
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        errors += 1
+
+        gc.collect()
+        if args.trace_memory:
+            tracemalloc.start()
+            memory_before = tracemalloc.take_snapshot()
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        await asyncio.gather(*(session(i) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*counselor_app.background_tasks)
+        rss_growth = peak_rss() - rss_before
+        if args.trace_memory:
+            gc.collect()
+            memory_after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            held = sum(s.size_diff for s in memory_after.compare_to(memory_before, "filename"))
+
+    requests = len(latencies)
+    calls = fake.calls["generate_content"] + fake.calls["generate_content_stream"]
+    store = counselor_app.sessions.stats()
+    admission = counselor_app.admission.stats()
+
+    print(f"sessions x turns:     {args.sessions} x {args.turns} "
+          f"(concurrency {args.concurrency}, pipeline {args.pipeline})")
+    print(f"fake upstream:        {args.latency_ms:.0f} ms {args.latency_dist}, "
+          f"{args.tokens_per_second:g} tok/s, failure rate {args.failure_rate:g}")
+    print(f"requests:             {requests} ({errors} errors) in {elapsed:.2f}s")
+    print(f"throughput:           {requests / elapsed:.1f} req/s")
+    print(f"latency p50/p95/p99:  {percentile(latencies, 0.50) * 1000:.0f} / "
+          f"{percentile(latencies, 0.95) * 1000:.0f} / "
+          f"{percentile(latencies, 0.99) * 1000:.0f} ms "
+          f"(mean {statistics.mean(latencies) * 1000:.0f} ms)")
+    print(f"upstream per request: {calls / requests:.2f} calls, "
+          f"{fake.upstream_seconds / requests * 1000:.0f} ms simulated")
+    print(f"memory per session:   {store['bytes'] / max(store['sessions'], 1) / 1024:.1f} KiB "
+          f"of history in the store, {rss_growth / args.sessions / 1024:.1f} KiB peak RSS growth")
+    print(f"admission queue:      {admission['queued']} queued, avg wait "
+          f"{admission['avg_wait_seconds'] * 1000:.0f} ms, "
+          f"{admission['rejected_queue_full'] + admission['rejected_queue_timeout']} rejected "
+          f"(max {admission['max_active']} active turns)")
+    if args.trace_memory:
+        print(f"python heap held:     {held / args.sessions / 1024:.1f} KiB per session (tracemalloc)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="sessions in flight at once")
+    parser.add_argument("--pipeline", default=counselor_app.DEFAULT_PIPELINE,
+                        choices=counselor_app.PIPELINE_MODES)
+    parser.add_argument("--latency-ms", type=float,
+                        default=float(os.environ.get("FAKE_LATENCY_MS", "800")))
+    parser.add_argument("--latency-dist", default=os.environ.get("FAKE_LATENCY_DIST", "lognormal"))
+    parser.add_argument("--tokens-per-second", type=float,
+                        default=float(os.environ.get("FAKE_TOKENS_PER_SECOND", "200")))
+    parser.add_argument("--failure-rate", type=float,
+                        default=float(os.environ.get("FAKE_FAILURE_RATE", "0")))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure Python heap per session with tracemalloc (slows the run)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Output-token budgets per model call stage, and handling of truncated output.
+
+On gemini-2.5 models the internal thinking tokens count against
+max_output_tokens. A stage capped at 512 tokens with dynamic thinking can
+spend the whole cap thinking and come back with finish_reason MAX_TOKENS and
+no text at all, which is paid for and then thrown away. OutputBudget makes
+the split explicit: `max_output_tokens` is the room for visible text and
+`thinking_budget` is added on top of it.
+
+- thinking_budget 0 turns thinking off. That is the default for stages whose
+  reasoning is already explicit, such as PLAN. Models that can't turn
+  thinking off, such as gemini-2.5-pro, need -1 or at least 128.
+- -1 leaves the amount to the model (dynamic thinking). None omits
+  thinking_config.
+
+When output is still cut off, the stage's `on_truncation` policy applies:
+"continue" asks the model to carry on from where the text stopped,
+"accept" keeps the partial text, and "retry" discards it and repeats the
+call with a larger budget (for structured output, where partial JSON is
+useless). Empty output is always retried with a larger budget, up to
+`max_retry_tokens`. Tokens spent on discarded output are counted as wasted.
+"""
+import os
+
+from metrics import Counter
+
+TRUNCATION_POLICIES = ("continue", "accept", "retry")
+
+TRUNCATIONS = Counter(
+    "counselor_truncations_total",
+    "Model outputs cut off by max_output_tokens, by what was done about it",
+    ("stage", "action"),
+)
+WASTED_TOKENS = Counter(
+    "counselor_wasted_tokens_total",
+    "Tokens paid for in model calls whose output was discarded",
+    ("stage", "kind"),
+)
+
+
+def finish_reason(response):
+    """The finish reason name of a response's first candidate ("STOP", "MAX_TOKENS", ...), or None."""
+    candidates = getattr(response, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", reason)
+
+
+def is_truncated(response):
+    return finish_reason(response) == "MAX_TOKENS"
+
+
+def wasted_tokens(response):
+    """Token counts ({"prompt", "thinking", "output"}) of a response that is being discarded."""
+    metadata = getattr(response, "usage_metadata", None)
+    return {
+        "prompt": getattr(metadata, "prompt_token_count", None) or 0,
+        "thinking": getattr(metadata, "thoughts_token_count", None) or 0,
+        "output": getattr(metadata, "candidates_token_count", None) or 0,
+    }
+
+
+def _optional_int(value):
+    if value is None or value.strip().lower() in ("", "none", "default"):
+        return None
+    return int(value)
+
+
+class OutputBudget:
+    def __init__(self, stage, max_output_tokens, thinking_budget=0, on_truncation="accept",
+                 max_retry_tokens=4096, max_continuations=1):
+        if on_truncation not in TRUNCATION_POLICIES:
+            raise ValueError(f"on_truncation must be one of {TRUNCATION_POLICIES}")
+        self.stage = stage
+        self.max_output_tokens = max_output_tokens
+        self.thinking_budget = thinking_budget
+        self.on_truncation = on_truncation
+        self.max_retry_tokens = max_retry_tokens
+        self.max_continuations = max_continuations
+
+    @classmethod
+    def from_env(cls, stage, max_output_tokens, thinking_budget=0, on_truncation="accept"):
+        """Defaults overridable with <STAGE>_MAX_OUTPUT_TOKENS and <STAGE>_THINKING_BUDGET."""
+        prefix = stage.upper()
+        thinking = os.environ.get(f"{prefix}_THINKING_BUDGET")
+        return cls(
+            stage,
+            max_output_tokens=int(os.environ.get(f"{prefix}_MAX_OUTPUT_TOKENS", str(max_output_tokens))),
+            thinking_budget=thinking_budget if thinking is None else _optional_int(thinking),
+            on_truncation=on_truncation,
+            max_retry_tokens=int(os.environ.get("TRUNCATION_MAX_OUTPUT_TOKENS", "4096")),
+            max_continuations=int(os.environ.get("TRUNCATION_MAX_CONTINUATIONS", "1")),
+        )
+
+    def config(self, max_output_tokens=None):
+        """Generation config entries for this stage: the token cap plus thinking_config."""
+        visible = max_output_tokens or self.max_output_tokens
+        config = {"max_output_tokens": visible + max(self.thinking_budget or 0, 0)}
+        if self.thinking_budget is not None:
+            config["thinking_config"] = {"thinking_budget": self.thinking_budget}
+        return config
+
+    def with_thinking(self, thinking_budget):
+        """The same budget with a different thinking_budget."""
+        return OutputBudget(self.stage, self.max_output_tokens, thinking_budget, self.on_truncation,
+                            self.max_retry_tokens, self.max_continuations)
+
+    def grow(self, max_output_tokens):
+        """The next, larger visible-text budget for a retry, or None past max_retry_tokens."""
+        if max_output_tokens >= self.max_retry_tokens:
+            return None
+        return min(max_output_tokens * 2, self.max_retry_tokens)
+
+    def stats(self):
+        return {
+            "max_output_tokens": self.max_output_tokens,
+            "thinking_budget": self.thinking_budget,
+            "on_truncation": self.on_truncation,
+        }
@@ -0,0 +1,292 @@
+"""
+Offline stand-in for google.genai.Client.
+
+FakeGeminiClient implements the parts of the client surface this project
+uses (models.generate_content, aio.models.generate_content[_stream] and
+aio.caches) and returns real google.genai response types, so the server can
+be exercised and benchmarked without network access or an API key.
+
+Behaviour is configurable:
+
+- latency: time to first token, drawn from a "fixed", "uniform" or
+  "lognormal" distribution around `latency_ms`
+- throughput: output (and thinking) tokens are produced at `tokens_per_second`
+- thinking: `thinking_tokens` are spent before any text and count against
+  max_output_tokens like on gemini-2.5 models (capped by a thinking_budget)
+- failures: each call fails with probability `failure_rate`, and fail_next()
+  queues deterministic failures
+
+Select it in app.py / gemini_demo.py with GEMINI_BACKEND=fake; the FAKE_*
+environment variables map to the constructor arguments (see from_env()).
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from google.genai import errors, types
+
+from few_shot import EXAMPLES
+from history import estimate_tokens
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+def api_error(code, message):
+    """Build the same exception type google-genai raises for an HTTP status."""
+    status = {
+        400: "INVALID_ARGUMENT",
+        403: "PERMISSION_DENIED",
+        404: "NOT_FOUND",
+        429: "RESOURCE_EXHAUSTED",
+        500: "INTERNAL",
+        503: "UNAVAILABLE",
+        504: "DEADLINE_EXCEEDED",
+    }.get(code, "UNKNOWN")
+    body = {"error": {"code": code, "message": message, "status": status}}
+    error_class = errors.ServerError if code >= 500 else errors.ClientError
+    return error_class(code, body)
+
+
+class FakeGeminiClient:
+    def __init__(self, latency_ms=800, latency_dist="lognormal", latency_sigma=0.35,
+                 tokens_per_second=200, thinking_tokens=0, failure_rate=0.0,
+                 failure_code=503, seed=None):
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"latency_dist must be one of {LATENCY_DISTRIBUTIONS}")
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.thinking_tokens = thinking_tokens
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.model_calls = Counter()
+        self.upstream_seconds = 0.0
+        self._queued_failures = []
+        self._caches = {}  # name -> (expires_at, token_count)
+
+        self.models = _SyncModels(self)
+        self.aio = SimpleNamespace(models=_AsyncModels(self), caches=_AsyncCaches(self))
+
+    @classmethod
+    def from_env(cls):
+        seed = os.environ.get("FAKE_SEED")
+        return cls(
+            latency_ms=float(os.environ.get("FAKE_LATENCY_MS", "800")),
+            latency_dist=os.environ.get("FAKE_LATENCY_DIST", "lognormal"),
+            latency_sigma=float(os.environ.get("FAKE_LATENCY_SIGMA", "0.35")),
+            tokens_per_second=float(os.environ.get("FAKE_TOKENS_PER_SECOND", "200")),
+            thinking_tokens=int(os.environ.get("FAKE_THINKING_TOKENS", "0")),
+            failure_rate=float(os.environ.get("FAKE_FAILURE_RATE", "0")),
+            failure_code=int(os.environ.get("FAKE_FAILURE_CODE", "503")),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def fail_next(self, count=1, code=503, message="Injected failure"):
+        """Make the next `count` model calls fail with the given HTTP status."""
+        self._queued_failures.extend([(code, message)] * count)
+
+    def evict_caches(self):
+        """Drop every cached content, as if the upstream had evicted them."""
+        self._caches.clear()
+
+    # Simulation
+
+    def first_token_delay(self):
+        base = self.latency_ms / 1000
+        if self.latency_dist == "fixed":
+            return base
+        if self.latency_dist == "uniform":
+            return base * self.random.uniform(0.5, 1.5)
+        return base * math.exp(self.random.gauss(0, self.latency_sigma))
+
+    def generation_delay(self, tokens):
+        if not self.tokens_per_second or math.isinf(self.tokens_per_second):
+            return 0.0
+        return tokens / self.tokens_per_second
+
+    def check_failure(self):
+        if self._queued_failures:
+            code, message = self._queued_failures.pop(0)
+            raise api_error(code, message)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise api_error(self.failure_code, "Injected random failure")
+
+    def plan_call(self, method, model, contents, config):
+        """Work out the simulated timing and response for one call."""
+        self.calls[method] += 1
+        self.model_calls[model] += 1
+        self.check_failure()
+        config = config or {}
+        if hasattr(config, "model_dump"):
+            config = config.model_dump(exclude_none=True)
+
+        prompt = contents if isinstance(contents, str) else json.dumps(contents, default=str)
+        prompt_tokens = estimate_tokens(prompt)
+        cached_tokens = 0
+        cache_name = config.get("cached_content")
+        if cache_name:
+            cache = self._caches.get(cache_name)
+            if cache is None or cache[0] < time.monotonic():
+                self._caches.pop(cache_name, None)
+                raise api_error(404, f"CachedContent not found (or permission denied): {cache_name}")
+            cached_tokens = cache[1]
+            prompt_tokens += cached_tokens
+
+        max_output_tokens = config.get("max_output_tokens") or 8192
+        thinking_budget = (config.get("thinking_config") or {}).get("thinking_budget")
+        thoughts = self.thinking_tokens
+        if thinking_budget is not None and thinking_budget >= 0:
+            thoughts = min(thoughts, thinking_budget)
+        thoughts = min(thoughts, max_output_tokens)
+
+        text = self.reply_text(prompt, config)
+        visible_budget = max_output_tokens - thoughts
+        finish_reason = types.FinishReason.STOP
+        words = text.split(" ")
+        if estimate_tokens(text) > visible_budget:
+            finish_reason = types.FinishReason.MAX_TOKENS
+            kept = []
+            for word in words:
+                if estimate_tokens(" ".join(kept + [word])) > visible_budget:
+                    break
+                kept.append(word)
+            words = kept
+        text = " ".join(words)
+
+        output_tokens = estimate_tokens(text) if text else 0
+        usage = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens or None,
+            candidates_token_count=output_tokens or None,
+            thoughts_token_count=thoughts or None,
+            total_token_count=prompt_tokens + output_tokens + thoughts,
+        )
+        first_token = self.first_token_delay() + self.generation_delay(thoughts)
+        return SimpleNamespace(
+            words=words if text else [],
+            finish_reason=finish_reason,
+            usage=usage,
+            first_token=first_token,
+            total=first_token + self.generation_delay(output_tokens),
+        )
+
+    def reply_text(self, prompt, config):
+        """Deterministic canned reply matching the kind of prompt."""
+        digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+        example = EXAMPLES[digest % len(EXAMPLES)]
+        if config.get("response_mime_type") == "application/json":
+            return json.dumps({
+                "plan": "\n".join(f"- {line}" for line in example["thought_process"]),
+                "answer": example["counselor"],
+            })
+        if "thought process in a clear, structured way" in prompt:
+            return "\n".join(f"- {line}" for line in example["thought_process"])
+        if "running summary" in prompt:
+            return f"The person has been talking about {example['topic']} and how it affects them."
+        return example["counselor"]
+
+    @staticmethod
+    def response(words, finish_reason, usage):
+        parts = [types.Part(text=" ".join(words))] if words else None
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(
+                content=types.Content(role="model", parts=parts),
+                finish_reason=finish_reason,
+            )],
+            usage_metadata=usage,
+        )
+
+
+class _SyncModels:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def generate_content(self, *, model, contents, config=None):
+        call = self.fake.plan_call("generate_content", model, contents, config)
+        time.sleep(call.total)
+        self.fake.upstream_seconds += call.total
+        return self.fake.response(call.words, call.finish_reason, call.usage)
+
+
+class _AsyncModels:
+    # Words per streamed chunk
+    CHUNK_WORDS = 6
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def generate_content(self, *, model, contents, config=None):
+        call = self.fake.plan_call("generate_content", model, contents, config)
+        await asyncio.sleep(call.total)
+        self.fake.upstream_seconds += call.total
+        return self.fake.response(call.words, call.finish_reason, call.usage)
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        call = self.fake.plan_call("generate_content_stream", model, contents, config)
+        fake = self.fake
+
+        async def chunks():
+            await asyncio.sleep(call.first_token)
+            fake.upstream_seconds += call.first_token
+            words = call.words
+            for start in range(0, max(len(words), 1), self.CHUNK_WORDS):
+                piece = words[start:start + self.CHUNK_WORDS]
+                last = start + self.CHUNK_WORDS >= len(words)
+                if start:
+                    delay = fake.generation_delay(estimate_tokens(" ".join(piece)))
+                    await asyncio.sleep(delay)
+                    fake.upstream_seconds += delay
+                text = " ".join(piece) + ("" if last else " ")
+                yield fake.response(
+                    [text] if piece else [],
+                    call.finish_reason if last else None,
+                    call.usage if last else None,
+                )
+
+        return chunks()
+
+    async def get(self, *, model, config=None):
+        self.fake.calls["models.get"] += 1
+        await asyncio.sleep(self.fake.first_token_delay())
+        return types.Model(name=f"models/{model}")
+
+
+class _AsyncCaches:
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def create(self, *, model, config=None):
+        self.fake.calls["caches.create"] += 1
+        config = config or {}
+        text = (config.get("system_instruction") or "") + "".join(config.get("contents") or [])
+        ttl = float(str(config.get("ttl", "3600s")).rstrip("s"))
+        tokens = estimate_tokens(text)
+        name = f"cachedContents/fake-{self.fake.calls['caches.create']}"
+        self.fake._caches[name] = (time.monotonic() + ttl, tokens)
+        await asyncio.sleep(self.fake.first_token_delay())
+        return types.CachedContent(
+            name=name,
+            model=model,
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens),
+        )
+
+    async def update(self, *, name, config=None):
+        self.fake.calls["caches.update"] += 1
+        if name not in self.fake._caches:
+            raise api_error(404, f"CachedContent not found: {name}")
+        ttl = float(str((config or {}).get("ttl", "3600s")).rstrip("s"))
+        self.fake._caches[name] = (time.monotonic() + ttl, self.fake._caches[name][1])
+        return types.CachedContent(name=name)
+
+    async def delete(self, *, name, config=None):
+        self.fake.calls["caches.delete"] += 1
+        self.fake._caches.pop(name, None)
@@ -0,0 +1,196 @@
+"""
+Few-shot example corpus and an offline retrieval index over it.
+
+Instead of sending every example on every call, the index picks the few
+examples most similar to the user's message. Similarity is TF-IDF cosine over
+word unigrams and bigrams, computed with NumPy from a matrix built once at
+startup, so selection runs locally in microseconds with no network access.
+"""
+import math
+import os
+import re
+from collections import Counter
+
+# Number of examples retrieved per turn; 0 sends the whole corpus every time,
+# as part of the cached prompt prefix (see app.PromptCache)
+FEW_SHOT_K = int(os.environ.get("FEW_SHOT_K", "0"))
+
+EXAMPLES = [
+    {
+        "topic": "work overwhelm",
+        "keywords": "workload job boss deadlines burnout burned out stressed exhausted behind pressure overworked busy coworkers career",
+        "user": "I feel like I'm drowning in work and I can't keep up. Everyone else seems fine but I'm falling apart.",
+        "thought_process": [
+            "Feeling: Overwhelmed, inadequate, isolated",
+            "Underlying issue: Possible burnout, comparison with others, lack of support",
+            "Need: Validation that their feelings are real and normal",
+            "Response approach: Normalize their experience, validate feelings, offer perspective",
+        ],
+        "counselor": "What you're experiencing sounds incredibly overwhelming, and I want you to know that your feelings are completely valid. It's important to remember that what you see of others is often just the surface - many people struggle privately. Feeling like you're 'falling apart' is actually your mind and body telling you that you need support and rest. This isn't a weakness; it's a sign that you're human and that you've been carrying too much. Can you tell me more about what's been weighing on you most?",
+    },
+    {
+        "topic": "hopelessness",
+        "keywords": "depressed depression empty numb pointless hopeless sad worthless unmotivated nothing matters give up living suicidal dark tired sleep bed morning",
+        "user": "I don't see the point anymore. Nothing makes me happy.",
+        "thought_process": [
+            "Feeling: Hopelessness, anhedonia (loss of pleasure), possible depression",
+            "Underlying issue: This could indicate clinical depression - serious concern",
+            "Need: Immediate validation, gentle exploration, professional help recommendation",
+            "Response approach: Take seriously, show care, assess safety, encourage professional support",
+        ],
+        "counselor": "Thank you for sharing something so difficult with me. What you're describing - this feeling of emptiness and loss of joy - is a real symptom that many people with depression experience, and it's not your fault. These feelings can feel permanent, but they're not. I'm concerned about you and I want to help. First, I need to ask: are you having thoughts of hurting yourself? Also, have you been able to talk to a mental health professional? You deserve support from someone who can work with you regularly. In the meantime, I'm here to listen.",
+    },
+    {
+        "topic": "panic",
+        "keywords": "panic attack heart racing breathe breathing chest terrified anxious anxiety fear shaking dizzy dying",
+        "user": "I had a panic attack today and I'm scared it will happen again.",
+        "thought_process": [
+            "Feeling: Fear, anxiety about anxiety, loss of control",
+            "Underlying issue: Panic disorder symptoms, fear of recurrence",
+            "Need: Reassurance, education about panic attacks, coping tools",
+            "Response approach: Normalize the experience, provide psychoeducation, teach grounding",
+        ],
+        "counselor": "I'm sorry you went through that - panic attacks can be terrifying, especially when they're unexpected. First, I want you to know that you're safe now, and what you experienced, while frightening, wasn't dangerous. The fear of having another panic attack is very common and actually has a name: 'anticipatory anxiety.' Here's something that might help: panic attacks always pass, usually within 10-20 minutes. When you feel one coming, try the 5-4-3-2-1 grounding technique: name 5 things you see, 4 you can touch, 3 you hear, 2 you smell, and 1 you taste. This helps bring you back to the present moment. Would you like to talk about what was happening before the panic attack occurred?",
+    },
+    {
+        "topic": "social anxiety",
+        "keywords": "shy parties people friends judged judge embarrassed awkward lonely nobody likes canceled social invite",
+        "user": "I avoid social situations because I'm terrified people will judge me. I canceled plans again today and now I feel like a failure.",
+        "thought_process": [
+            "Feeling: Social anxiety, shame, self-criticism, isolation",
+            "Underlying issue: Fear of negative evaluation, avoidance cycle reinforcing anxiety",
+            "Need: Validation without enabling avoidance, gentle challenge to negative self-talk",
+            "Response approach: Normalize the fear, address self-criticism, explore small steps forward",
+        ],
+        "counselor": "First, I want to acknowledge how brave it is that you're sharing this with me. Social anxiety is incredibly common, and the fear of judgment can feel paralyzing. But I want to gently challenge the idea that you're a 'failure' - you're someone dealing with anxiety, and that's not a character flaw. The tricky thing about avoidance is that while it brings short-term relief, it can actually strengthen the anxiety over time. Your brain learns that social situations are dangerous, even though they're not. What if we thought about this differently? Instead of 'I'm a failure for canceling,' what if it's 'I'm struggling with anxiety, and I'm working on it.' Can you tell me what specifically worries you most about these social situations?",
+    },
+    {
+        "topic": "relationships",
+        "keywords": "partner boyfriend girlfriend husband wife marriage married arguing argue argument fight breakup communication",
+        "user": "My partner and I keep fighting about the same things. I don't think they understand how I feel.",
+        "thought_process": [
+            "Feeling: Frustration, feeling unheard, relationship distress",
+            "Underlying issue: Communication breakdown, possible unmet needs",
+            "Need: Help identifying patterns, communication tools, validation of both perspectives",
+            "Response approach: Explore the pattern, teach communication skills, avoid taking sides",
+        ],
+        "counselor": "Relationship conflicts, especially recurring ones, can be really exhausting and lonely. It sounds like you're feeling unheard, which is painful. I'm curious - when you say they don't understand how you feel, have you been able to express your feelings using 'I' statements? For example, instead of 'You always...' trying 'I feel... when... because...' This can help your partner hear your feelings without becoming defensive. Also, it might help to ask yourself: what need of mine isn't being met? Is it connection, respect, support, or something else? Understanding this can help you communicate more clearly. Would you be willing to tell me about one of these recurring conflicts so we can explore it together?",
+    },
+    {
+        "topic": "grief",
+        "keywords": "died death dead loss lost passed away miss funeral mourning dad mom father mother grandma grandpa",
+        "user": "It's been six months since my mom passed away and I still cry every day. People say I should be moving on by now.",
+        "thought_process": [
+            "Feeling: Grief, sadness, pressure from others, possibly guilt",
+            "Underlying issue: Normal grief process being invalidated by others",
+            "Need: Permission to grieve, normalization of timeline, validation",
+            'Response approach: Strongly validate grief, educate about grief process, challenge "should"',
+        ],
+        "counselor": "I'm so sorry for the loss of your mom. What you're experiencing is completely normal and valid. There's no timeline for grief, and anyone who suggests you 'should' be over it by six months doesn't understand how grief works. Grief isn't linear - it comes in waves, and six months is still very recent. Crying every day is your heart processing an enormous loss. Some people grieve intensely for years, and that's okay. What matters is that you're allowing yourself to feel. Grief is love with nowhere to go, and the depth of your pain reflects the depth of your love for your mom. How are you taking care of yourself during this time? And do you have people in your life who allow you to grieve without judgment?",
+    },
+    {
+        "topic": "self-image",
+        "keywords": "ugly body weight appearance mirror self-esteem hate myself confidence compare comparison fat looks",
+        "user": "I look in the mirror and hate what I see. I feel ugly and worthless compared to everyone else.",
+        "thought_process": [
+            "Feeling: Low self-esteem, self-hatred, comparison, body image issues",
+            "Underlying issue: Negative self-perception, possibly influenced by social media/society",
+            "Need: Compassionate challenge to distorted thinking, self-worth beyond appearance",
+            "Response approach: Validate pain, challenge comparison, explore self-worth sources",
+        ],
+        "counselor": "Thank you for trusting me with something so painful. The relationship we have with ourselves can be the hardest one, and I hear how much you're struggling right now. I want to ask you something: if a friend came to you and said they felt ugly and worthless, what would you say to them? Often we're much kinder to others than to ourselves. Comparison is a trap - we compare our behind-the-scenes to everyone else's highlight reel, especially on social media. But here's the truth: your worth has nothing to do with how you look. Your worth is inherent - it exists because you exist. What are some things about yourself that have nothing to do with appearance? What do you value in others - is it really just how they look, or is it their kindness, humor, intelligence, creativity?",
+    },
+    {
+        "topic": "focus",
+        "keywords": "concentrate concentration distracted procrastinate procrastinating homework study studying racing thoughts productive tasks",
+        "user": "I have so much to do and I can't focus on anything. My mind keeps racing and I'm getting nothing done.",
+        "thought_process": [
+            "Feeling: Overwhelmed, scattered, anxious, possibly paralyzed by stress",
+            "Underlying issue: Cognitive overload, possible anxiety, lack of prioritization",
+            "Need: Grounding, practical strategies, validation of difficulty",
+            "Response approach: Validate, provide concrete stress management tools, break down tasks",
+        ],
+        "counselor": "What you're describing is a really common response to stress and overwhelm - when we have too much to do, our brain can go into overdrive and actually make it harder to do anything. It's like having too many browser tabs open. First, take a breath with me. Let's try to calm your nervous system. Can you name three things you can see right now? Good. Now, let's make this manageable. Instead of looking at everything at once, can you identify just ONE thing that absolutely must get done today? Just one. We're going to ignore everything else for now. Once you have that one thing, break it into the smallest possible first step - something you can do in 5 minutes. Sometimes we just need to build momentum. Also, your racing mind might benefit from a 'brain dump' - write down everything you're worried about, just to get it out of your head. Does this feel doable?",
+    },]
+
+
+def render_example(number, example):
+    thought_process = "\n".join(f"- {line}" for line in example["thought_process"])
+    return f"""Example {number}:
+User: "{example['user']}"
+
+Counselor's thought process:
+{thought_process}
+
+Counselor: "{example['counselor']}\""""
+
+
+def render_examples(examples):
+    """Render examples in the prompt format, numbered from 1."""
+    return "\n\n".join(render_example(i, example) for i, example in enumerate(examples, 1))
+
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have i i'm if in is it it's me my of on or
+so that the their them they this to was we were what when with you your
+""".split())
+
+
+def tokenize(text):
+    """Lowercased words minus stopwords, plus adjacent-word bigrams."""
+    words = [w for w in re.findall(r"[a-z']+", text.lower()) if w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def example_document(example):
+    # The user message carries the situation; the keywords and thought-process
+    # notes add the vocabulary other people use to describe the same thing.
+    return " ".join([
+        example["topic"], example["keywords"], example["user"], *example["thought_process"],
+    ])
+
+
+class FewShotIndex:
+    """
+    TF-IDF index over the example corpus, built once. numpy is imported when
+    the first index is built, so importing this module (and app.py) stays fast.
+    """
+
+    def __init__(self, examples):
+        import numpy as np
+
+        self.examples = examples
+        documents = [Counter(tokenize(example_document(e))) for e in examples]
+        vocabulary = sorted(set().union(*documents))
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        document_frequency = Counter(term for doc in documents for term in doc)
+        self.idf = np.array(
+            [math.log((1 + len(documents)) / (1 + document_frequency[t])) + 1 for t in vocabulary]
+        )
+        self.matrix = np.vstack([self._vector(doc) for doc in documents])
+
+    def _vector(self, counts):
+        import numpy as np
+
+        vector = np.zeros(len(self.term_ids))
+        for term, count in counts.items():
+            term_id = self.term_ids.get(term)
+            if term_id is not None:
+                vector[term_id] = 1 + math.log(count)
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def select(self, query, k):
+        """The k examples most similar to `query`, most relevant first."""
+        if k <= 0 or k >= len(self.examples):
+            return list(self.examples)
+        import numpy as np
+
+        scores = self.matrix @ self._vector(Counter(tokenize(query)))
+        # Stable sort keeps corpus order for ties (e.g. no overlap at all)
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [self.examples[i] for i in order]
+
+
+FEW_SHOT_EXAMPLES = "\n" + render_examples(EXAMPLES) + "\n"
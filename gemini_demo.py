@@ -1,14 +1,34 @@
-from google import genai
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from budgets import OutputBudget
+from history import ConversationHistory, build_summary_prompt
+from metrics import RequestTrace, get_logger
+from model_client import create_client
+from resilience import ResilientCaller
+
+# Model client; the API key is REQUIRED for the real backend (GEMINI_BACKEND=fake
+# runs offline)
+client = create_client()
+
+MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+
+# Retries with backoff, circuit breaking, fallback models and a deadline per
+# response, configured like app.py (see resilience.py)
+upstream = ResilientCaller.from_env(MODEL_NAME)
+
+# Summary calls get the same output budget as in app.py (see budgets.py)
+SUMMARY_BUDGET = OutputBudget.from_env("summary", 512, thinking_budget=0)
+
+# Structured JSON log line per response (stderr), same format as app.py
+logger = get_logger("counselor.demo")
+
+
+def set_client(new_client):
+    """Swap the model client, e.g. for a FakeGeminiClient."""
+    global client
+    client = new_client
 
-# Get API key from environment variable (REQUIRED for security)
-api_key = os.environ.get("GOOGLE_API_KEY")
-if not api_key:
-    raise ValueError(
-        "GOOGLE_API_KEY environment variable is not set. "
-        "Please set it in your .env file or environment variables."
-    )
-client = genai.Client(api_key=api_key)
 
 # System prompt with counselor role and chain-of-thought instructions
 SYSTEM_PROMPT = """You are a compassionate AI counselor specializing in mental health support for depression and anxiety. 
@@ -88,18 +108,39 @@ User: "{user_message}"
 
 Counselor's thought process:"""
 
+    trace = RequestTrace("gemini_demo", logger)
+    trace.set(history_chars=len(conversation_history))
+    trace.record_prompt("answer", full_prompt)
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=full_prompt
-        )
-        print("-------")
-        print(response)
+        with trace.stage("answer"):
+            response = upstream.call_sync(lambda model: generate(model, full_prompt))
+        trace.record_usage("answer", response)
+        trace.finish("ok" if response.text else "fallback")
         return response.text
     except Exception as e:
+        trace.finish("error", e)
         return f"I apologize, but I'm having trouble connecting right now. Error: {e}\nPlease try again, and if you're in crisis, please reach out to a crisis helpline immediately."
 
 
+def generate(model, contents, config=None):
+    """One synchronous attempt, bounded by the per-attempt timeout."""
+    timeout_ms = int(upstream.attempt_timeout * 1000)
+    return client.models.generate_content(
+        model=model,
+        contents=contents,
+        config={**(config or {}), "http_options": {"timeout": timeout_ms}},
+    )
+
+
+def summarize_turns(summary, lines):
+    """Fold turns that left the history window into the running summary."""
+    prompt = build_summary_prompt(summary, lines)
+    response = upstream.call_sync(
+        lambda model: generate(model, prompt, {"temperature": 0.3, **SUMMARY_BUDGET.config()})
+    )
+    return response.text.strip() if response.text else None
+
+
 def interactive_counselor():
     """
     Interactive counseling session
@@ -113,7 +154,10 @@ def interactive_counselor():
     print("⚠️  Note: I'm an AI assistant, not a replacement for professional help.")
     print("If you're in crisis, please contact a crisis helpline immediately.\n")
     
-    conversation_history = ""
+    history = ConversationHistory()
+    # Summaries are generated in the background while the user is typing
+    summarizer = ThreadPoolExecutor(max_workers=1)
+    pending_summary = None
     
     while True:
         user_input = input("You: ").strip()
@@ -125,12 +169,29 @@ def interactive_counselor():
         if not user_input:
             continue
         
+        # Pick up a finished background summary before building the prompt
+        if pending_summary is not None and pending_summary[0].done():
+            future, folded = pending_summary
+            pending_summary = None
+            try:
+                summary = future.result()
+            except Exception as e:
+                summary = None
+                print(f"(Could not summarize earlier conversation: {e})")
+            if summary:
+                history.apply_summary(summary, folded)
+        
         print("\nCounselor: ", end="", flush=True)
-        response = get_counselor_response(user_input, conversation_history)
+        response = get_counselor_response(user_input, history.render())
         print(response + "\n")
         
-        # Update conversation history for context
-        conversation_history += f"\nUser: {user_input}\nCounselor: {response}\n"
+        # Update conversation history for context, within the token budget
+        history.add_exchange(user_input, response)
+        if history.pending and pending_summary is None:
+            folded = list(history.pending)
+            pending_summary = (summarizer.submit(summarize_turns, history.summary, folded), folded)
+    
+    summarizer.shutdown(wait=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+"""
+Token-budgeted conversation history with a running summary.
+
+Recent turns are kept verbatim as long as they fit in the token budget. Turns
+that fall out of the window move to a pending list, and the caller folds them
+into the running summary with a model call made off the request path
+(build_summary_prompt() + apply_summary()).
+
+The rendered history text is maintained incrementally: new turns are appended
+to it and evicted turns are sliced off the front, so it is never rebuilt from
+scratch. The state round-trips through plain dicts so it can live in any
+session store.
+"""
+import os
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "2000"))
+
+
+def estimate_tokens(text):
+    """Cheap offline token estimate (~4 characters per token for English text)."""
+    return max(1, (len(text) + 3) // 4)
+
+
+class ConversationHistory:
+    # Always keep at least the latest exchange verbatim, however long it is
+    MIN_TURNS = 2
+
+    def __init__(self, budget_tokens=HISTORY_TOKEN_BUDGET, summary="", rendered="",
+                 turns=None, pending=None):
+        self.budget_tokens = budget_tokens
+        self.summary = summary
+        # The verbatim window: `rendered` is the turns joined by newlines and
+        # `turns` holds [chars, tokens] for each of them, oldest first.
+        self.rendered = rendered
+        self.turns = [list(turn) for turn in turns or []]
+        self.tokens = sum(tokens for _, tokens in self.turns)
+        # Turns that left the window and are waiting to be summarized
+        self.pending = list(pending or [])
+
+    def add(self, line):
+        """Append one turn ("User: ..." or "Counselor: ...") to the window."""
+        tokens = estimate_tokens(line)
+        self.rendered = f"{self.rendered}\n{line}" if self.turns else line
+        self.turns.append([len(line), tokens])
+        self.tokens += tokens
+        self._evict()
+
+    def add_exchange(self, message, counselor_response):
+        self.add(f"User: {message}")
+        self.add(f"Counselor: {counselor_response}")
+
+    def _evict(self):
+        while self.tokens > self.budget_tokens and len(self.turns) > self.MIN_TURNS:
+            chars, tokens = self.turns.pop(0)
+            self.pending.append(self.rendered[:chars])
+            self.rendered = self.rendered[chars + 1:]
+            self.tokens -= tokens
+
+    def render(self):
+        """History text to put in the prompt."""
+        if not self.summary:
+            return self.rendered
+        return f"Summary of the earlier conversation:\n{self.summary}\n\n{self.rendered}"
+
+    def apply_summary(self, summary, folded):
+        """
+        Install a summary that covers `folded`, the pending turns it was built
+        from. Ignored if those turns are no longer at the head of the pending
+        list (for example because the conversation was reset meanwhile).
+        """
+        if not folded or self.pending[:len(folded)] != folded:
+            return False
+        self.summary = summary
+        del self.pending[:len(folded)]
+        return True
+
+    def to_dict(self):
+        return {
+            "summary": self.summary,
+            "rendered": self.rendered,
+            "turns": self.turns,
+            "pending": self.pending,
+        }
+
+    @classmethod
+    def from_dict(cls, data, budget_tokens=HISTORY_TOKEN_BUDGET):
+        if not data:
+            return cls(budget_tokens=budget_tokens)
+        return cls(budget_tokens=budget_tokens, **data)
+
+
+def build_summary_prompt(summary, lines):
+    """Prompt that folds `lines` (turns leaving the window) into `summary`."""
+    previous = summary or "(none yet)"
+    transcript = "\n".join(lines)
+    return f"""You maintain a running summary of a supportive counseling conversation.
+
+Current summary:
+{previous}
+
+Older turns to fold into the summary:
+{transcript}
+
+Write an updated summary in under 150 words. Keep what the person shared about their feelings, circumstances and concerns, anything they asked to be remembered, any safety concerns, and the coping strategies already suggested. Write only the summary:"""
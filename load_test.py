@@ -0,0 +1,828 @@
+"""
+Load test for the /chat endpoint against the offline fake Gemini backend.
+
+Runs entirely offline: app.py is given a FakeGeminiClient with a fixed
+round-trip time. With a non-blocking pipeline, N concurrent sessions should
+finish in roughly one chat round trip (PLAN + ANSWER), not N.
+
+Usage:
+    python load_test.py
+"""
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+# Every request here comes from one client address; check_admission() tests the limits
+os.environ.setdefault("RATE_LIMIT_IP_BURST", "10000")
+os.environ.setdefault("RATE_LIMIT_SESSION_BURST", "100")
+
+import httpx
+from starlette.requests import Request
+
+import app as counselor_app
+from fake_gemini import FakeGeminiClient, api_error
+from admission import Admission
+from budgets import TRUNCATIONS, OutputBudget
+from resilience import ResilientCaller, UpstreamUnavailable
+
+ROUND_TRIP = 0.2  # seconds per upstream call
+SESSIONS = 25
+
+
+def install_fake(delay=ROUND_TRIP):
+    # Instant token generation: every call takes exactly one round trip
+    fake = FakeGeminiClient(latency_ms=delay * 1000, latency_dist="fixed", tokens_per_second=0)
+    counselor_app.set_client(fake)
+    return fake
+
+
+def model_calls(fake):
+    return fake.calls["generate_content"] + fake.calls["generate_content_stream"]
+
+
+def http_request(disconnected=None):
+    """Minimal request for calling the chat handlers directly; it disconnects once `disconnected` is set."""
+    scope = {"type": "http", "method": "POST", "headers": [], "client": ("127.0.0.1", 0)}
+    if disconnected is None:
+        return Request(scope)
+
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+    return Request(scope, receive)
+
+
+async def check_startup(fake):
+    """Live at once, ready once the background warm-up has opened the upstream connection."""
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        async with counselor_app.lifespan(counselor_app.app):
+            health = await http.get("/healthz")
+            starting = await http.get("/readyz")
+            await counselor_app.startup_task
+            ready = await http.get("/readyz")
+    return health, starting, ready, fake.calls["models.get"]
+
+
+async def run_sessions(sessions):
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        async def one(i):
+            response = await http.post("/chat", json={
+                "message": f"Hello from session {i}",
+                "session_id": f"load_{i}",
+            })
+            response.raise_for_status()
+
+        # A static route requested mid-load must not wait for the chats.
+        async def static_probe():
+            await asyncio.sleep(ROUND_TRIP / 2)
+            start = time.perf_counter()
+            response = await http.get("/styles.css")
+            response.raise_for_status()
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(static_probe(), *(one(i) for i in range(sessions)))
+        return time.perf_counter() - start, results[0]
+
+
+async def read_stream(response):
+    events = []
+    async for message in response.body_iterator:
+        events.append(json.loads(message[len("data: "):]))
+    return events
+
+
+async def check_stream_duplicates(fake):
+    """Two followers of the same streamed turn get the same events from one upstream pair."""
+    calls_before = model_calls(fake)
+    request = counselor_app.ChatRequest(
+        message="Hello twice", session_id="stream_dup", request_id="stream-turn-1",
+    )
+    first, second = await asyncio.gather(
+        counselor_app.chat_stream(request, http_request()),
+        counselor_app.chat_stream(request, http_request()),
+    )
+    first_events, second_events = await asyncio.gather(read_stream(first), read_stream(second))
+    return model_calls(fake) - calls_before, first_events, second_events
+
+
+async def run_stream(session_id):
+    """Returns (time to first token, total time, streamed text) for one /chat/stream call."""
+    # httpx's ASGI transport buffers whole responses, so read the SSE body
+    # iterator directly to observe when each event is produced.
+    start = time.perf_counter()
+    response = await counselor_app.chat_stream(counselor_app.ChatRequest(
+        message="Hello over SSE", session_id=session_id,
+    ), http_request())
+    first_token = None
+    text = ""
+    async for message in response.body_iterator:
+        event = json.loads(message[len("data: "):])
+        assert event["type"] != "error", event
+        if event["type"] == "token":
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            text += event["text"]
+    return first_token, time.perf_counter() - start, text
+
+
+def check_session_store():
+    """Random session ids from many browsers must not grow memory without bound."""
+    from session_store import MemorySessionStore
+
+    store = MemorySessionStore(max_sessions=1000, max_bytes=200_000)
+    for i in range(20_000):
+        store.put(f"session_{i}", [f"User: message {i}", "Counselor: reply"])
+    return store.stats()
+
+
+def check_sqlite_session_store():
+    """
+    Two SQLiteSessionStore instances on one file (as two workers would have)
+    share sessions; TTL expiry and the background size sweep work, and the
+    triggered totals behind stats() match the table.
+    """
+    import tempfile
+    from session_store import SQLiteSessionStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.db")
+        first, second = SQLiteSessionStore(path, max_sessions=5), SQLiteSessionStore(path, max_sessions=5)
+        first.put("shared", ["User: hi"])
+        second.put("shared", ["User: hi", "Counselor: hello"])
+        shared = first.get("shared")
+        second.delete("shared")
+        deleted = first.get("shared")
+
+        first.SWEEP_EVERY, first._writes = 10, 0
+        for i in range(10):  # the 10th write starts a sweep down to max_sessions
+            first.put(f"session_{i}", [f"User: message {i}"])
+        first._sweeper.join()
+        swept = {**second.stats(), "evictions": first.evictions}
+
+        short_lived = SQLiteSessionStore(path, max_sessions=5, ttl_seconds=0.05)
+        time.sleep(0.1)
+        expired = short_lived.get("session_9")
+
+        count, size = first._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(id) + LENGTH(data)), 0) FROM sessions"
+        ).fetchone()
+        totals = second.stats()
+        for store in (first, second, short_lived):
+            store.close()
+    return shared, deleted, swept, expired, (count, size), totals
+
+
+async def check_sqlite_off_loop():
+    """
+    While another process holds the SQLite write lock, a chat turn waits for
+    it in a thread: the event loop keeps running, and the update lands once
+    the lock is released.
+    """
+    import sqlite3
+    import tempfile
+    from session_store import SQLiteSessionStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.db")
+        store = SQLiteSessionStore(path)
+        other_worker = sqlite3.connect(path)
+        other_worker.execute("BEGIN IMMEDIATE")
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        memory_store, counselor_app.sessions = counselor_app.sessions, store
+        ticker = asyncio.create_task(tick())
+        try:
+            asyncio.get_running_loop().call_later(0.3, other_worker.commit)
+            started = time.perf_counter()
+            await counselor_app.commit_exchange("locked", "Hello", "Hi there")
+            waited = time.perf_counter() - started
+            history = (await counselor_app.get_history("locked")).rendered
+        finally:
+            ticker.cancel()
+            counselor_app.sessions = memory_store
+            other_worker.close()
+            store.close()
+    return waited, ticks, history
+
+
+async def check_duplicate_submissions(fake):
+    """
+    Double submits and retries of one turn share a single PLAN/ANSWER pair;
+    distinct turns of one session run one after the other.
+    """
+    session_id = "double_submit"
+    calls_before = model_calls(fake)
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        def send(request_id, message):
+            return http.post("/chat", json={
+                "message": message, "session_id": session_id, "request_id": request_id,
+            })
+
+        # Five copies of turn A race with two copies of turn B
+        responses = await asyncio.gather(
+            *(send("turn-a", "First message") for _ in range(5)),
+            *(send("turn-b", "Second message") for _ in range(2)),
+        )
+        # A retry after completion is answered from the finished turn
+        responses.append(await send("turn-a", "First message"))
+
+    assert all(r.status_code == 200 for r in responses), [r.text for r in responses]
+    history = (await counselor_app.get_history(session_id)).rendered.split("\n")
+    return model_calls(fake) - calls_before, history
+
+
+async def check_history_budget():
+    """Long conversations stay under the token budget and older turns get summarized."""
+    session_id = "long_history"
+    long_message = "I keep going over everything that happened at work. " * 40
+    for _ in range(6):
+        await counselor_app.chat(counselor_app.ChatRequest(
+            message=long_message, session_id=session_id,
+        ), http_request())
+    await asyncio.gather(*counselor_app.background_tasks)
+    return await counselor_app.get_history(session_id)
+
+
+async def check_pipelines():
+    """Every pipeline mode can be selected per request and is metered separately."""
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        for mode in counselor_app.PIPELINE_MODES:
+            response = await http.post("/chat", json={
+                "message": "Hello", "session_id": f"pipeline_{mode}", "pipeline": mode,
+            })
+            response.raise_for_status()
+            answer = response.json()["prompt"]
+            assert answer and answer != counselor_app.FALLBACK_RESPONSE, response.json()
+        response = await http.post("/chat", json={"message": "Hello", "pipeline": "bogus"})
+        assert response.status_code == 400, response.status_code
+        return (await http.get("/stats")).json()["pipelines"]
+
+
+async def check_prompt_cache(fake):
+    """A warm cache is referenced by name; an evicted one is replayed inline and recreated."""
+    await counselor_app.prompt_cache.stop()
+    cache = counselor_app.prompt_cache = counselor_app.PromptCache(
+        model=counselor_app.MODEL_NAME,
+        system_instruction=counselor_app.SYSTEM_PROMPT,
+        prefix=counselor_app.FEW_SHOT_EXAMPLES,
+        ttl_seconds=counselor_app.PROMPT_CACHE_TTL_SECONDS,
+    )
+    await cache.start()
+    try:
+        await counselor_app.generate("User: hi", max_output_tokens=512)
+        fake.evict_caches()
+        await counselor_app.generate("User: hi again", max_output_tokens=512)
+        await asyncio.sleep(ROUND_TRIP * 1.5)  # let the background recreation run
+        await counselor_app.generate("User: hi once more", max_output_tokens=512)
+    finally:
+        await cache.stop()
+    return cache.stats()
+
+
+async def check_static_assets():
+    """Hashed URLs in the page, brotli/gzip immutable assets and 304 revalidation."""
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        page = await http.get("/", headers={"Accept-Encoding": "gzip"})
+        css_url = counselor_app.static_assets.url("styles.css")
+        assert css_url in page.text, "index.html does not reference the hashed stylesheet"
+        css = await http.get(css_url, headers={"Accept-Encoding": "gzip"})
+        revalidated = await http.get("/", headers={
+            "Accept-Encoding": "gzip", "If-None-Match": page.headers["etag"],
+        })
+        plain = await http.get(css_url, headers={"Accept-Encoding": "identity"})
+        brotli_css = await http.get(css_url, headers={"Accept-Encoding": "gzip, br"})
+    return page, css, revalidated, plain, brotli_css
+
+async def check_upstream_failures(fake):
+    """Retries, model fallback, 503 when every model fails and 504 past the deadline."""
+    saved = counselor_app.upstream
+    primary, fallback = counselor_app.MODEL_NAME, "fallback-model"
+
+    def caller(deadline=60.0):
+        return ResilientCaller([primary, fallback], max_attempts=3, backoff_base=0.01,
+                               backoff_max=0.02, default_deadline=deadline)
+
+    statuses = []
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        async def send(failures, upstream):
+            counselor_app.upstream = upstream
+            fake.fail_next(failures, code=503)
+            response = await http.post("/chat", json={"message": "Hello", "session_id": "flaky"})
+            statuses.append(response.status_code)
+            return response
+
+        try:
+            upstream = caller()
+            await send(2, upstream)  # retried on the primary model
+            await send(3, upstream)  # primary exhausted, PLAN falls back
+            retries, fallbacks = upstream.counters["retries"], upstream.counters["fallbacks"]
+            unavailable = await send(6, caller())  # every attempt on both models fails
+            await send(0, caller(deadline=ROUND_TRIP / 2))  # deadline shorter than one call
+        finally:
+            counselor_app.upstream = saved
+    return statuses, retries, fallbacks, unavailable.headers.get("retry-after"), fake.model_calls[fallback]
+
+async def check_stream_deadline(fake):
+    """A stream that stalls after its first token ends with a 504 event at the request deadline."""
+    saved = counselor_app.upstream
+    fake.tokens_per_second = 20  # the answer would take ~10 s
+    try:
+        counselor_app.upstream = ResilientCaller([counselor_app.MODEL_NAME],
+                                                 default_deadline=3 * ROUND_TRIP)
+        start = time.perf_counter()
+        response = await counselor_app.chat_stream(counselor_app.ChatRequest(
+            message="Hello", session_id="stalled", pipeline="thinking",
+        ), http_request())
+        events = [json.loads(event[len("data: "):]) async for event in response.body_iterator]
+        elapsed = time.perf_counter() - start
+    finally:
+        fake.tokens_per_second = 0
+        counselor_app.upstream = saved
+    return events, elapsed, len(counselor_app.session_locks)
+
+
+async def check_empty_stream():
+    """A stream that ends before its first chunk is still closed and counted as a call."""
+    closed = []
+
+    class EmptyStream:
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            raise StopAsyncIteration
+
+        async def aclose(self):
+            closed.append(True)
+
+    async def empty_request(*args, **kwargs):
+        return EmptyStream()
+
+    saved = counselor_app.model_request
+    counselor_app.model_request = empty_request
+    usage = counselor_app.new_usage()
+    try:
+        chunks = [chunk async for chunk in counselor_app.generate_stream("Hello", 64, usage, stage="answer")]
+    finally:
+        counselor_app.model_request = saved
+    return chunks, usage["upstream_calls"], closed
+
+
+async def check_hedging_and_breaker():
+    """Hedged attempt beats a stalled one; an open circuit skips the model."""
+    caller = ResilientCaller(["model"], max_attempts=1, hedge=True, hedge_delay=0.05,
+                             breaker_failures=2, breaker_reset_seconds=0.2)
+    delays = iter([5.0, 0.01])
+
+    async def slow_then_fast(model):
+        await asyncio.sleep(next(delays))
+        return "answer"
+
+    start = time.perf_counter()
+    result = await caller.call(slow_then_fast)
+    hedged_elapsed = time.perf_counter() - start
+    assert result == "answer" and caller.counters["hedge_wins"] == 1, caller.counters
+
+    attempts = 0
+
+    async def failing(model):
+        nonlocal attempts
+        attempts += 1
+        raise api_error(503, "down")
+
+    for _ in range(3):
+        try:
+            await caller.call(failing)
+        except UpstreamUnavailable:
+            pass
+    short_circuited = attempts == 2 and caller.breakers["model"].state == "open"
+    await asyncio.sleep(0.25)  # circuit half-open: one trial call closes it again
+    caller.hedge = False
+
+    async def healthy(model):
+        return "ok"
+
+    recovered = await caller.call(healthy)
+    return hedged_elapsed, short_circuited, recovered, caller.breakers["model"].state
+
+async def check_admission():
+    """
+    Session and IP buckets and a full or slow queue answer 429 with
+    Retry-After; requests the IP limit turns away don't use up the session's.
+    """
+    saved = counselor_app.admission
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        def send(session_id):
+            return http.post("/chat", json={"message": "Hello", "session_id": session_id})
+
+        try:
+            counselor_app.admission = Admission(session_per_minute=6, session_burst=2)
+            flood = [(await send("flood")).status_code for _ in range(3)]
+            flood_retry_after = counselor_app.admission.sessions.check("flood")
+
+            counselor_app.admission = Admission(session_per_minute=6, session_burst=2,
+                                                ip_per_minute=6, ip_burst=1)
+            ip_flood = [(await send("ip_flood")).status_code for _ in range(3)]
+            ip_rejections = counselor_app.admission.stats()["rejected_ip"]
+            # One of the session's two tokens is left
+            session_left = counselor_app.admission.sessions.check("ip_flood")
+
+            # One turn in progress, one waiting (and timing out), one turned away
+            counselor_app.admission = Admission(max_active=1, max_queue=1, max_wait=ROUND_TRIP / 2)
+            responses = await asyncio.gather(send("q1"), send("q2"), send("q3"))
+            stats = counselor_app.admission.stats()
+        finally:
+            counselor_app.admission = saved
+    return flood, flood_retry_after, (ip_flood, ip_rejections, session_left), responses, stats
+
+async def check_forwarded_for():
+    """
+    Behind serve.py's dispatcher, workers get the address of the peer that
+    connected (or the one the platform proxy reported), whatever
+    X-Forwarded-For a client sends.
+    """
+    from admission import client_address
+    from serve import Dispatcher, Worker, worker_env
+
+    async def client_ip(platform_hops, peer, headers):
+        saved = os.environ.get("FORWARDED_HOPS")
+        os.environ["FORWARDED_HOPS"] = str(platform_hops)
+        try:
+            hops = int(worker_env()["FORWARDED_HOPS"])
+        finally:
+            if saved is None:
+                del os.environ["FORWARDED_HOPS"]
+            else:
+                os.environ["FORWARDED_HOPS"] = saved
+
+        async def worker(scope, receive, send):
+            # Stands in for app.py on a Unix socket (no client address)
+            body = client_address(Request(scope), hops).encode()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": body})
+
+        dispatcher = Dispatcher([Worker(0, "unused.sock", {})])
+        dispatcher.clients = [httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=worker, client=None), base_url="http://worker",
+        )]
+        transport = httpx.ASGITransport(app=dispatcher, client=(peer, 5000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            response = await http.get("/whoami", headers=headers)
+        return response.text
+
+    direct = await client_ip(0, "203.0.113.7", {"X-Forwarded-For": "6.6.6.6"})
+    # Render/Heroku: their proxy (10.0.0.1) appended the real client
+    platform = await client_ip(1, "10.0.0.1", {"X-Forwarded-For": "6.6.6.6, 198.51.100.9"})
+    return direct, platform
+
+
+async def check_crisis(fake):
+    """Crisis messages get the safety response at once, the model's reply follows."""
+    message = "I don't see the point anymore. Nothing makes me happy."
+    calls_before = model_calls(fake)
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        start = time.perf_counter()
+        safety = await http.post("/chat", json={"message": message, "session_id": "crisis"})
+        safety_latency = time.perf_counter() - start
+        follow_up = await http.post("/chat/follow_up", json={
+            "session_id": "crisis", "request_id": safety.json()["follow_up"],
+        })
+
+        # Even when the session is out of admission tokens. The follow-up
+        # reports why there is no reply, also once the turn is long over.
+        saved = counselor_app.admission
+        try:
+            counselor_app.admission = Admission(session_per_minute=1, session_burst=0)
+            limited = await http.post("/chat", json={"message": message, "session_id": "crisis_limited"})
+            await asyncio.sleep(ROUND_TRIP)
+            limited_follow_up = await http.post("/chat/follow_up", json={
+                "session_id": "crisis_limited", "request_id": limited.json()["follow_up"],
+            })
+        finally:
+            counselor_app.admission = saved
+
+        # Every model unavailable, follow-up fetched after the turn failed
+        saved = counselor_app.upstream
+        try:
+            counselor_app.upstream = ResilientCaller(
+                [counselor_app.MODEL_NAME], max_attempts=1, default_deadline=60.0,
+            )
+            fake.fail_next(1, code=503)
+            failed = await http.post("/chat", json={"message": message, "session_id": "crisis_failed"})
+            await asyncio.sleep(ROUND_TRIP)
+            failed_follow_up = await http.post("/chat/follow_up", json={
+                "session_id": "crisis_failed", "request_id": failed.json()["follow_up"],
+            })
+        finally:
+            counselor_app.upstream = saved
+
+    response = await counselor_app.chat_stream(counselor_app.ChatRequest(
+        message=message, session_id="crisis_stream",
+    ), http_request())
+    start = time.perf_counter()
+    events = []
+    async for event in response.body_iterator:
+        events.append((json.loads(event[len("data: "):])["type"], time.perf_counter() - start))
+    return (safety, safety_latency, follow_up, limited, limited_follow_up, failed_follow_up, events,
+            model_calls(fake) - calls_before)
+
+
+async def check_truncation(fake):
+    """Thinking that eats the budget is retried bigger; a cut-off answer is continued."""
+    saved = counselor_app.PLAN_BUDGET, counselor_app.ANSWER_BUDGET
+    try:
+        # Dynamic thinking (600 tokens) under a 512 cap: PLAN comes back empty
+        fake.thinking_tokens = 600
+        counselor_app.PLAN_BUDGET = OutputBudget("plan", 512, thinking_budget=None)
+        counselor_app.ANSWER_BUDGET = OutputBudget("answer", 40, on_truncation="continue")
+        usage = counselor_app.new_usage()
+        answer = await counselor_app.run_pipeline("two_stage", "", "Hello", usage)
+
+        streamed = []
+        async for text in counselor_app.stream_pipeline("two_stage", "", "Hello", counselor_app.new_usage()):
+            streamed.append(text)
+    finally:
+        fake.thinking_tokens = 0
+        counselor_app.PLAN_BUDGET, counselor_app.ANSWER_BUDGET = saved
+    actions = {action: TRUNCATIONS.value(stage=stage, action=action)
+               for stage, action in (("plan", "retried"), ("answer", "continued"),
+                                     ("answer", "continued_partial"))}
+    return answer, "".join(streamed), usage, actions
+
+
+async def check_cancellation(fake):
+    """
+    Turns stop calling the model once nobody wants the answer: on reset, on
+    /cancel, when the only client disconnects, and when the last stream
+    follower goes away; another follower keeps a streamed turn alive.
+    """
+    calls = {}
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        # Reset while PLAN is in flight
+        calls_before = model_calls(fake)
+        chat = asyncio.create_task(http.post("/chat", json={"message": "Hello", "session_id": "cancel_reset"}))
+        await asyncio.sleep(ROUND_TRIP / 2)
+        await http.post("/reset", json={"session_id": "cancel_reset"})
+        reset = await chat
+        calls["reset"] = model_calls(fake) - calls_before
+
+        # The browser supersedes its request during ANSWER
+        calls_before = model_calls(fake)
+        chat = asyncio.create_task(http.post("/chat", json={
+            "message": "Hello", "session_id": "cancel_superseded", "request_id": "superseded-1",
+        }))
+        await asyncio.sleep(ROUND_TRIP * 1.5)
+        cancelled = await http.post("/cancel", json={
+            "session_id": "cancel_superseded", "request_id": "superseded-1",
+        })
+        superseded = await chat
+        calls["cancel"] = model_calls(fake) - calls_before
+
+    # The tab is closed during PLAN
+    calls_before = model_calls(fake)
+    disconnected = asyncio.Event()
+    chat = asyncio.create_task(counselor_app.chat(counselor_app.ChatRequest(
+        message="Hello", session_id="cancel_disconnect",
+    ), http_request(disconnected)))
+    await asyncio.sleep(ROUND_TRIP / 2)
+    disconnected.set()
+    closed = await chat
+    await asyncio.sleep(ROUND_TRIP * 2)  # would be long done if it were still running
+    calls["disconnect"] = model_calls(fake) - calls_before
+
+    # Two followers of one stream; one goes away mid-answer, then the other
+    fake.tokens_per_second = 200
+    request = counselor_app.ChatRequest(message="Hello", session_id="cancel_stream", request_id="stream-1")
+    first, second = [await counselor_app.chat_stream(request, http_request()) for _ in range(2)]
+    first_event = await anext(first.body_iterator)
+    second_events = [await anext(second.body_iterator)]
+    await first.body_iterator.aclose()
+    async for event in second.body_iterator:
+        second_events.append(event)
+        if len(second_events) == 3:
+            break
+    turn = counselor_app.turns.find(("stream", "cancel_stream", "stream-1"))
+    still_running = not turn.done
+    await second.body_iterator.aclose()
+    await asyncio.wait([turn.task])
+    fake.tokens_per_second = 0
+
+    histories = [(await counselor_app.get_history(s)).rendered
+                 for s in ("cancel_reset", "cancel_superseded", "cancel_disconnect", "cancel_stream")]
+    assert first_event == second_events[0] and "token" in first_event, (first_event, second_events)
+    return (reset, cancelled.json(), superseded, closed, calls, still_running, turn, histories)
+
+
+async def check_metrics(fake):
+    """One failed and one successful turn, then scrape /metrics."""
+    transport = httpx.ASGITransport(app=counselor_app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        fake.fail_next(1, code=400)
+        failed = await http.post("/chat", json={"message": "Hello", "session_id": "metrics"})
+        ok = await http.post("/chat", json={"message": "Hello", "session_id": "metrics"})
+        response = await http.get("/metrics")
+    assert failed.status_code == 500 and ok.status_code == 200, (failed, ok)
+    assert response.headers["content-type"].startswith("text/plain"), response.headers
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+async def main():
+    fake = install_fake()
+    chat_round_trip = 2 * ROUND_TRIP  # PLAN + ANSWER
+
+    health, starting, ready, warmup_calls = await check_startup(fake)
+    print(f"startup: /healthz {health.status_code}, /readyz {starting.status_code} while "
+          f"warming up, then {ready.status_code} {ready.json()['warmup']}")
+    assert health.status_code == 200 and starting.status_code == 503, starting.text
+    assert ready.status_code == 200 and warmup_calls == 1, ready.text
+
+    elapsed, static_latency = await run_sessions(SESSIONS)
+    print(f"{SESSIONS} concurrent sessions finished in {elapsed:.2f}s "
+          f"(one chat round trip = {chat_round_trip:.2f}s, serial would be "
+          f"{SESSIONS * chat_round_trip:.2f}s)")
+    print(f"/styles.css served in {static_latency * 1000:.1f} ms during load")
+
+    assert model_calls(fake) == 2 * SESSIONS, model_calls(fake)
+    expected_waves = -(-SESSIONS // counselor_app.MAX_CONCURRENT_UPSTREAM)
+    assert elapsed < chat_round_trip * expected_waves * 1.5 + 0.5, "event loop is being blocked"
+    assert static_latency < ROUND_TRIP, "static route waited on upstream calls"
+
+    fake.tokens_per_second = 400  # let the answer trickle in
+    first_token, total, text = await run_stream("stream_0")
+    fake.tokens_per_second = 0
+    print(f"/chat/stream first token after {first_token:.2f}s, complete after {total:.2f}s")
+    assert first_token < total - ROUND_TRIP / 2, "tokens were not streamed incrementally"
+    history = await counselor_app.get_history("stream_0")
+    assert history.rendered.endswith(f"Counselor: {text}"), history.rendered
+
+    upstream_calls, first_events, second_events = await check_stream_duplicates(fake)
+    assert upstream_calls == 2, upstream_calls
+    assert first_events == second_events and first_events[-1]["type"] == "done", first_events
+
+    store_stats = check_session_store()
+    print(f"session store after 20000 sessions: {store_stats}")
+    assert store_stats["sessions"] <= 1000 and store_stats["bytes"] <= 200_000, store_stats
+
+    shared, deleted, swept, expired, table, totals = check_sqlite_session_store()
+    print(f"sqlite session store: shared between instances, {swept['evictions']} evicted by the "
+          f"sweep, totals {totals['sessions']} sessions / {totals['bytes']} bytes")
+    assert shared == ["User: hi", "Counselor: hello"] and deleted is None, (shared, deleted)
+    assert swept["sessions"] == 5 and swept["evictions"] == 5 and expired is None, (swept, expired)
+    assert (totals["sessions"], totals["bytes"]) == table, (totals, table)
+
+    waited, ticks, locked_history = await check_sqlite_off_loop()
+    print(f"sqlite write behind another process's lock: waited {waited:.2f}s, "
+          f"event loop ran {ticks} ticks meanwhile")
+    assert waited >= 0.25 and ticks >= 10, (waited, ticks)
+    assert locked_history == "User: Hello\nCounselor: Hi there", locked_history
+
+    upstream_calls, history = await check_duplicate_submissions(fake)
+    print(f"8 submissions of 2 unique turns -> {upstream_calls} upstream calls, "
+          f"{len(history)} history lines")
+    assert upstream_calls == 4, upstream_calls  # one PLAN/ANSWER pair per unique turn
+    assert [line.split(":")[0] for line in history] == ["User", "Counselor"] * 2, history
+
+    history = await check_history_budget()
+    print(f"history after 6 long turns: {history.tokens} tokens in window, "
+          f"{len(history.pending)} turns pending, summary={bool(history.summary)}")
+    assert history.tokens <= history.budget_tokens, history.tokens
+    assert history.summary and not history.pending, history.to_dict()
+
+    pipelines = await check_pipelines()
+    for mode, entry in pipelines.items():
+        print(f"pipeline {mode}: p50 {entry['latency_p50']:.2f}s over {entry['requests']} requests, "
+              f"{entry['upstream_calls'] / entry['requests']:.0f} upstream calls/request")
+    assert pipelines["fused"]["upstream_calls"] == 1, pipelines["fused"]
+    assert pipelines["thinking"]["upstream_calls"] == 1, pipelines["thinking"]
+
+    cache_stats = await check_prompt_cache(fake)
+    print(f"prompt cache: {cache_stats}")
+    assert cache_stats["evictions"] == 1 and cache_stats["creates"] == 2, cache_stats
+    assert cache_stats["cached_tokens"] == 2 * cache_stats["prefix_tokens"], cache_stats
+    page, css, revalidated, plain, brotli_css = await check_static_assets()
+    print(f"static assets: {css.request.url.path} {css.headers['content-encoding']} "
+          f"{css.headers['content-length']}, br {brotli_css.headers['content-length']} "
+          f"of {plain.headers['content-length']} bytes, "
+          f"page revalidation -> {revalidated.status_code}")
+    assert css.headers["cache-control"].endswith("immutable"), css.headers
+    assert css.headers["content-encoding"] == "gzip" and css.text == plain.text
+    assert brotli_css.headers["content-encoding"] == "br" and brotli_css.text == plain.text
+    assert css.headers["etag"] != plain.headers["etag"], "encodings share one strong ETag"
+    assert page.headers["cache-control"] == "no-cache" and revalidated.status_code == 304
+    assert revalidated.headers["etag"] == page.headers["etag"]
+
+    statuses, retries, fallbacks, retry_after, fallback_calls = await check_upstream_failures(fake)
+    print(f"upstream failures: statuses {statuses}, {retries} retries, {fallbacks} fallback "
+          f"({fallback_calls} calls to the fallback model), Retry-After {retry_after}")
+    assert statuses == [200, 200, 503, 504], statuses
+    assert retries >= 4 and fallbacks == 1 and fallback_calls == 4 and retry_after, retries
+
+    events, elapsed, locked_sessions = await check_stream_deadline(fake)
+    print(f"stalled stream: {[e['type'] for e in events][:2]}... ended with "
+          f"{events[-1].get('status')} after {elapsed:.2f}s (deadline {3 * ROUND_TRIP:.2f}s)")
+    assert events[0]["type"] == "token" and events[-1] == {**events[-1], "type": "error", "status": 504}
+    assert elapsed < 3 * ROUND_TRIP + 0.3 and locked_sessions == 0, (elapsed, locked_sessions)
+    assert (await counselor_app.get_history("stalled")).rendered == ""
+
+    chunks, empty_calls, closed = await check_empty_stream()
+    assert chunks == [] and empty_calls == 1 and closed == [True], (chunks, empty_calls, closed)
+
+    hedged_elapsed, short_circuited, recovered, state = await check_hedging_and_breaker()
+    print(f"hedged call answered in {hedged_elapsed * 1000:.0f} ms instead of 5000 ms, "
+          f"breaker short-circuited={short_circuited}, after reset -> {recovered} ({state})")
+    assert hedged_elapsed < 0.5 and short_circuited and recovered == "ok" and state == "closed"
+
+    flood, flood_retry_after, ip_limited, responses, stats = await check_admission()
+    ip_flood, ip_rejections, session_left = ip_limited
+    print(f"admission: session flood -> {flood}, IP flood -> {ip_flood}, "
+          f"queue -> {[r.status_code for r in responses]}, "
+          f"Retry-After {[r.headers.get('retry-after') for r in responses]}")
+    assert flood == [200, 200, 429] and flood_retry_after > 0, flood
+    assert ip_flood == [200, 429, 429] and ip_rejections == 2 and session_left == 0, ip_limited
+    assert [r.status_code for r in responses] == [200, 429, 429], [r.text for r in responses]
+    assert all(r.headers["retry-after"].isdigit() for r in responses[1:])
+    assert stats["rejected_queue_full"] == 1 and stats["rejected_queue_timeout"] == 1, stats
+    assert stats["active"] == 0 and stats["queue_depth"] == 0, stats
+
+    direct, platform = await check_forwarded_for()
+    print(f"serve.py X-Forwarded-For: spoofed header -> {direct} direct, {platform} behind a platform proxy")
+    assert direct == "203.0.113.7" and platform == "198.51.100.9", (direct, platform)
+
+    safety, latency, follow_up, limited, limited_follow_up, failed_follow_up, events, calls = \
+        await check_crisis(fake)
+    print(f"crisis fast path: safety response in {latency * 1000:.1f} ms, model reply via "
+          f"/chat/follow_up -> {follow_up.status_code}, rate-limited -> {limited.status_code} "
+          f"then {limited_follow_up.status_code}, upstream down -> {failed_follow_up.status_code}, "
+          f"stream events {[t for t, _ in events[:2]]}...")
+    assert safety.json()["task"] == "SAFETY" and "988" in safety.json()["prompt"], safety.text
+    assert latency < ROUND_TRIP / 2, latency
+    assert follow_up.status_code == 200 and follow_up.json()["task"] == "ANSWER", follow_up.text
+    assert limited.status_code == 200 and limited_follow_up.status_code == 429, limited_follow_up.text
+    assert failed_follow_up.status_code == 503, failed_follow_up.text
+    assert events[0][0] == "safety" and events[0][1] < ROUND_TRIP / 2, events
+    assert events[-1][0] == "done" and calls == 5, (events, calls)
+    assert (await counselor_app.get_history("crisis")).rendered.startswith("User: I don't see the point")
+
+    answer, streamed, usage, actions = await check_truncation(fake)
+    print(f"truncation: {actions}, {usage['wasted_tokens']} wasted tokens, "
+          f"{usage['upstream_calls']} calls, answer {len(answer)} chars (streamed {len(streamed)})")
+    assert actions["retried"] == 2 and usage["wasted_tokens"] > 0, (actions, usage)
+    assert actions["continued"] + actions["continued_partial"] == 2, actions
+    assert usage["upstream_calls"] == 4 and len(answer) > 40 * 4 and len(streamed) > 40 * 4
+    assert "  " not in answer, answer
+
+    reset, cancelled, superseded, closed, calls, still_running, stream_turn, histories = \
+        await check_cancellation(fake)
+    stats = counselor_app.turns.stats()
+    saved_tokens = {endpoint: counselor_app.SAVED_TOKENS.value(endpoint=endpoint)
+                    for endpoint in ("/chat", "/chat/stream")}
+    print(f"cancellation: reset -> {reset.status_code}, /cancel -> {superseded.status_code}, "
+          f"disconnect -> {closed.status_code}, upstream calls {calls}, "
+          f"{stats['cancelled']} turns cancelled, ~{saved_tokens} tokens saved")
+    assert reset.status_code == 409 and superseded.status_code == 409, (reset.text, superseded.text)
+    assert cancelled == {"cancelled": 1} and closed.status_code == 499, (cancelled, closed)
+    assert calls == {"reset": 1, "cancel": 2, "disconnect": 1}, calls
+    assert still_running and stream_turn.task.cancelled(), "stream turn outlived its followers"
+    assert stream_turn.events[-1] == counselor_app.sse_event({"type": "cancelled", "reason": "abandoned"})
+    assert histories == ["", "", "", ""], histories
+    assert stats["cancelled"] == 4 and stats["in_flight"] == 0, stats
+    assert saved_tokens["/chat"] > 0 and saved_tokens["/chat/stream"] > 0, saved_tokens
+
+    samples = await check_metrics(fake)
+    errors = samples['counselor_errors_total{endpoint="/chat",error_class="ClientError"}']
+    plan_calls = samples['counselor_stage_duration_seconds_count{stage="plan"}']
+    answer_tokens = samples['counselor_tokens_total{stage="answer",kind="output"}']
+    print(f"/metrics: {len(samples)} samples, {errors:.0f} ClientError, "
+          f"{plan_calls:.0f} PLAN calls, {answer_tokens:.0f} ANSWER output tokens")
+    assert errors == 1 and plan_calls > 0 and answer_tokens > 0
+    assert 'counselor_request_duration_seconds_count{endpoint="/chat",pipeline="two_stage"}' in samples
+    assert 'counselor_stage_duration_seconds_count{stage="session_queue"}' in samples
+    assert "counselor_session_store_sessions" in samples
+    assert samples['counselor_safety_responses_total{endpoint="/chat"}'] == 3
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,282 @@
+"""
+Request instrumentation shared by app.py and gemini_demo.py.
+
+- Counter / Histogram: minimal Prometheus metric types with labels, rendered
+  in the text exposition format by render_metrics() (served on /metrics).
+- register_collector(): exports values computed on scrape (e.g. the
+  session-store and prompt-cache stats) as gauges.
+- RequestTrace: per-request stage timings, token usage and error class,
+  recorded into the metrics and written as one structured JSON log line.
+- get_logger(): JSON-lines logger used instead of print statements.
+"""
+import contextvars
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as TallyCounter
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+SIZE_BUCKETS = (256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+_registry = []
+_collectors = []
+_lock = threading.Lock()
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(n, "") for n in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}  # labels -> [bucket counts, sum, count]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def register_collector(prefix, documentation, stats):
+    """
+    Export every numeric value of the dict returned by `stats()` as a gauge
+    named `<prefix>_<key>`, evaluated on each scrape.
+    """
+    _collectors.append((prefix, documentation, stats))
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for prefix, documentation, stats in _collectors:
+        for key, value in stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{prefix}_{key}"
+            lines.append(f"# HELP {name} {documentation} ({key})")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter(
+    "counselor_requests_total", "Chat requests by outcome", ("endpoint", "pipeline", "status")
+)
+REQUEST_SECONDS = Histogram(
+    "counselor_request_duration_seconds", "End-to-end chat request latency", ("endpoint", "pipeline")
+)
+STAGE_SECONDS = Histogram(
+    "counselor_stage_duration_seconds",
+    "Time spent per request stage (queueing, prompt assembly, model calls)",
+    ("stage",),
+)
+TOKENS = Counter(
+    "counselor_tokens_total", "Tokens reported by the model per stage", ("stage", "kind")
+)
+PROMPT_CHARS = Histogram(
+    "counselor_prompt_chars", "Size of prompts sent to the model", ("stage",), SIZE_BUCKETS
+)
+HISTORY_CHARS = Histogram(
+    "counselor_history_chars", "Size of the conversation history per request", (), SIZE_BUCKETS
+)
+ERRORS = Counter(
+    "counselor_errors_total", "Failed requests by error class", ("endpoint", "error_class")
+)
+SAFETY_RESPONSES = Counter(
+    "counselor_safety_responses_total", "Messages answered at once by the crisis fast path", ("endpoint",)
+)
+CANCELLED_TURNS = Counter(
+    "counselor_cancelled_turns_total",
+    "Turns stopped before finishing (reset, cancel, or every client gone)",
+    ("endpoint", "reason"),
+)
+SAVED_TOKENS = Counter(
+    "counselor_cancellation_saved_tokens_total",
+    "Estimated upstream tokens not spent because turns were cancelled",
+    ("endpoint",),
+)
+
+USAGE_FIELDS = {
+    "prompt": "prompt_token_count",
+    "output": "candidates_token_count",
+    "thinking": "thoughts_token_count",
+    "cached": "cached_content_token_count",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        logger.propagate = False
+    return logger
+
+
+def log_event(logger, event, level=logging.INFO, exc_info=False, **fields):
+    logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def current_trace():
+    """The RequestTrace of the request being handled in this context, if any."""
+    return _current_trace.get()
+
+
+class RequestTrace:
+    """
+    Instrumentation for one request. Creating it makes it the current trace
+    for this context (and tasks started from it), so the model-call helpers
+    can attribute their timings and token usage without extra parameters.
+    """
+
+    def __init__(self, endpoint, logger, **fields):
+        self.logger = logger
+        self.fields = {"endpoint": endpoint, **fields}
+        self.stages = {}
+        self.tokens = TallyCounter()
+        self.start = time.perf_counter()
+        self.finished = False
+        _current_trace.set(self)
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+    def record_prompt(self, stage, prompt):
+        PROMPT_CHARS.observe(len(prompt), stage=stage)
+        self.fields[f"{stage}_prompt_chars"] = len(prompt)
+
+    def record_usage(self, stage, response):
+        metadata = getattr(response, "usage_metadata", None)
+        if metadata is None:
+            return
+        for kind, attribute in USAGE_FIELDS.items():
+            count = getattr(metadata, attribute, None)
+            if count:
+                TOKENS.inc(count, stage=stage, kind=kind)
+                self.tokens[f"{stage}_{kind}"] += count
+
+    def finish(self, status="ok", error=None):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.start
+        endpoint = self.fields["endpoint"]
+        pipeline = self.fields.get("pipeline", "")
+        REQUESTS.inc(endpoint=endpoint, pipeline=pipeline, status=status)
+        REQUEST_SECONDS.observe(duration, endpoint=endpoint, pipeline=pipeline)
+        if error is not None:
+            ERRORS.inc(endpoint=endpoint, error_class=type(error).__name__)
+            self.fields["error_class"] = type(error).__name__
+            self.fields["error"] = str(error)[:500]
+        log_event(
+            self.logger,
+            "request",
+            level=logging.ERROR if error is not None else logging.INFO,
+            exc_info=error if error is not None else False,
+            status=status,
+            duration_ms=round(duration * 1000, 1),
+            stages_ms={name: round(s * 1000, 1) for name, s in self.stages.items()},
+            tokens=dict(self.tokens),
+            **self.fields,
+        )
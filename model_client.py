@@ -0,0 +1,38 @@
+"""
+Model client construction shared by app.py and gemini_demo.py.
+
+Both modules only rely on this part of the google-genai Client surface:
+
+- client.models.generate_content(model=..., contents=..., config=...)
+- client.aio.models.generate_content(...) / generate_content_stream(...)
+- client.aio.caches.create(...) / update(...)
+- client.aio.models.get(model=...) (app.py's startup warm-up)
+
+so any object providing it can be injected in place of the real client with
+their set_client() functions. GEMINI_BACKEND selects the default:
+"google" (the real API, needs GOOGLE_API_KEY) or "fake" (the offline
+FakeGeminiClient from fake_gemini.py, configured by FAKE_* variables).
+"""
+import os
+
+
+def create_client(backend=None):
+    backend = backend or os.environ.get("GEMINI_BACKEND", "google")
+
+    if backend == "fake":
+        from fake_gemini import FakeGeminiClient
+        return FakeGeminiClient.from_env()
+
+    if backend != "google":
+        raise ValueError(f"Unknown GEMINI_BACKEND '{backend}'. Use 'google' or 'fake'.")
+
+    from google import genai
+
+    # Get API key from environment variable
+    api_key = os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        raise ValueError(
+            "GOOGLE_API_KEY environment variable is not set. "
+            "Please set it in your .env file or environment variables."
+        )
+    return genai.Client(api_key=api_key)
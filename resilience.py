@@ -0,0 +1,393 @@
+"""
+Resilience for upstream model calls.
+
+ResilientCaller runs one logical model call as a series of attempts:
+
+- Deadline: a per-request time budget shared by every call of the request
+  (PLAN and ANSWER draw from the same budget). No attempt or backoff sleep
+  runs past it; running out raises DeadlineExceeded.
+- Retries: retryable failures (429, 5xx, timeouts, connection errors) are
+  retried with jittered exponential backoff (tenacity). Client errors such
+  as 400 or 404 are raised immediately.
+- Hedging (optional): if an attempt hasn't answered after the model's
+  observed p95 latency, a second identical request is sent and whichever
+  finishes first wins; the other is cancelled.
+- Circuit breaker: after repeated failures a model is skipped for a while,
+  then a single trial call decides whether it is healthy again.
+- Fallback chain: when a model is unavailable (circuit open or retries
+  exhausted) the next model in the chain is tried.
+
+The caller is independent of the client: `attempt(model)` performs one
+request against the given model, so the same logic can wrap
+generate_content, a stream up to its first chunk, or the fake client.
+"""
+import asyncio
+import contextvars
+import os
+import sys
+import time
+from collections import deque
+
+from tenacity import (
+    AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential,
+)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before the upstream answered."""
+
+
+class UpstreamUnavailable(Exception):
+    """Every model in the chain failed or has its circuit open."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    # google.genai and httpx take ~0.6s to import, so they aren't imported
+    # here; a client that raised one of their errors has already loaded them.
+    errors = sys.modules.get("google.genai.errors")
+    if errors is not None and isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS
+    if isinstance(error, TimeoutError):
+        return True
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(error, httpx.TransportError)
+
+
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class Deadline:
+    """Absolute time budget for one request; start() makes it current for this context."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def start(cls, seconds):
+        deadline = cls(seconds)
+        _current_deadline.set(deadline)
+        return deadline
+
+    @staticmethod
+    def current():
+        return _current_deadline.get()
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures; open ->
+    half-open after `reset_seconds`, letting one trial call through; its
+    outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.opens = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_flight or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial_in_flight:
+                self.opens += 1
+            self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+
+class ResilientCaller:
+    # Latency samples kept per model, and how many are needed before the
+    # observed p95 replaces hedge_delay
+    WINDOW = 200
+    MIN_SAMPLES = 20
+
+    def __init__(self, models, max_attempts=3, attempt_timeout=30.0, backoff_base=0.5,
+                 backoff_max=8.0, hedge=False, hedge_delay=5.0, breaker_failures=5,
+                 breaker_reset_seconds=30.0, default_deadline=60.0):
+        if not models:
+            raise ValueError("at least one model is required")
+        self.models = list(models)
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.default_deadline = default_deadline
+        self.breakers = {m: CircuitBreaker(breaker_failures, breaker_reset_seconds) for m in self.models}
+        self.latencies = {m: deque(maxlen=self.WINDOW) for m in self.models}
+        self.counters = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "fallbacks": 0,
+            "short_circuited": 0,
+            "deadline_exceeded": 0,
+            "unavailable": 0,
+        }
+
+    @classmethod
+    def from_env(cls, primary_model):
+        """Chain: primary_model followed by GEMINI_FALLBACK_MODELS (comma-separated)."""
+        fallbacks = os.environ.get("GEMINI_FALLBACK_MODELS", "gemini-2.5-flash-lite")
+        models = [primary_model]
+        models += [m.strip() for m in fallbacks.split(",") if m.strip() and m.strip() != primary_model]
+        return cls(
+            models,
+            max_attempts=int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", "3")),
+            attempt_timeout=float(os.environ.get("UPSTREAM_ATTEMPT_TIMEOUT_SECONDS", "30")),
+            backoff_base=float(os.environ.get("UPSTREAM_BACKOFF_SECONDS", "0.5")),
+            backoff_max=float(os.environ.get("UPSTREAM_BACKOFF_MAX_SECONDS", "8")),
+            hedge=os.environ.get("UPSTREAM_HEDGE", "0") == "1",
+            hedge_delay=float(os.environ.get("UPSTREAM_HEDGE_DELAY_SECONDS", "5")),
+            breaker_failures=int(os.environ.get("UPSTREAM_BREAKER_FAILURES", "5")),
+            breaker_reset_seconds=float(os.environ.get("UPSTREAM_BREAKER_RESET_SECONDS", "30")),
+            default_deadline=float(os.environ.get("REQUEST_DEADLINE_SECONDS", "60")),
+        )
+
+    @property
+    def primary(self):
+        return self.models[0]
+
+    def p95(self, model):
+        samples = self.latencies[model]
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return sorted(samples)[int(len(samples) * 0.95)]
+
+    def _chain(self):
+        """The models to try in order, skipping those whose circuit is open."""
+        for index, model in enumerate(self.models):
+            breaker = self.breakers[model]
+            if not breaker.allow():
+                self.counters["short_circuited"] += 1
+                continue
+            if index > 0:
+                self.counters["fallbacks"] += 1
+            try:
+                yield model
+            finally:
+                # A half-open trial ending without a verdict (deadline,
+                # cancellation, client error) must not block later trials
+                breaker.trial_in_flight = False
+
+    def _model_failed(self, error):
+        """Re-raise errors that another model can't fix; otherwise return the error."""
+        if isinstance(error, DeadlineExceeded):
+            self.counters["deadline_exceeded"] += 1
+            raise error
+        if not is_retryable(error):
+            raise error
+        return error
+
+    def _unavailable(self, last_error):
+        self.counters["unavailable"] += 1
+        retry_after = min(b.retry_after() for b in self.breakers.values())
+        return UpstreamUnavailable(
+            f"All models unavailable ({', '.join(self.models)})"
+            + (f": {last_error}" if last_error else ""),
+            retry_after=retry_after or None,
+        )
+
+    def _retry_policy(self, deadline):
+        def out_of_time(retry_state):
+            return deadline.remaining() <= retry_state.upcoming_sleep
+
+        return {
+            "stop": stop_after_attempt(self.max_attempts) | out_of_time,
+            "wait": wait_random_exponential(multiplier=self.backoff_base, max=self.backoff_max),
+            "retry": retry_if_exception(is_retryable),
+            "reraise": True,
+        }
+
+    def _check_deadline(self, deadline):
+        if deadline.remaining() <= 0:
+            raise DeadlineExceeded(f"request deadline of {deadline.seconds:g}s exceeded")
+
+    async def call(self, attempt, deadline=None, discard=None):
+        """
+        Return the first successful `await attempt(model)` across retries,
+        hedges and fallback models. `discard(result)` releases the result of
+        a losing hedge that completed anyway (e.g. closes a stream).
+        """
+        deadline = deadline or Deadline.current() or Deadline(self.default_deadline)
+        self.counters["calls"] += 1
+        last_error = None
+        chain = self._chain()
+        try:
+            for model in chain:
+                try:
+                    return await self._call_model(model, attempt, deadline, discard)
+                except Exception as e:
+                    last_error = self._model_failed(e)
+        finally:
+            chain.close()
+        raise self._unavailable(last_error) from last_error
+
+    def call_sync(self, attempt, deadline=None):
+        """
+        Blocking variant of call() for the synchronous client. There is no
+        hedging, and the attempt itself must bound its duration (e.g. with
+        the client's http timeout); the deadline is checked between attempts.
+        """
+        deadline = deadline or Deadline.current() or Deadline(self.default_deadline)
+        self.counters["calls"] += 1
+        last_error = None
+        chain = self._chain()
+        try:
+            for model in chain:
+                try:
+                    return self._call_model_sync(model, attempt, deadline)
+                except Exception as e:
+                    last_error = self._model_failed(e)
+        finally:
+            chain.close()
+        raise self._unavailable(last_error) from last_error
+
+    async def _call_model(self, model, attempt, deadline, discard):
+        breaker = self.breakers[model]
+        async for attempt_state in AsyncRetrying(**self._retry_policy(deadline)):
+            with attempt_state:
+                if attempt_state.retry_state.attempt_number > 1:
+                    self.counters["retries"] += 1
+                self._check_deadline(deadline)
+                timeout = min(self.attempt_timeout, deadline.remaining())
+                try:
+                    result = await self._hedged(model, attempt, timeout, discard)
+                except Exception as e:
+                    if is_retryable(e):
+                        breaker.record_failure()
+                        if isinstance(e, TimeoutError):
+                            self._check_deadline(deadline)
+                    raise
+                breaker.record_success()
+                return result
+
+    def _call_model_sync(self, model, attempt, deadline):
+        breaker = self.breakers[model]
+        for attempt_state in Retrying(**self._retry_policy(deadline)):
+            with attempt_state:
+                if attempt_state.retry_state.attempt_number > 1:
+                    self.counters["retries"] += 1
+                self._check_deadline(deadline)
+                self.counters["attempts"] += 1
+                started = time.monotonic()
+                try:
+                    result = attempt(model)
+                except Exception as e:
+                    if is_retryable(e):
+                        breaker.record_failure()
+                    raise
+                self.latencies[model].append(time.monotonic() - started)
+                breaker.record_success()
+                return result
+
+    async def _hedged(self, model, attempt, timeout, discard):
+        """One attempt, plus a hedged duplicate if the first is slower than usual."""
+        started = time.monotonic()
+        give_up_at = started + timeout
+        hedge_at = None
+        if self.hedge:
+            hedge_at = started + (self.p95(model) or self.hedge_delay)
+
+        def launch():
+            self.counters["attempts"] += 1
+            task = asyncio.ensure_future(attempt(model))
+            starts[task] = time.monotonic()
+            return task
+
+        starts = {}
+        first = launch()
+        pending = {first}
+        error = None
+        try:
+            while pending:
+                wake_at = give_up_at if hedge_at is None else min(give_up_at, hedge_at)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(wake_at - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies[model].append(time.monotonic() - starts[task])
+                        if task is not first:
+                            self.counters["hedge_wins"] += 1
+                        for other in done - {task}:
+                            self._release(other, discard)
+                        return task.result()
+                    error = task.exception()
+                now = time.monotonic()
+                if now >= give_up_at:
+                    raise TimeoutError(f"{model} did not answer within {timeout:.1f}s")
+                if hedge_at is not None and now >= hedge_at and pending:
+                    hedge_at = None
+                    self.counters["hedges"] += 1
+                    pending.add(launch())
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(lambda t: self._release(t, discard))
+
+    @staticmethod
+    def _release(task, discard):
+        """Retrieve a losing task's outcome, releasing its result if it has one."""
+        if task.cancelled():
+            return
+        if task.exception() is None and discard is not None:
+            discard(task.result())
+
+    def stats(self):
+        return {
+            **self.counters,
+            "models": {
+                model: {
+                    "circuit": breaker.state,
+                    "consecutive_failures": breaker.failures,
+                    "circuit_opens": breaker.opens,
+                    "latency_p95": self.p95(model),
+                }
+                for model, breaker in self.breakers.items()
+            },
+        }
@@ -1,6 +1,16 @@
-// Generate unique session ID
+// Generate unique session ID. Every request carries it in X-Session-Id too,
+// so serve.py routes the whole conversation to the same worker.
 const sessionId = 'session_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
 
+// Idempotency key for one turn: retries of the same message reuse it so the
+// server answers them from a single model call
+function newRequestId() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return 'req_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
+}
+
 // DOM elements
 const welcomeMessage = document.getElementById('welcomeMessage');
 const messagesContainer = document.getElementById('messages');
@@ -54,7 +64,13 @@ function addMessage(sender, text) {
 
     messagesContainer.appendChild(messageDiv);
 
-    // Scroll to bottom smoothly
+    scrollToBottom();
+
+    return content;
+}
+
+// Scroll to bottom smoothly
+function scrollToBottom() {
     setTimeout(() => {
         messagesContainer.parentElement.scrollTo({
             top: messagesContainer.parentElement.scrollHeight,
@@ -67,23 +83,46 @@ function addMessage(sender, text) {
 function setTyping(isTyping) {
     if (isTyping) {
         typingIndicator.classList.add('active');
-        setTimeout(() => {
-            messagesContainer.parentElement.scrollTo({
-                top: messagesContainer.parentElement.scrollHeight,
-                behavior: 'smooth'
-            });
-        }, 100);
+        scrollToBottom();
     } else {
         typingIndicator.classList.remove('active');
     }
 }
 
+// The chat request in flight. A newer message or a reset aborts it, and the
+// server stops generating an answer nobody is going to read.
+let activeRequest = null;
+
+function cancelActiveRequest(notifyServer) {
+    if (!activeRequest) return;
+    activeRequest.controller.abort();
+    if (notifyServer) {
+        // Closing the connection already stops the turn; this also covers a
+        // request that is between retries or shares its turn with a retry
+        fetch('/cancel', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Session-Id': sessionId,
+            },
+            body: JSON.stringify({
+                session_id: sessionId,
+                request_id: activeRequest.requestId
+            })
+        }).catch(error => console.error('Error cancelling request:', error));
+    }
+    activeRequest = null;
+}
+
 // Send message to backend
 async function sendMessage() {
     const message = userInput.value.trim();
 
     if (!message) return;
 
+    // A newer message supersedes the one still being answered
+    cancelActiveRequest(true);
+
     // Add user message
     addMessage('user', message);
 
@@ -96,55 +135,166 @@ async function sendMessage() {
     // Show typing indicator
     setTyping(true);
 
-    try {
-        const response = await fetch('/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                message: message,
-                session_id: sessionId
-            })
-        });
+    const request = { controller: new AbortController(), requestId: newRequestId() };
+    activeRequest = request;
+    const signal = request.controller.signal;
+    const requestBody = JSON.stringify({
+        message: message,
+        session_id: sessionId,
+        request_id: request.requestId
+    });
 
-        if (!response.ok) {
-            throw new Error('Network response was not ok');
+    try {
+        let response;
+        try {
+            response = await postChat(requestBody, signal);
+        } catch (networkError) {
+            // Retry once with the same request_id; the server won't answer twice
+            response = await postChat(requestBody, signal);
         }
 
-        const data = await response.json();
+        // Server is busy: wait as told and try once more if the wait is short
+        if (response.status === 429) {
+            const waitSeconds = retryAfterSeconds(response);
+            if (waitSeconds <= MAX_AUTO_RETRY_SECONDS) {
+                await sleep(waitSeconds * 1000);
+                response = await postChat(requestBody, signal);
+            }
+        }
 
-        // Hide typing indicator
-        setTyping(false);
+        if (response.status === 429) {
+            const waitSeconds = retryAfterSeconds(response);
+            setTyping(false);
+            addMessage('counselor', `I'm receiving a lot of messages right now. Please wait about ${waitSeconds} seconds and send your message again.`);
+            // Give the unsent message back so it doesn't have to be retyped
+            userInput.value = message;
+            charCount.textContent = message.length;
+            sendButton.disabled = false;
+            userInput.focus();
+            return;
+        }
 
-        // Backend handles chain-of-thought internally and returns only the final ANSWER
-        if (data.task === "ANSWER") {
-            addMessage('counselor', data.prompt);
-        } else {
-            // Fallback for any other response type
-            addMessage('counselor', data.prompt || 'Sorry, I encountered an error. Please try again.');
+        if (!response.ok || !response.body) {
+            throw new Error('Network response was not ok');
         }
 
+        await readAnswerStream(response);
+
     } catch (error) {
+        if (error.name === 'AbortError') {
+            return;  // superseded or reset; whoever aborted owns the UI now
+        }
         setTyping(false);
         addMessage('counselor', 'Sorry, I encountered an error. Please try again.');
         console.error('Error:', error);
+    } finally {
+        if (activeRequest === request) {
+            activeRequest = null;
+        }
     }
 
     userInput.focus();
 }
 
+// Longest Retry-After we wait out automatically before asking the user to resend
+const MAX_AUTO_RETRY_SECONDS = 5;
+
+function retryAfterSeconds(response) {
+    const seconds = parseInt(response.headers.get('Retry-After'), 10);
+    return Number.isFinite(seconds) && seconds > 0 ? seconds : 1;
+}
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+function postChat(body, signal) {
+    return fetch('/chat/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-Session-Id': sessionId,
+        },
+        body: body,
+        signal: signal
+    });
+}
+
+// Render a Server-Sent Events ANSWER stream into a single message bubble.
+// The bubble is created on the first token so the typing indicator stays
+// visible while the backend is still working on the PLAN stage. A "safety"
+// event (crisis helplines, sent before the model answers) gets its own
+// bubble right away.
+async function readAnswerStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let bubble = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            const dataLine = rawEvent.split('\n').find(line => line.startsWith('data: '));
+            if (!dataLine) continue;
+
+            const event = JSON.parse(dataLine.slice(6));
+
+            if (event.type === 'safety') {
+                addMessage('counselor', event.text).classList.add('safety');
+                setTyping(true);
+            } else if (event.type === 'token') {
+                if (!bubble) {
+                    setTyping(false);
+                    bubble = addMessage('counselor', '');
+                }
+                bubble.textContent += event.text;
+                scrollToBottom();
+            } else if (event.type === 'cancelled') {
+                // Stopped on the server, e.g. reset from another tab
+                setTyping(false);
+                return;
+            } else if (event.type === 'error') {
+                setTyping(false);
+                if (bubble) {
+                    bubble.textContent = event.detail;
+                } else {
+                    addMessage('counselor', event.detail);
+                }
+                return;
+            }
+        }
+    }
+
+    if (!bubble) {
+        throw new Error('Stream ended without a response');
+    }
+}
+
 // Reset conversation
 async function resetConversation() {
     if (!confirm('Are you sure you want to start a new conversation? This will clear the current chat history.')) {
         return;
     }
 
+    // /reset also stops the turn on the server
+    cancelActiveRequest(false);
+    setTyping(false);
+
     try {
         await fetch('/reset', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Session-Id': sessionId,
             },
             body: JSON.stringify({
                 session_id: sessionId
@@ -0,0 +1,367 @@
+"""
+Opt-in multi-worker launcher with a session-affine dispatcher.
+
+Runs several uvicorn worker processes behind one dispatcher process. The
+default deploy (Procfile, render.yaml) runs app.py in one process; switch to
+this only where bench_workers.py shows more workers beating one, since every
+request also passes through the dispatcher.
+
+Conversation history (with the default memory session store), the per-session
+turn locks, idempotency keys, pending crisis follow-ups and per-session rate
+limits all live in the worker process that handles a session. Plain
+multi-worker uvicorn spreads connections over workers at random and would
+split a session's state between them, so instead:
+
+- each worker serves app.py on its own Unix socket;
+- this process listens on PORT and forwards each request to the worker that
+  owns its session, by consistent hashing of the session id (the
+  X-Session-Id header, else "session_id" in the JSON body). Requests
+  without a session (the page, assets, /stats) go round robin. Consistent
+  hashing means a change in the worker count moves only about 1/N of the
+  sessions;
+- /healthz and /readyz are answered here: ready once every worker is;
+- workers that exit are restarted.
+
+Settings:
+
+- workers: --workers, else WEB_CONCURRENCY, else the CPUs this process may
+  run on. With one worker app.py is served directly, without the dispatcher.
+- PORT (default 8000) and HOST (default 0.0.0.0).
+- uvloop and httptools are used when installed, asyncio and h11 otherwise.
+
+/stats and /metrics are per worker; the X-Worker response header tells
+which worker answered.
+
+Usage:
+    python serve.py [--workers N] [--port PORT]
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import uvicorn
+
+from metrics import get_logger, log_event
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+logger = get_logger("counselor.serve")
+
+# Points per worker on the hash ring; more spread sessions more evenly
+VIRTUAL_NODES = 64
+# Request bodies larger than this are not parsed for a session_id
+MAX_SNIFF_BYTES = 64 * 1024
+# How long a request waits for its worker to (re)start before a 502
+WORKER_CONNECT_TIMEOUT = float(os.environ.get("WORKER_CONNECT_TIMEOUT", "30"))
+
+HOP_BY_HOP = {
+    b"connection", b"keep-alive", b"proxy-authenticate", b"proxy-authorization",
+    b"te", b"trailer", b"transfer-encoding", b"upgrade",
+}
+
+
+def cpu_count():
+    """CPUs this process may use: its affinity mask, capped by a container's (cgroup v2) CPU quota."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            count = min(count, max(math.ceil(int(quota) / int(period)), 1))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def worker_count():
+    return int(os.environ.get("WEB_CONCURRENCY") or cpu_count())
+
+
+def event_loop():
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def http_protocol():
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, with virtual nodes for an even spread."""
+
+    def __init__(self, nodes, replicas=VIRTUAL_NODES):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def session_key(headers, body):
+    """
+    The session id a request belongs to, or None. A JSON body without a
+    session_id belongs to the app's "default" session.
+    """
+    for name, value in headers:
+        if name == b"x-session-id" and value:
+            return value.decode("latin-1")
+    if not body.startswith(b"{") or len(body) > MAX_SNIFF_BYTES:
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    session_id = payload.get("session_id", "default")
+    return session_id if isinstance(session_id, str) else None
+
+
+class Worker:
+    """One uvicorn process serving app.py on a Unix socket."""
+
+    def __init__(self, index, socket_path, env):
+        self.index = index
+        self.socket_path = socket_path
+        self.env = env
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--uds", self.socket_path,
+             "--loop", event_loop(), "--http", http_protocol()],
+            cwd=HERE, env=self.env,
+        )
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout=10):
+        if not self.alive:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Dispatcher:
+    """ASGI app forwarding requests to workers, keeping each session on one worker."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.ring = HashRing(range(len(workers)))
+        self._round_robin = itertools.cycle(range(len(workers)))
+        self.clients = [
+            httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=worker.socket_path),
+                base_url="http://worker",
+                timeout=None,  # workers enforce their own deadlines; streams stay open
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=256),
+            )
+            for worker in workers
+        ]
+        self._supervisor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/healthz":
+                await respond(send, 200, {"status": "ok"})
+            elif scope["path"] == "/readyz":
+                await self.readyz(send)
+            else:
+                await self.forward(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._supervisor = asyncio.create_task(self.supervise())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._supervisor.cancel()
+                for client in self.clients:
+                    await client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def supervise(self):
+        """Restart workers that exited."""
+        while True:
+            await asyncio.sleep(1)
+            for worker in self.workers:
+                if not worker.alive:
+                    log_event(logger, "worker_restart", logging.WARNING, worker=worker.index,
+                              returncode=worker.process.returncode)
+                    worker.restarts += 1
+                    worker.start()
+
+    async def readyz(self, send):
+        async def probe(client):
+            try:
+                response = await client.get("/readyz", timeout=5)
+                return response.status_code == 200, response.json().get("status")
+            except (httpx.HTTPError, ValueError) as e:
+                return False, type(e).__name__
+
+        results = await asyncio.gather(*(probe(client) for client in self.clients))
+        body = {
+            "status": "ready" if all(ok for ok, _ in results) else "starting",
+            "workers": [status for _, status in results],
+        }
+        await respond(send, 200 if body["status"] == "ready" else 503, body)
+
+    async def forward(self, scope, receive, send):
+        body = await read_body(receive)
+        key = session_key(scope["headers"], body)
+        index = self.ring.node(key) if key is not None else next(self._round_robin)
+        client = self.clients[index]
+
+        url = scope["path"]
+        if scope["query_string"]:
+            url += "?" + scope["query_string"].decode("latin-1")
+        headers = forwarded_headers(scope["headers"], scope.get("client"))
+        request = client.build_request(scope["method"], url, headers=headers, content=body)
+
+        response = await self.connect(client, request)
+        if response is None:
+            await respond(send, 502, {"detail": "Worker unavailable"})
+            return
+        # Stop relaying once the client is gone, so closing the upstream
+        # connection lets the worker cancel the turn (see turns.py)
+        relay = asyncio.ensure_future(relay_response(response, send, index))
+        watcher = asyncio.ensure_future(until_disconnected(receive))
+        try:
+            await asyncio.wait((relay, watcher), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            relay.cancel()
+            watcher.cancel()
+            await response.aclose()
+        if relay.done() and not relay.cancelled():
+            relay.result()
+
+    async def connect(self, client, request):
+        """Send `request`, waiting for a worker that is (re)starting; None if it never comes up."""
+        give_up_at = time.monotonic() + WORKER_CONNECT_TIMEOUT
+        while True:
+            try:
+                return await client.send(request, stream=True)
+            except httpx.ConnectError:
+                if time.monotonic() >= give_up_at:
+                    return None
+                await asyncio.sleep(0.05)
+
+
+def forwarded_headers(headers, client):
+    """
+    Request headers for a worker: hop-by-hop headers dropped, and the peer's
+    address appended to X-Forwarded-For. Any X-Forwarded-For the request
+    came with is merged into the one header, because the app reads only the
+    first and counts hops from its right end (admission.client_address).
+    """
+    forwarded = [value for name, value in headers if name == b"x-forwarded-for"]
+    forwarded.append(client[0].encode("latin-1") if client else b"unknown")
+    kept = [(name, value) for name, value in headers
+            if name not in HOP_BY_HOP and name != b"x-forwarded-for"]
+    return kept + [(b"x-forwarded-for", b", ".join(forwarded))]
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def until_disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def relay_response(response, send, worker_index):
+    headers = [(name, value) for name, value in response.headers.raw if name.lower() not in HOP_BY_HOP]
+    headers.append((b"x-worker", str(worker_index).encode()))
+    await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    async for chunk in response.aiter_raw():
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def respond(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def worker_env():
+    env = dict(os.environ)
+    # The dispatcher appends the client address to X-Forwarded-For
+    env["FORWARDED_HOPS"] = str(int(env.get("FORWARDED_HOPS", "0")) + 1)
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=worker_count())
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    args = parser.parse_args()
+
+    log_event(logger, "serve_start", workers=args.workers, host=args.host, port=args.port,
+              loop=event_loop(), http=http_protocol())
+    if args.workers <= 1:
+        uvicorn.run("app:app", host=args.host, port=args.port,
+                    loop=event_loop(), http=http_protocol())
+        return
+
+    socket_dir = tempfile.mkdtemp(prefix="counselor-")
+    env = worker_env()
+    workers = [Worker(i, os.path.join(socket_dir, f"worker-{i}.sock"), env)
+               for i in range(args.workers)]
+    try:
+        for worker in workers:
+            worker.start()
+        # Workers log requests and set Date/Server, so the dispatcher doesn't.
+        # The peer address must stay the real one: forwarded_headers() adds it.
+        uvicorn.run(Dispatcher(workers), host=args.host, port=args.port,
+                    loop=event_loop(), http=http_protocol(), access_log=False,
+                    server_header=False, date_header=False, proxy_headers=False)
+    finally:
+        for worker in workers:
+            worker.stop()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Session stores for per-session conversation state.
+
+Values are any JSON-serializable object (the app stores its conversation
+history). Two implementations are provided:
+
+- MemorySessionStore: in-process LRU with a TTL and caps on session count and
+  bytes held. Fast, but each worker process has its own copy.
+- SQLiteSessionStore: a local SQLite file that several worker processes on
+  the same machine can share. Its calls block on file I/O and on other
+  processes' writes (`blocking` is True), so async code runs them in a thread.
+
+Use create_session_store() to build the one selected by environment variables.
+"""
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def encoded_size(session_id, value):
+    """Approximate bytes held for one session (key + JSON payload)."""
+    return len(session_id.encode("utf-8")) + len(json.dumps(value).encode("utf-8"))
+
+
+class SessionStore(abc.ABC):
+    """Interface shared by all session stores."""
+
+    # Whether calls may block the calling thread on I/O
+    blocking = False
+
+    @abc.abstractmethod
+    def get(self, session_id):
+        """Return the stored value, or None if missing or expired."""
+
+    @abc.abstractmethod
+    def put(self, session_id, value):
+        pass
+
+    @abc.abstractmethod
+    def update(self, session_id, change):
+        """
+        Atomically replace the value with change(value), where value is None
+        if missing or expired. If change returns None, nothing is written.
+        Returns what change returned.
+        """
+
+    @abc.abstractmethod
+    def delete(self, session_id):
+        pass
+
+    @abc.abstractmethod
+    def stats(self):
+        """Counters for monitoring: sessions, bytes, evictions, expirations."""
+
+
+class MemorySessionStore(SessionStore):
+    """
+    LRU + TTL store kept in process memory.
+
+    The least recently used sessions are evicted once either `max_sessions` or
+    `max_bytes` is exceeded, and sessions idle for longer than `ttl_seconds`
+    are dropped.
+    """
+
+    def __init__(self, max_sessions=10000, max_bytes=64 * 1024 * 1024, ttl_seconds=86400):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # session_id -> (value, size, expires_at)
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        value, size, expires_at = entry
+        if time.monotonic() >= expires_at:
+            self._remove(session_id)
+            self.expirations += 1
+            return None
+        self._entries[session_id] = (value, size, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(session_id)
+        return value
+
+    def put(self, session_id, value):
+        self._remove(session_id)
+        size = encoded_size(session_id, value)
+        self._entries[session_id] = (value, size, time.monotonic() + self.ttl_seconds)
+        self._bytes += size
+        self._expire()
+        while self._entries and (
+            len(self._entries) > self.max_sessions or self._bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def update(self, session_id, change):
+        value = change(self.get(session_id))
+        if value is not None:
+            self.put(session_id, value)
+        return value
+
+    def delete(self, session_id):
+        self._remove(session_id)
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _expire(self):
+        # Entries are in LRU order, so expired ones are at the front
+        now = time.monotonic()
+        while self._entries:
+            oldest, (_, _, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._remove(oldest)
+            self.expirations += 1
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "sessions": len(self._entries),
+            "bytes": self._bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store backed by a local SQLite file in WAL mode, so several
+    worker processes on one machine see the same sessions. A write waits for
+    other processes' writes (up to `busy_timeout` seconds), so callers on an
+    event loop run get/put/update/delete in a thread.
+
+    The TTL/size sweep runs every SWEEP_EVERY writes in a background thread
+    with its own connection. Session count and size are kept up to date by
+    triggers in a one-row table shared by all processes; stats() (run on
+    every /metrics scrape) reads it over a separate connection, which in WAL
+    mode never waits for writers.
+    """
+
+    blocking = True
+    # Run the TTL/size sweep once every this many writes
+    SWEEP_EVERY = 100
+
+    def __init__(self, path="sessions.db", max_sessions=100000, ttl_seconds=86400, busy_timeout=10):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.busy_timeout = busy_timeout
+        self.evictions = 0
+        self.expirations = 0
+        self._writes = 0
+        self._sweeper = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS session_totals ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " sessions INTEGER NOT NULL,"
+                " bytes INTEGER NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS sessions_insert AFTER INSERT ON sessions BEGIN"
+                " UPDATE session_totals SET sessions = sessions + 1,"
+                " bytes = bytes + LENGTH(NEW.id) + LENGTH(NEW.data) WHERE id = 0; END"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS sessions_update AFTER UPDATE OF data ON sessions BEGIN"
+                " UPDATE session_totals SET"
+                " bytes = bytes + LENGTH(NEW.data) - LENGTH(OLD.data) WHERE id = 0; END"
+            )
+            self._db.execute(
+                "CREATE TRIGGER IF NOT EXISTS sessions_delete AFTER DELETE ON sessions BEGIN"
+                " UPDATE session_totals SET sessions = sessions - 1,"
+                " bytes = bytes - LENGTH(OLD.id) - LENGTH(OLD.data) WHERE id = 0; END"
+            )
+            # Once per database: count the sessions written before the triggers existed
+            self._db.execute(
+                "INSERT OR IGNORE INTO session_totals (id, sessions, bytes)"
+                " SELECT 0, COUNT(*), COALESCE(SUM(LENGTH(id) + LENGTH(data)), 0) FROM sessions"
+            )
+        self._stats_db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+
+    def get(self, session_id):
+        with self._lock, self._db:
+            return self._read(session_id)
+
+    def put(self, session_id, value):
+        with self._lock, self._db:
+            self._write(session_id, value)
+
+    def update(self, session_id, change):
+        with self._lock, self._db:
+            # Take the write lock first, so no other process writes in between
+            self._db.execute("BEGIN IMMEDIATE")
+            value = change(self._read(session_id))
+            if value is not None:
+                self._write(session_id, value)
+        return value
+
+    def delete(self, session_id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _read(self, session_id):
+        row = self._db.execute(
+            "SELECT data, updated_at FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] < time.time() - self.ttl_seconds:
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self.expirations += 1
+            return None
+        return json.loads(row[0])
+
+    def _write(self, session_id, value):
+        self._db.execute(
+            "INSERT INTO sessions (id, data, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET data = excluded.data,"
+            " updated_at = excluded.updated_at",
+            (session_id, json.dumps(value), time.time()),
+        )
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0 and not self.sweeping:
+            self._sweeper = threading.Thread(target=self.sweep, name="session-sweep", daemon=True)
+            self._sweeper.start()
+
+    @property
+    def sweeping(self):
+        return self._sweeper is not None and self._sweeper.is_alive()
+
+    def sweep(self):
+        """Drop expired sessions, then the least recently updated beyond max_sessions."""
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        try:
+            with db:
+                expired = db.execute(
+                    "DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl_seconds,)
+                ).rowcount
+            with db:
+                overflow = db.execute(
+                    "DELETE FROM sessions WHERE id IN ("
+                    " SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_sessions,),
+                ).rowcount
+        finally:
+            db.close()
+        with self._lock:
+            self.expirations += expired
+            self.evictions += overflow
+
+    def close(self):
+        if self._sweeper is not None:
+            self._sweeper.join()
+        self._db.close()
+        self._stats_db.close()
+
+    def stats(self):
+        count, size = self._stats_db.execute(
+            "SELECT sessions, bytes FROM session_totals WHERE id = 0"
+        ).fetchone()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "sessions": count,
+            "bytes": size,
+            "max_sessions": self.max_sessions,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def create_session_store():
+    """Build the session store configured through environment variables."""
+    backend = os.environ.get("SESSION_STORE", "memory")
+    ttl_seconds = int(os.environ.get("SESSION_TTL_SECONDS", "86400"))
+    if backend == "sqlite":
+        return SQLiteSessionStore(
+            path=os.environ.get("SESSION_DB_PATH", "sessions.db"),
+            max_sessions=int(os.environ.get("SESSION_MAX_COUNT", "100000")),
+            ttl_seconds=ttl_seconds,
+        )
+    if backend == "memory":
+        return MemorySessionStore(
+            max_sessions=int(os.environ.get("SESSION_MAX_COUNT", "10000")),
+            max_bytes=int(os.environ.get("SESSION_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl_seconds=ttl_seconds,
+        )
+    raise ValueError(f"Unknown SESSION_STORE '{backend}'. Use 'memory' or 'sqlite'.")
@@ -0,0 +1,145 @@
+"""
+Static assets served from memory with fingerprinting and precompression.
+
+At startup each asset is read once, given a content-hash name
+(styles.css -> /assets/styles.<hash>.css) and compressed to brotli and gzip
+(gzip only if the `brotli` package from requirements.txt is missing). The
+HTML page is rewritten to reference the hashed names, so those can be cached
+forever (Cache-Control: immutable) and a changed file simply gets a new URL.
+The page itself and the legacy unhashed URLs are revalidated with strong ETags and
+answered with 304 Not Modified when unchanged.
+"""
+import gzip
+import hashlib
+import mimetypes
+import re
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # in requirements.txt; without it, gzip only
+    brotli = None
+
+ASSET_PREFIX = "/assets/"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# Smaller bodies aren't worth compressing
+MIN_COMPRESS_BYTES = 256
+
+
+def compress(body):
+    """Precompressed representations of `body`, best first, only when smaller."""
+    encodings = {}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body, quality=11)
+    encodings["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+    return {name: data for name, data in encodings.items()
+            if len(body) >= MIN_COMPRESS_BYTES and len(data) < len(body)}
+
+
+def accepted_encodings(header):
+    """Content codings the client accepts (q > 0) from an Accept-Encoding header."""
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        if name and quality > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def etag_matches(header, etag):
+    """If-None-Match comparison (weak comparison, as RFC 9110 requires for it)."""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in tags
+
+
+class Asset:
+    def __init__(self, name, body):
+        self.name = name
+        self.body = body
+        self.media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or name.endswith(".js"):
+            self.media_type += "; charset=utf-8"
+        self.digest = hashlib.sha256(body).hexdigest()
+        stem, dot, suffix = name.rpartition(".")
+        self.hashed_name = f"{stem}.{self.digest[:12]}.{suffix}" if dot else f"{name}.{self.digest[:12]}"
+        self.encodings = compress(body)
+
+    def representation(self, accept_encoding):
+        """(body, content coding or None, strong ETag) for this request."""
+        accepted = accepted_encodings(accept_encoding)
+        for coding, data in self.encodings.items():
+            if coding in accepted:
+                # Each representation needs its own strong validator
+                return data, coding, f'"{self.digest[:32]}-{coding}"'
+        return self.body, None, f'"{self.digest[:32]}"'
+
+
+class StaticAssets:
+    """
+    Serves `page` (the HTML entry point) and `files` from `root`, with
+    references to `files` in the page rewritten to their hashed URLs.
+    """
+
+    def __init__(self, root, page="index.html", files=("styles.css", "script.js")):
+        self.assets = {}
+        for name in files:
+            self.assets[name] = Asset(name, (root / name).read_bytes())
+        self.by_hashed_name = {asset.hashed_name: asset for asset in self.assets.values()}
+
+        html = (root / page).read_text(encoding="utf-8")
+        for name, asset in self.assets.items():
+            html = re.sub(
+                rf'((?:href|src)=["\'])/?{re.escape(name)}(["\'])',
+                rf"\g<1>{ASSET_PREFIX}{asset.hashed_name}\g<2>",
+                html,
+            )
+        self.assets[page] = Asset(page, html.encode("utf-8"))
+
+    def url(self, name):
+        return ASSET_PREFIX + self.assets[name].hashed_name
+
+    def respond(self, asset, request, cache_control):
+        body, coding, etag = asset.representation(request.headers.get("accept-encoding"))
+        headers = {
+            "ETag": etag,
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        return Response(body, media_type=asset.media_type, headers=headers)
+
+    def serve(self, name, request):
+        """An asset by its original name; revalidated on every use."""
+        return self.respond(self.assets[name], request, REVALIDATE)
+
+    def serve_hashed(self, hashed_name, request):
+        """An asset by its fingerprinted name; cacheable forever."""
+        asset = self.by_hashed_name.get(hashed_name)
+        if asset is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return self.respond(asset, request, IMMUTABLE)
+
+    def stats(self):
+        return {
+            "assets": len(self.assets),
+            "bytes": sum(len(a.body) for a in self.assets.values()),
+            "gzip_bytes": sum(len(a.encodings.get("gzip", a.body)) for a in self.assets.values()),
+            "brotli": brotli is not None,
+        }
@@ -1,9 +1,13 @@
-from google import genai
 import os
-
-# Import the counselor function
 import sys
-sys.path.insert(0, '/Users/anirudhkumar/.gemini/antigravity/scratch')
+
+# Run offline against the fake backend with: python test_counselor.py --fake
+if "--fake" in sys.argv:
+    os.environ["GEMINI_BACKEND"] = "fake"
+    os.environ.setdefault("FAKE_LATENCY_MS", "200")
+
+# Import the counselor function from this directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from gemini_demo import get_counselor_response
 
 print("="*70)
@@ -0,0 +1,215 @@
+"""
+Coordination of chat turns within one worker process.
+
+- SessionLocks serializes turns of the same session, so each turn sees the
+  history committed by the previous one instead of a stale snapshot.
+- Turn runs one chat turn as its own task and records the events it
+  publishes, so any number of requests can follow it (and replay it).
+- TurnRegistry maps (session_id, request_id) idempotency keys to turns:
+  a duplicate submission of a request that is in flight, or that finished
+  recently, joins the existing turn instead of calling the model again.
+  It also cancels a session's turns in flight, e.g. when it is reset.
+
+A turn is cancelled once every request following it has gone away (the
+browser disconnected or aborted), so no model calls are spent on answers
+nobody will read. A turn nobody has followed yet keeps running.
+"""
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+
+class SessionLocks:
+    """One asyncio.Lock per session, dropped again once nobody holds or waits on it."""
+
+    def __init__(self):
+        self._locks = {}  # session_id -> [lock, holders + waiters]
+
+    @asynccontextmanager
+    async def hold(self, session_id):
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[session_id]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class TurnCancelled(Exception):
+    """The turn a request was following was cancelled, e.g. by a reset."""
+
+    def __init__(self, reason):
+        super().__init__(f"turn cancelled ({reason})")
+        self.reason = reason
+
+
+class Turn:
+    """
+    A chat turn running as its own task.
+
+    `produce(turn)` does the work, may call turn.publish() for streamed
+    events and returns the turn's result. Followers either wait for the result
+    or iterate the events; when the last one goes away before the turn is
+    done, the turn is cancelled.
+    """
+
+    def __init__(self, produce):
+        self.events = []
+        self.done = False
+        self.followers = 0
+        self.cancel_reason = None
+        self.keep_failed = False
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(produce))
+
+    async def _run(self, produce):
+        try:
+            return await produce(self)
+        finally:
+            self.done = True
+            self._notify()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def cancel(self, reason):
+        """Cancel the turn if it is still running; returns whether it was."""
+        if self.task.done():
+            return False
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+        self.task.cancel()
+        return True
+
+    @contextmanager
+    def _following(self):
+        self.followers += 1
+        try:
+            yield
+        finally:
+            self.followers -= 1
+            if self.followers == 0:
+                self.cancel("abandoned")
+
+    async def wait(self):
+        """
+        The turn's result (or exception). Being cancelled ourselves doesn't
+        cancel the turn unless we were its last follower; if the turn itself
+        is cancelled, TurnCancelled is raised.
+        """
+        with self._following():
+            try:
+                return await asyncio.shield(self.task)
+            except asyncio.CancelledError:
+                if self.task.cancelled() and not asyncio.current_task().cancelling():
+                    raise TurnCancelled(self.cancel_reason) from None
+                raise
+
+    async def follow(self):
+        """Yield every published event from the start, then new ones as they arrive."""
+        with self._following():
+            index = 0
+            while True:
+                changed = self._changed
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    return
+                await changed.wait()
+
+    @property
+    def succeeded(self):
+        return self.task.done() and not self.task.cancelled() and self.task.exception() is None
+
+
+class TurnRegistry:
+    """Shares turns between duplicate submissions of the same idempotency key."""
+
+    def __init__(self, max_completed=1024):
+        self.max_completed = max_completed
+        self._inflight = {}
+        self._completed = OrderedDict()
+        self._sessions = {}  # session_id -> {turn: key} of turns in flight
+        self.counters = {
+            "turns": 0,
+            "coalesced": 0,
+            "replayed": 0,
+            "cancelled": 0,
+        }
+
+    def find(self, key):
+        """The in-flight or recently completed turn for `key`, or None."""
+        return self._inflight.get(key) or self._completed.get(key)
+
+    def start(self, key, produce, keep_failed=False):
+        """
+        Return the turn for `key`, starting `produce` only if no turn for it
+        is in flight or recently completed. A key whose request id is None is
+        never shared. With `keep_failed`, a turn that fails or is cancelled
+        stays findable (until evicted like completed turns) so its outcome
+        can still be fetched; starting the key again runs a new turn.
+        """
+        turn = self._completed.get(key)
+        if turn is not None and turn.succeeded:
+            self._completed.move_to_end(key)
+            self.counters["replayed"] += 1
+            return turn
+        self._completed.pop(key, None)
+        turn = self._inflight.get(key)
+        if turn is not None:
+            self.counters["coalesced"] += 1
+            return turn
+
+        turn = Turn(produce)
+        turn.keep_failed = keep_failed
+        self.counters["turns"] += 1
+        if key[-1] is not None:
+            self._inflight[key] = turn
+        self._sessions.setdefault(key[1], {})[turn] = key
+        turn.task.add_done_callback(lambda _: self._finish(key, turn))
+        return turn
+
+    def cancel(self, session_id, request_id=None, reason="cancelled"):
+        """Cancel the session's turns in flight (only those of `request_id` if given)."""
+        cancelled = 0
+        for turn, key in list(self._sessions.get(session_id, {}).items()):
+            if request_id is None or key[-1] == request_id:
+                cancelled += turn.cancel(reason)
+        return cancelled
+
+    def _finish(self, key, turn):
+        session = self._sessions.get(key[1], {})
+        session.pop(turn, None)
+        if not session:
+            self._sessions.pop(key[1], None)
+        if turn.task.cancelled():
+            self.counters["cancelled"] += 1
+        else:
+            turn.task.exception()  # mark as retrieved; followers re-raise it
+        if key[-1] is None:
+            return
+        self._inflight.pop(key, None)
+        # Only successful turns are replayed; a failed one may be retried
+        if turn.succeeded or turn.keep_failed:
+            self._completed[key] = turn
+            while len(self._completed) > self.max_completed:
+                self._completed.popitem(last=False)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "completed_cached": len(self._completed),
+            **self.counters,
+        }
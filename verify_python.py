@@ -1,6 +1,7 @@
-from google import genai
+from model_client import create_client
 
-client = genai.Client()
+# Uses GOOGLE_API_KEY, or runs offline with GEMINI_BACKEND=fake
+client = create_client()
 
 response = client.models.generate_content(
     model="gemini-2.5-flash",